@@ -1,7 +1,11 @@
 import datetime
 
+import numpy
 import pygame
 
+from applehealthtool.columns import ReportColumns
+from applehealthtool.lod import visible_range, minmax_columns, needs_reduction
+
 
 class DataSet():
     def __init__(self, name, rows, label='', color=pygame.Color(0, 0, 0)):
@@ -14,6 +18,11 @@ class DataSet():
     def data_count(self):
         return len(self._data)
 
+    @property
+    def columnar(self):
+        # rows is a ReportColumns of epoch seconds rather than a list of dicts
+        return isinstance(self._data, ReportColumns)
+
     def get_iter_row(self, index):
         if index >= 0 and index < self.data_count:
             return []
@@ -50,9 +59,23 @@ class DataDateRange(DataSet):
             if not t in self.config:
                 print(f'WARNING: No entry for {t} in config')
         self._xmin = self._xmax = self._ymin = self._ymax = None
+        # start and end as float64 epoch seconds and the type of each range
+        self._starts = numpy.empty(0)
+        self._ends = numpy.empty(0)
+        self._types = numpy.empty(0, dtype=object)
         if self.data_count < 1:
             return
-        self._convert_date_cols()
+        if self.columnar:
+            self._starts = self._data[self.x_start_col]
+            self._ends = self._data[self.x_end_col]
+            self._types = self._data[self.type_col]
+            self._xmin = float(self._starts[0])
+            self._xmax = float(self._ends[-1])
+        else:
+            self._convert_date_cols()
+            self._starts = column_array(self._data, self.x_start_col)
+            self._ends = column_array(self._data, self.x_end_col)
+            self._types = numpy.array([d[self.type_col] for d in self._data], dtype=object)
 
     def _convert_date_cols(self):
         if self.data_count < 1:
@@ -70,6 +93,12 @@ class DataDateRange(DataSet):
 
     def get_iter_row(self, index):
         if index >= 0 and index < self.data_count:
+            if self.columnar:
+                return [
+                    self._data[self.type_col][index],
+                    self._data[self.x_start_col][index],
+                    self._data[self.x_end_col][index],
+                ]
             return [
                 self._data[index][self.type_col],
                 self._data[index][self.x_start_col],
@@ -78,6 +107,28 @@ class DataDateRange(DataSet):
         else:
             raise StopIteration
 
+    @property
+    def x_start_values(self):
+        return self._starts
+
+    @property
+    def x_end_values(self):
+        return self._ends
+
+    @property
+    def type_values(self):
+        return self._types
+
+
+
+def column_array(rows, col, timeseries=False):
+    '''
+    One column of a list of row dicts as a float64 array.
+    :param timeseries: the column holds datetimes, convert them to epoch seconds
+    '''
+    if timeseries:
+        return numpy.fromiter((d[col].timestamp() for d in rows), dtype=numpy.float64, count=len(rows))
+    return numpy.array([d[col] for d in rows], dtype=numpy.float64)
 
 
 class DataSeries(DataSet):
@@ -90,42 +141,70 @@ class DataSeries(DataSet):
         self._y_data_cols = y_data_cols
         self._line_width = line_width
         self._xmin = self._xmax = self._ymin = self._ymax = None
+        # x and one array per y column, float64; missing values are NaN
+        self._x = numpy.empty(0)
+        self._y = [numpy.empty(0) for _ in y_data_cols]
         if self.data_count < 1:
             return
-        if timeseries:
-            # convert dates to integers
-            orig_x_col = x_data_col + '_orig'
-            print(f'Rename timestamp row to {orig_x_col}')
-            for d in self._data:
-                d[orig_x_col] = d[x_data_col]
-                d[x_data_col] = datetime.datetime.timestamp(d[x_data_col])
-                # print(f' - timestamp: {d[x_data_row]}')
-        self._xmin = float(self._data[0][self._x_data_col])
-        self._xmax = float(self._data[-1][self._x_data_col])
-
-        self._ymin = self._ymax = float(self._data[0][self._y_data_cols[0]])
-        for row in self._data:
-            for col in self._y_data_cols:
-                d = float(row[col])
-                if d < self._ymin:
-                    self._ymin = d
-                if d > self._ymax:
-                    self._ymax = d
+        if self.columnar:
+            # dates are epoch seconds already, whatever timeseries says
+            self._x = self._data[x_data_col]
+            self._y = [self._data[col] for col in y_data_cols]
+        else:
+            self._x = column_array(self._data, x_data_col, timeseries)
+            self._y = [column_array(self._data, col) for col in y_data_cols]
+        self._xmin = float(self._x[0])
+        self._xmax = float(self._x[-1])
+        self._ymin = float(min(numpy.nanmin(y) for y in self._y))
+        self._ymax = float(max(numpy.nanmax(y) for y in self._y))
 
         print(f'   x min/max: {self._xmin} / {self._xmax}')
         print(f'data min/max: {self._ymin} / {self._ymax}')
 
     def get_iter_row(self, index):
         if index >= 0 and index < self.data_count:
-            row = [
-                self._data[index][self._x_data_col]
-            ]
-            for y in self._y_data_cols:
-                row.append(self._data[index][y])
-            return row
+            return [self._x[index]] + [y[index] for y in self._y]
         else:
             raise StopIteration
 
+    def scaled_lines(self, xscaler, yscaler, downsample=True):
+        '''
+        The series in view coordinates, ready for pygame.draw.lines.
+        :param downsample: leave out the points outside the x view and, where there are more points than
+                           the view has pixel columns to show, reduce each column with lod.minmax_columns
+        :return: a list of [x, y] points per y column, points with a missing y are left out
+        '''
+        if self.data_count < 1:
+            return [[] for _ in self._y]
+        x = xscaler.scale_array(self._x)
+        ys = self._y
+        view_min = min(xscaler.view_min, xscaler.view_max)
+        view_max = max(xscaler.view_min, xscaler.view_max)
+        if downsample:
+            start, stop = visible_range(x, view_min, view_max)
+            x = x[start:stop]
+            ys = [y[start:stop] for y in ys]
+        lines = []
+        for y in ys:
+            vx = x
+            keep = ~numpy.isnan(y)
+            if not keep.all():
+                vx = x[keep]
+                y = y[keep]
+            vy = yscaler.scale_array(y)
+            if downsample and needs_reduction(len(vx), view_max - view_min):
+                vx, vy = minmax_columns(vx, vy)
+            lines.append(numpy.column_stack((vx, vy)).tolist())
+        return lines
+
+    @property
+    def x_values(self):
+        return self._x
+
+    @property
+    def y_values(self):
+        return self._y
+
     @property
     def x_minmax(self):
         return (self._xmin, self._xmax)
@@ -195,6 +274,31 @@ class DataViewScaler:
         r = (data_value - self.data_min) / (self.data_max - self.data_min)
         return r * (self.view_max - self.view_min) + self.view_min
 
+    def scale_array(self, data_values):
+        '''
+        scale() over a whole column in one vectorised call.
+        :param data_values: numpy array or sequence of data values
+        :return: float64 numpy array of view values
+        '''
+        values = numpy.asarray(data_values, dtype=numpy.float64)
+        if self.clamp:
+            values = numpy.clip(values, self.data_min, self.data_max)
+        r = (values - self.data_min) / (self.data_max - self.data_min)
+        return r * (self.view_max - self.view_min) + self.view_min
+
+    def shifted(self, offset):
+        '''
+        :return: a copy of this scaler with the view moved by offset, e.g. to draw on a surface placed at -offset
+        '''
+        return DataViewScaler(list(self.data_limits), [self.view_min + offset, self.view_max + offset], self.clamp)
+
+    @property
+    def state(self):
+        '''
+        Everything scale() depends on; layers drawn through this scaler are out of date when it changes.
+        '''
+        return tuple(self.data_limits or (None, None)) + tuple(self.view_limits or (None, None)) + (self.clamp,)
+
     @property
     def is_valid(self):
         if self.data_min is None or self.data_max is None or self.view_min is None or self.view_max is None:
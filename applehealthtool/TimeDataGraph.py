@@ -8,7 +8,88 @@ from pygame_gui.elements import UIImage
 
 from applehealthtool.GraphData import DataViewScaler, DataSeries, DataDateRange
 from applehealthtool.layers import TextLayer, BackgroundLayer, AxisLayer, BPRangeLayer, GraphLayer, DataSeriesLayer, \
-    DateRangeDataLayer
+    DateRangeDataLayer, DEPENDS_X, DEPENDS_Y
+
+
+def merge_rects(rects):
+    '''
+    Merge overlapping rectangles so no area is composed twice.
+    :return: list of non overlapping pygame.Rect
+    '''
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        n = rect.collidelist(merged)
+        while n >= 0:
+            rect.union_ip(merged.pop(n))
+            n = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+
+class LayerCompositor:
+    '''
+    Composes the layers of a UIGraph onto its image. Every layer keeps its rendered surface between
+    redraws and is only rendered again when it is dirty or a scaler in its depends_on changed. Only the
+    areas of the layers that changed are filled and blitted again, everything else is left as it was.
+    '''
+    def __init__(self, background_color, scalers):
+        '''
+        :param scalers: {DEPENDS_X: DataViewScaler, DEPENDS_Y: DataViewScaler}
+        '''
+        self.background_color = background_color
+        self.scalers = scalers
+        self._scaler_states = {}
+        self._composed = {} # layer -> (visible, rect) when last composed
+        self._full = True
+
+    def invalidate(self):
+        # compose the whole target on the next call, e.g. when it was drawn over
+        self._full = True
+
+    def compose(self, layers, target:pygame.Surface):
+        '''
+        Bring target up to date with layers.
+        :param layers: GraphLayers from the bottom up
+        :return: list of the rectangles of target that were composed again
+        '''
+        changed = set()
+        for name, scaler in self.scalers.items():
+            state = scaler.state
+            if self._scaler_states.get(name) != state:
+                self._scaler_states[name] = state
+                changed.add(name)
+
+        dirty = []
+        for layer in layers:
+            if changed.intersection(layer.depends_on):
+                layer.dirty = True
+            rendered = False
+            if layer.visible and layer.dirty:
+                layer.update()
+                layer.dirty = False
+                rendered = True
+            state = (layer.visible, layer.rect if layer.visible else None)
+            previous = self._composed.get(layer)
+            if rendered or previous != state:
+                # where it was and where it is now
+                dirty.extend(rect for rect in (previous[1] if previous else None, state[1]) if rect)
+            self._composed[layer] = state
+
+        bounds = target.get_rect()
+        if self._full:
+            dirty = [bounds]
+            self._full = False
+        rects = [rect.clip(bounds) for rect in merge_rects(dirty)]
+        rects = [rect for rect in rects if rect.width > 0 and rect.height > 0]
+        for rect in rects:
+            target.set_clip(rect)
+            target.fill(self.background_color, rect)
+            for layer in layers:
+                if layer.visible and layer.rect and layer.rect.colliderect(rect):
+                    layer.blit(target)
+        target.set_clip(None)
+        return rects
 
 
 class UIGraph(UIImage):
@@ -16,7 +97,7 @@ class UIGraph(UIImage):
         'background_color': pygame.Color(220, 220, 220, 255),
         'margin': 10,
         'title': {
-            'font': 'arial',
+            'font': 'FiraMono', # bundled, see applehealthtool.fonts
             'font_size': 20,
             'text_color': pygame.Color(0, 0, 0, 255)
         },
@@ -52,6 +133,7 @@ class UIGraph(UIImage):
         self._yscaler = DataViewScaler([0, 200], [None, None])
 
         self._background_color = UIGraph.DEFAULT_CONFIG['background_color']
+        self._compositor = LayerCompositor(self._background_color, {DEPENDS_X: self._xscaler, DEPENDS_Y: self._yscaler})
         self._margin = self.DEFAULT_CONFIG['margin']
         self._title = title
         if title_font_name is None:
@@ -86,10 +168,13 @@ class UIGraph(UIImage):
 
         self.calculate_graph_rect()
         origin = self.graph_rect.topleft
-        self.background_layer = BackgroundLayer(self.graph_rect.size, pygame.Color(220, 220, 220, 255), self._xscaler, self._yscaler, offset=origin)
+        axis_background = pygame.Color(220, 220, 220, 255)
+        self.background_layer = BackgroundLayer(self.graph_rect.size, axis_background, self._xscaler, self._yscaler, offset=origin)
         self.add_layer(self.background_layer)
 
-        self.axis_layer = AxisLayer(self.get_relative_rect().size, self.axis_color, self.axis_width, self._xscaler, self._yscaler, self.graph_rect)
+        # the tick labels are drawn over background_layer, render them onto its colour
+        self.axis_layer = AxisLayer(self.graph_rect.size, self.axis_color, self.axis_width, self._xscaler, self._yscaler, self.graph_rect,
+                                    label_background=axis_background)
         self.axis_layer.recalculate_layout()
 
         w = self.graph_rect.width - self.axis_layer.y_axis_rect.width
@@ -99,10 +184,11 @@ class UIGraph(UIImage):
 
         self.add_layer(self.axis_layer)
 
-        bp_range_layer = BPRangeLayer(self.get_relative_rect().size, pygame.Color(220, 255, 220, 128), self._xscaler, self._yscaler)
-        self.add_layer(bp_range_layer)
-
         self.recalculate_layout()
+        # layers drawn through the scalers only cover graph_data_rect
+        bp_range_layer = BPRangeLayer(self.graph_data_rect.size, pygame.Color(220, 255, 220, 128), self._xscaler, self._yscaler,
+                                      offset=self.graph_data_rect.topleft)
+        self.add_layer(bp_range_layer)
         # self.redraw()
         # IGraph._list_system_fonts()
 
@@ -130,15 +216,20 @@ class UIGraph(UIImage):
         self._layer_list.append(layer)
 
     def add_data_series_layer(self, data_series:DataSeries):
-        xmin, xmax = data_series.x_minmax
-        self._xscaler.update_data_limits(xmin, xmax)
-        ymin, ymax = data_series.y_minmax
-        self._yscaler.update_data_limits(ymin, ymax)
-        layer = DataSeriesLayer(data_series, self.get_relative_rect().size, self._xscaler, self._yscaler)
+        if hasattr(data_series, 'update_from_scaler'):
+            # a LazyDataSeries loads whatever the x range shows instead of widening it
+            if self._xscaler.is_valid:
+                data_series.update_from_scaler(self._xscaler)
+        else:
+            xmin, xmax = data_series.x_minmax
+            self._xscaler.update_data_limits(xmin, xmax)
+        if data_series.data_count > 0:
+            ymin, ymax = data_series.y_minmax
+            self._yscaler.update_data_limits(ymin, ymax)
+        # the compositor renders the layers drawn through the scalers again if the limits changed
+        layer = DataSeriesLayer(data_series, self.graph_data_rect.size, self._xscaler, self._yscaler,
+                                offset=self.graph_data_rect.topleft)
         self._layer_list.append(layer)
-        for layer in self._layer_list:
-            # If we update the scalers, we need to mark all of the layers as dirty
-            layer.dirty = True
 
     def add_sleep_data(self, sleep_data:DataDateRange):
         self.sleep_data = sleep_data
@@ -149,11 +240,28 @@ class UIGraph(UIImage):
             'HKCategoryValueSleepAnalysisAwake': pygame.Color(255, 255, 200, 128),
             'HKCategoryValueSleepAnalysisAsleep': pygame.Color(200, 255, 200, 128)
         }
-        layer = DateRangeDataLayer(sleep_data, self.get_relative_rect().size, self._xscaler, self._yscaler, type_color_map, TYPE_ROW)
+        layer = DateRangeDataLayer(sleep_data, self.graph_data_rect.size, self._xscaler, self._yscaler, type_color_map, TYPE_ROW,
+                                   offset=self.graph_data_rect.topleft)
         self.add_layer(layer)
+
+    def set_x_range(self, x_min, x_max):
+        '''
+        Show x_min to x_max, e.g. to pan or zoom. Lazily loaded data sets fetch the new range.
+        '''
+        self._xscaler.data_min = x_min
+        self._xscaler.data_max = x_max
+        self.refresh_data_sets()
+
+    def refresh_data_sets(self):
+        '''
+        Reload the lazily loaded data sets for the current x range, e.g. after tiles arrived in the
+        background, and mark their layers for redrawing.
+        '''
         for layer in self._layer_list:
-            # If we update the scalers, we need to mark all of the layers as dirty
-            layer.dirty = True
+            data_set = getattr(layer, 'data_set', None)
+            if hasattr(data_set, 'update_from_scaler') and self._xscaler.is_valid:
+                data_set.update_from_scaler(self._xscaler)
+                layer.dirty = True
 
     def calculate_title_rect(self):
         # for now, title is centered horizontally, top aligned vertically
@@ -195,22 +303,12 @@ class UIGraph(UIImage):
             if not self._layers[ds_name].visible:
                 continue
             print(f'DS: {ds.name}')
-            lines = []
-            ycount = ds.y_per_column
-            for y in range(ycount):
-                print(f'Start Empty Line: {y}')
-                lines.append([])
-
             if ds.data_count > 0:
-                print(f'First Row: {ds._data[0]["startDate"]}')
-                print(f' Last Row: {ds._data[-1]["startDate"]}')
+                print(f'First Row: {ds.x_min}')
+                print(f' Last Row: {ds.x_max}')
             else:
                 print(f'NO DATA')
-            for row in ds:
-                x = self._xscaler.scale(float(row[0]))
-                for i in range(ycount):
-                    y = self._yscaler.scale(float(row[i + 1]))
-                    lines[i].append([x, y])
+            lines = ds.scaled_lines(self._xscaler, self._yscaler)
 
             for line in lines:
                 if len(line) > 1:
@@ -231,15 +329,20 @@ class UIGraph(UIImage):
         # surface.blit(self._layers['sleep'].surface, (0,0))
         # self.draw_data_sets()
 
-    def redraw(self):
+    def redraw(self, full=False):
+        '''
+        Render the layers that changed and compose them onto the image.
+        :param full: compose the whole image, not only what changed
+        :return: list of the rectangles of the image that changed
+        '''
         surface = self.base_surface
         if not surface:
             print(f'Creating missing base surface')
-            pygame.Surface(self.get_relative_rect().size, flags=SRCALPHA)
-        surface.fill(self._background_color)
-
-        for layer in self._layer_list:
-            layer.redraw(self.base_surface)
+            self.set_image(pygame.Surface(self.get_relative_rect().size, flags=SRCALPHA))
+            full = True
+        if full:
+            self._compositor.invalidate()
+        return self._compositor.compose(self._layer_list, self.base_surface)
 
     @classmethod
     def _list_system_fonts(cls):
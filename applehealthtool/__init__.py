@@ -26,3 +26,15 @@ def get_themes_file_path(file_name):
         return None
     path = os.path.join(themes_dir, file_name)
     return path if os.path.exists(path) else None
+
+_fonts_dir = os.path.join(_data_dir, 'fonts')
+
+def get_fonts_dir():
+    return _fonts_dir if os.path.exists(_fonts_dir) else None
+
+def get_fonts_file_path(file_name):
+    fonts_dir = get_fonts_dir()
+    if fonts_dir is None:
+        return None
+    path = os.path.join(fonts_dir, file_name)
+    return path if os.path.exists(path) else None
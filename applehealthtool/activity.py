@@ -0,0 +1,340 @@
+'''
+Everything in an export besides plain Records: Workouts, ActivitySummaries, the MetadataEntry and
+HeartRateVariabilityMetadataList children of records and the GPX files in workout-routes/.
+
+Long series (route points, beat to beat heart rate) are stored packed, one blob per column, rather
+than one row per point. pack_array and unpack_array convert between lists and the blobs.
+'''
+import array
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import posixpath
+import sys
+import xml.etree.ElementTree as ET
+import zipfile
+
+from applehealthtool.dates import parse_epoch, parse_utc_epoch
+from applehealthtool.sources import RouteReader
+
+WORKOUT_TAG = 'Workout'
+ACTIVITY_SUMMARY_TAG = 'ActivitySummary'
+METADATA_TAG = 'MetadataEntry'
+HRV_LIST_TAG = 'HeartRateVariabilityMetadataList'
+BEAT_TAG = 'InstantaneousBeatsPerMinute'
+WORKOUT_STATISTICS_TAG = 'WorkoutStatistics'
+WORKOUT_ROUTE_TAG = 'WorkoutRoute'
+FILE_REFERENCE_TAG = 'FileReference'
+# top level elements imported besides Record; also accepted by the type filter
+ELEMENT_TAGS = (WORKOUT_TAG, ACTIVITY_SUMMARY_TAG)
+
+ACTIVE_ENERGY_TYPE = 'HKQuantityTypeIdentifierActiveEnergyBurned'
+DISTANCE_TYPE_PREFIX = 'HKQuantityTypeIdentifierDistance'
+
+# typecodes of the packed columns
+BPM_TYPECODE = 'H' # uint16
+OFFSET_TYPECODE = 'i' # int32, milliseconds or seconds from the start of the series
+COORDINATE_TYPECODE = 'i' # int32, degrees * COORDINATE_SCALE
+FLOAT_TYPECODE = 'f' # float32
+COORDINATE_SCALE = 10000000 # 1e-7 degrees is about a centimetre
+CPUS_PER_ROUTE_WORKER = 4 # routes are parsed next to the import, not instead of it
+# what a damaged or unreadable route file raises; anything else, e.g. a broken process pool, stops the import
+ROUTE_FILE_ERRORS = (ET.ParseError, KeyError, OSError, ValueError, TypeError, zipfile.BadZipFile)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def pack_array(typecode, values):
+    '''
+    Pack numbers into a little endian blob of array typecode.
+    '''
+    a = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tobytes()
+
+
+def unpack_array(typecode, data):
+    '''
+    Inverse of pack_array.
+    :return: array.array of typecode
+    '''
+    a = array.array(typecode)
+    a.frombytes(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+def _float(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_time_of_day(time_string):
+    '''
+    Parse the local time of an InstantaneousBeatsPerMinute element, e.g. '7:42:39.73 PM' or '19:42:39,73'.
+    :return: milliseconds since midnight, or None if it cannot be read
+    '''
+    parts = time_string.split()
+    try:
+        h, m, s = parts[0].split(':')
+        ms = int(h) * 3600000 + int(m) * 60000 + round(float(s.replace(',', '.')) * 1000)
+    except ValueError:
+        return None
+    if len(parts) > 1:
+        suffix = parts[1].upper()
+        if suffix == 'PM' and int(h) != 12:
+            ms += 12 * 3600000
+        elif suffix == 'AM' and int(h) == 12:
+            ms -= 12 * 3600000
+    return ms
+
+
+class ExtraRows:
+    '''
+    Converted rows of everything but the records themselves, collected alongside a batch of records
+    and written by AppleHealthDatabase.insert_extras. Strings are left for the database to encode.
+    '''
+    def __init__(self):
+        self.metadata = [] # (type, sourceName, start date, key, value)
+        self.heart_beats = [] # (type, sourceName, start date, count, packed bpm, packed ms offsets)
+        self.workouts = [] # dicts, see add_workout
+        self.activity_summaries = [] # dicts, see add_activity_summary
+        self.routes = [] # dicts, see parse_route
+
+    def __len__(self):
+        return len(self.metadata) + len(self.heart_beats) + len(self.workouts) + \
+            len(self.activity_summaries) + len(self.routes)
+
+    def extend(self, other):
+        self.metadata.extend(other.metadata)
+        self.heart_beats.extend(other.heart_beats)
+        self.workouts.extend(other.workouts)
+        self.activity_summaries.extend(other.activity_summaries)
+        self.routes.extend(other.routes)
+
+    def add_record_children(self, elem, row):
+        '''
+        Collect the MetadataEntry and HeartRateVariabilityMetadataList children of a Record.
+        :param row: the record converted by make_row_tuple, for its type, source and start date
+        '''
+        record_type, source_name, start_date = row[0], row[1], row[6]
+        for child in elem:
+            if child.tag == METADATA_TAG:
+                self.metadata.append((record_type, source_name, start_date, child.get('key'), child.get('value')))
+            elif child.tag == HRV_LIST_TAG:
+                self._add_heart_beats(elem.get('startDate'), child, row)
+
+    def _add_heart_beats(self, start_string, beats, row):
+        start_ms = parse_time_of_day(start_string[11:19]) # local time of day the series starts
+        bpm = []
+        offsets = []
+        for beat in beats:
+            if beat.tag != BEAT_TAG:
+                continue
+            bpm.append(int(_float(beat.get('bpm')) or 0))
+            ms = parse_time_of_day(beat.get('time', ''))
+            if ms is None or start_ms is None:
+                offsets.append(-1)
+            else:
+                offsets.append((ms - start_ms) % (SECONDS_PER_DAY * 1000))
+        self.heart_beats.append((row[0], row[1], row[6], len(bpm),
+                                 pack_array(BPM_TYPECODE, bpm), pack_array(OFFSET_TYPECODE, offsets)))
+
+    def add_workout(self, elem):
+        attrib = elem.attrib
+        start_date = parse_epoch(attrib['startDate'])
+        workout = {
+            'activityType': attrib['workoutActivityType'],
+            'sourceName': attrib['sourceName'],
+            'sourceVersion': attrib.get('sourceVersion', ''),
+            'device': attrib.get('device', ''),
+            'creationDate': parse_epoch(attrib['creationDate']) if 'creationDate' in attrib else None,
+            'startDate': start_date,
+            'endDate': parse_epoch(attrib['endDate']),
+            'duration': _float(attrib.get('duration')),
+            'durationUnit': attrib.get('durationUnit', ''),
+            'totalDistance': _float(attrib.get('totalDistance')),
+            'totalDistanceUnit': attrib.get('totalDistanceUnit', ''),
+            'totalEnergyBurned': _float(attrib.get('totalEnergyBurned')),
+            'totalEnergyBurnedUnit': attrib.get('totalEnergyBurnedUnit', ''),
+            'routeName': None,
+        }
+        for child in elem:
+            if child.tag == METADATA_TAG:
+                self.metadata.append((workout['activityType'], workout['sourceName'], start_date,
+                                      child.get('key'), child.get('value')))
+            elif child.tag == WORKOUT_STATISTICS_TAG:
+                # newer exports give the totals as statistics instead of attributes
+                statistic = child.get('type', '')
+                if statistic == ACTIVE_ENERGY_TYPE and workout['totalEnergyBurned'] is None:
+                    workout['totalEnergyBurned'] = _float(child.get('sum'))
+                    workout['totalEnergyBurnedUnit'] = child.get('unit', '')
+                elif statistic.startswith(DISTANCE_TYPE_PREFIX) and workout['totalDistance'] is None:
+                    workout['totalDistance'] = _float(child.get('sum'))
+                    workout['totalDistanceUnit'] = child.get('unit', '')
+            elif child.tag == WORKOUT_ROUTE_TAG:
+                reference = child.find(FILE_REFERENCE_TAG)
+                if reference is not None and reference.get('path'):
+                    workout['routeName'] = posixpath.basename(reference.get('path'))
+        self.workouts.append(workout)
+
+    def add_activity_summary(self, elem):
+        attrib = elem.attrib
+        self.activity_summaries.append({
+            'date': attrib['dateComponents'],
+            'active_energy_burned': _float(attrib.get('activeEnergyBurned')),
+            'active_energy_burned_goal': _float(attrib.get('activeEnergyBurnedGoal')),
+            'active_energy_burned_unit': attrib.get('activeEnergyBurnedUnit', ''),
+            'apple_move_time': _float(attrib.get('appleMoveTime')),
+            'apple_move_time_goal': _float(attrib.get('appleMoveTimeGoal')),
+            'apple_exercise_time': _float(attrib.get('appleExerciseTime')),
+            'apple_exercise_time_goal': _float(attrib.get('appleExerciseTimeGoal')),
+            'apple_stand_hours': _float(attrib.get('appleStandHours')),
+            'apple_stand_hours_goal': _float(attrib.get('appleStandHoursGoal')),
+        })
+
+
+def parse_route(name, data):
+    '''
+    Parse a GPX route into packed columns.
+    :param name: file name the route is stored under, matches the FileReference of its Workout
+    :param data: contents of the .gpx file
+    :return: dict of name, start_date, end_date, point_count and packed times (seconds from
+             start_date), latitudes, longitudes, elevations and speeds
+    '''
+    times = []
+    latitudes = []
+    longitudes = []
+    elevations = []
+    speeds = []
+    for _, elem in ET.iterparse(io.BytesIO(data)):
+        if not elem.tag.endswith('}trkpt') and elem.tag != 'trkpt':
+            continue
+        latitudes.append(round(float(elem.get('lat')) * COORDINATE_SCALE))
+        longitudes.append(round(float(elem.get('lon')) * COORDINATE_SCALE))
+        time = elevation = speed = None
+        for child in elem.iter():
+            tag = child.tag.rsplit('}', 1)[-1]
+            if tag == 'time':
+                time = parse_utc_epoch(child.text.strip())
+            elif tag == 'ele':
+                elevation = _float(child.text)
+            elif tag == 'speed':
+                speed = _float(child.text)
+        times.append(time)
+        elevations.append(float('nan') if elevation is None else elevation)
+        speeds.append(float('nan') if speed is None else speed)
+        elem.clear()
+    known = [t for t in times if t is not None]
+    start_date = min(known) if known else None
+    end_date = max(known) if known else None
+    return {
+        'name': name,
+        'start_date': start_date,
+        'end_date': end_date,
+        'point_count': len(times),
+        'times': pack_array(OFFSET_TYPECODE, [-1 if t is None else t - start_date for t in times]),
+        'latitudes': pack_array(COORDINATE_TYPECODE, latitudes),
+        'longitudes': pack_array(COORDINATE_TYPECODE, longitudes),
+        'elevations': pack_array(FLOAT_TYPECODE, elevations),
+        'speeds': pack_array(FLOAT_TYPECODE, speeds),
+    }
+
+
+_route_reader = None # of the export, in each RouteLoader worker process
+
+
+def default_route_workers():
+    '''
+    :return: processes a RouteLoader starts by default, a share of the CPUs small enough to leave the
+             rest to the XML parse (and the converter processes of the pipeline) it runs alongside
+    '''
+    return max(1, (os.cpu_count() or 1) // CPUS_PER_ROUTE_WORKER)
+
+
+def _init_route_worker(export_path, kind):
+    global _route_reader
+    _route_reader = RouteReader(export_path, kind)
+
+
+def load_route(route_file):
+    # runs in a RouteLoader worker process
+    return parse_route(posixpath.basename(route_file), _route_reader.read(route_file))
+
+
+class RouteLoader:
+    '''
+    Parses the GPX files of an export in worker processes while the caller streams export.xml.
+    The caller collects the parsed routes with finished() as it goes and wait() at the end, and
+    writes them itself so the database keeps a single writer.
+    '''
+    def __init__(self, source, skip_names=(), workers=None):
+        '''
+        :param source: open ExportSource
+        :param skip_names: names of routes already stored, they are not parsed again
+        :param workers: number of processes, defaults to default_route_workers()
+        '''
+        self.source = source
+        self.skip_names = set(skip_names)
+        self.workers = workers or default_route_workers()
+        self._executor = None
+        self._pending = []
+        self.routes_failed = 0
+
+    def start(self):
+        route_files = [name for name in self.source.route_files()
+                       if posixpath.basename(name) not in self.skip_names]
+        if not route_files:
+            return self
+        print(f'Parsing {len(route_files)} workout routes')
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_route_worker, initargs=(self.source.path, self.source.kind))
+        self._pending = [self._executor.submit(load_route, name) for name in route_files]
+        return self
+
+    def _collect(self, futures):
+        routes = []
+        for future in futures:
+            try:
+                routes.append(future.result())
+            except ROUTE_FILE_ERRORS as e:
+                # a damaged route file should not stop the import
+                print(f'Skipping workout route: {type(e).__name__}: {e}')
+                self.routes_failed += 1
+        return routes
+
+    def finished(self):
+        '''
+        :return: routes parsed since the last call, without waiting for the rest
+        '''
+        done = []
+        pending = []
+        for future in self._pending:
+            (done if future.done() else pending).append(future)
+        self._pending = pending
+        return self._collect(done)
+
+    def wait(self):
+        '''
+        :return: every route not returned yet, once all are parsed
+        '''
+        routes = self._collect(self._pending)
+        self._pending = []
+        self.close()
+        return routes
+
+    def close(self):
+        if self._executor:
+            for future in self._pending:
+                future.cancel()
+            self._pending = []
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -1,7 +1,4 @@
-import datetime
 import os
-import pathlib
-import zipfile
 
 import pygame
 import pygame_gui
@@ -12,12 +9,11 @@ from pycraft_gui.gui_app import GuiApp
 
 import applehealthtool
 from applehealthtool.data_panel import DataPanel, LOAD_DATABASE, SELECT_DATABASE, SELECT_SOURCE_FILE, LOAD_DATA_SOURCE
+from applehealthtool.data_panel import CANCEL_IMPORT, IMPORT_PROGRESS, IMPORT_FINISHED
 from applehealthtool.healthdatabase import AppleHealthDatabase
-from applehealthtool.healthdatabase import HealthData
+from applehealthtool.import_thread import ImportThread, IMPORT_SUCCEEDED, IMPORT_CANCELLED
 from applehealthtool.report import ReportPanel
 
-import xml.etree.ElementTree as ET
-
 class AppleHealthTool(GuiApp):
     def __init__(self, size=(1280, 960)):
         super().__init__(size, title='Apple Heath Data Tool')
@@ -34,7 +30,9 @@ class AppleHealthTool(GuiApp):
         self._button_width = 100
         self._button_height = 35
         self._button_rect = pygame.Rect(0, 0, self._button_width, self._button_height)
-        self._database = AppleHealthDatabase()
+        self._database = AppleHealthDatabase(persist_reports=True)
+        self._import_thread = None
+        self._import_reading = False # an IMPORT_PROGRESS event has arrived for the running import
 
     def setup(self):
         button_pane = UIPanel(
@@ -114,6 +112,9 @@ class AppleHealthTool(GuiApp):
                 self._data_panel.hide()
             elif event.ui_element == self._quit_button:
                 print(f'quit')
+                if self._import_thread:
+                    self._import_thread.cancel()
+                    self._import_thread.join()
                 self.is_running = False
                 pygame.quit()
         elif event.type == LOAD_DATABASE:
@@ -121,6 +122,18 @@ class AppleHealthTool(GuiApp):
             self.open_database(event.db_path)
         elif event.type == LOAD_DATA_SOURCE:
             self.open_data_source(event.file_path)
+        elif event.type == IMPORT_PROGRESS:
+            if not self._import_reading:
+                self._import_reading = True
+                self._data_panel.start_reading_data()
+            self._data_panel.set_import_progress(event.bytes_read, event.bytes_total,
+                                                 event.records_read, event.records_saved)
+        elif event.type == IMPORT_FINISHED:
+            self.import_finished(event)
+        elif event.type == CANCEL_IMPORT:
+            if self._import_thread:
+                print('cancel import')
+                self._import_thread.cancel()
         elif event.type == SELECT_SOURCE_FILE:
             print(f'select source {event}')
             UIFileDialog(
@@ -166,15 +179,17 @@ class AppleHealthTool(GuiApp):
             bp_report = self._database.get_blood_pressure_report()
             print('[')
             for row in bp_report:
-                print(f'{{"date": datetime.strptime("{row["date"]}", "%Y-%m-%d %H:%M:%S.000000"), "systolic": {row["systolic"]}, "diastolic": {row["diastolic"]}}},')
+                date = row['startDate'].strftime('%Y-%m-%d %H:%M:%S.000000')
+                print(f'{{"date": datetime.strptime("{date}", "%Y-%m-%d %H:%M:%S.000000"), "systolic": {row["systolic"]}, "diastolic": {row["diastolic"]}}},')
             print(']')
-                # NOTE date is just a str
 
     def open_database(self, path):
         try:
             if not os.path.exists(os.path.dirname(path)):
                 os.makedirs(os.path.dirname(path))
             self.db_engine = self._database.open_database(path)
+            if self._database.needs_migration():
+                self._database.migrate_legacy_data()
         except Exception as e:
             print(f'Uh-oh: {e}')
             UIMessageWindow(
@@ -190,88 +205,42 @@ class AppleHealthTool(GuiApp):
         self.count_records()
 
     def open_data_source(self, file_path):
+        '''
+        Start importing an export on the import thread. Progress and completion come back as
+        IMPORT_PROGRESS and IMPORT_FINISHED events.
+        '''
         print(f'Path: {file_path}')
-        path_obj = pathlib.Path(file_path)
-        data = None
-        self._data_panel.start_reading_data()
-        self._main_loop() # run the main loop once to update the screen
-
-        if path_obj.suffix == '.zip':
-            with zipfile.ZipFile(file_path, 'r') as zippy:
-                with zippy.open('apple_health_export/export.xml') as d:
-                    data = d.read()
-        elif path_obj.suffix == '.xml':
-            with open(file_path, 'r') as d:
-                data = d.read()
-        latest = self._database.latest_record() if self.db_engine else None
-        self._data_panel.finish_reading_data()
-        self._main_loop() # run the main loop once to update the screen
-        self.load_xml_data(data, latest)
-
-    def load_xml_data(self, data, latest):
-        if not data or not self.db_engine:
-            # show an error dialog
+        if self._import_thread or not self.db_engine:
             return
-        print(f'Loading XML Data...')
-        self._data_panel.set_xml_load_progress(0)
-        self._main_loop()
-        root = ET.fromstring(data)
-        # root = tree.getroot()
-        records = []
-        tags = {
-            'HKQuantityTypeIdentifierBloodPressureDiastolic': 'diastolic',
-            'HKQuantityTypeIdentifierBloodPressureSystolic': 'systolic',
-            'HKQuantityTypeIdentifierHeartRate': 'heart-rate',
-            'HKQuantityTypeIdentifierBodyMass': 'weight',
-            'HKQuantityTypeIdentifierHeight': 'height',
-            'HKQuantityTypeIdentifierActiveEnergyBurned': 'calories',
-            'HKQuantityTypeIdentifierFlightsClimbed': 'stairs',
-            'HKQuantityTypeIdentifierStepCount': 'steps',
-            'HKQuantityTypeIdentifierDistanceWalkingRunning': 'distance'
-        }
-        import pytz
-        def make_datetime(datetime_string):
-            format = '%Y-%m-%d %H:%M:%S %z'
-            d = datetime.datetime.strptime(datetime_string, format)
-            return d
-        # tz = pytz.timezone('US/Pacific')
-        # latestDate = datetime.datetime.strptime(latest, '%Y-%m-%d %H:%M:%S.000000').replace(tzinfo=tz) if latest else None
-        total_records = len(root)
-        self._data_panel.set_xml_total_records(total_records)
-        n = 0
-        for elem in root:
-            n += 1
-            if elem.tag == 'Record':
-                self._data_panel.set_xml_load_progress(n)
-                if n % 1000 == 0:
-                    self._main_loop()
-                creationDate = make_datetime(elem.attrib['creationDate'])
-                if latest and creationDate < latest:
-                    continue
-                record = HealthData(
-                    type = elem.attrib['type'],
-                    sourceName = elem.attrib['sourceName'],
-                    sourceVersion = elem.attrib['sourceVersion'] if 'sourceVersion' in elem.attrib else '',
-                    device = str(elem.attrib['device']) if 'device' in elem.attrib else '',
-                    unit = elem.attrib['unit'] if 'unit' in elem.attrib else '',
-                    creationDate = make_datetime(elem.attrib['creationDate']),
-                    startDate = make_datetime(elem.attrib['startDate']),
-                    endDate = make_datetime(elem.attrib['endDate']),
-                    value = elem.attrib['value']
-                )
-                records.append(record)
-        self._data_panel.set_xml_load_progress(total_records)
-
-        total_records = len(records)
-
-        def db_save_progress_callback(n):
-            print(f' - progress: {n}')
-            self._data_panel.set_database_save_progress(n)
-            self._main_loop()
-
-        self._data_panel.set_database_total_records(total_records)
-        self._main_loop()
-        self._database.insert_records(records, callback=db_save_progress_callback)
+        self._import_reading = False
+        self._data_panel.set_import_status_text(f'Importing {file_path}')
+        self._data_panel.set_import_running(True)
+        self._report_button.disable()
+        # loading into an empty database: build the indexes once at the end
+        rebuild_indexes = self._database.latest_record() is None
+        self._import_thread = ImportThread(self._database, file_path, rebuild_indexes=rebuild_indexes)
+        self._import_thread.start()
+
+    def import_finished(self, event):
+        self._import_thread.join()
+        self._import_thread = None
+        if self._import_reading:
+            self._data_panel.finish_reading_data()
+        self._import_reading = False
+        self._data_panel.set_import_running(False)
+        self._report_button.enable()
+        if event.status == IMPORT_SUCCEEDED:
+            skipped = f', {event.message}' if event.message else ''
+            self._data_panel.set_import_status_text(f'Imported {event.records_new} new records{skipped}')
+        elif event.status == IMPORT_CANCELLED:
+            self._data_panel.set_import_status_text(
+                f'Import cancelled after {event.records_new} new records')
+        else:
+            self._data_panel.set_import_status_text('Import failed')
+            UIMessageWindow(
+                pygame.Rect(10, 10, 600, 300),
+                f'{event.message}'.replace('\n', '<br>'),
+                self.ui_manager,
+                window_title='Failed to Import Data Source'
+            )
         self.count_records()
-        return records
-
@@ -0,0 +1,85 @@
+'''
+Columnar report results: one NumPy array per column instead of a dict per row.
+
+Dates are float64 epoch seconds (what the graph scalers work in), numbers float64 with NaN for
+NULL and strings object arrays. The arrays are filled straight from the DBAPI cursor a block of
+rows at a time; no datetime or dict is made for a row.
+'''
+import numpy
+
+FETCH_BLOCK_SIZE = 10000 # rows converted per numpy call
+
+DATE_COLUMN = 'date'
+FLOAT_COLUMN = 'float'
+TEXT_COLUMN = 'text'
+
+_DTYPES = {
+    DATE_COLUMN: numpy.float64,
+    FLOAT_COLUMN: numpy.float64,
+    TEXT_COLUMN: object,
+}
+
+
+class ReportColumns:
+    '''
+    Result of a report as parallel arrays, looked up by the same names as the keys of the row dicts
+    the get_*_report methods return otherwise. DataSeries and DataDateRange take it in place of rows.
+    '''
+    def __init__(self, columns):
+        '''
+        :param columns: {name: numpy array}, all of the same length
+        '''
+        self.columns = columns
+        self._length = len(next(iter(columns.values()))) if columns else 0
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    @property
+    def names(self):
+        return list(self.columns)
+
+    @property
+    def nbytes(self):
+        # memory held by the arrays, not counting the strings an object column points to
+        return sum(a.nbytes for a in self.columns.values())
+
+
+def _convert_block(rows, layout):
+    # one numpy call for the whole block, then a contiguous copy per column
+    if all(kind != TEXT_COLUMN for _, kind in layout):
+        block = numpy.array(rows, dtype=numpy.float64)
+    else:
+        block = numpy.array(rows, dtype=object)
+    block = block.reshape(len(rows), len(layout))
+    return [block[:, i].astype(_DTYPES[kind]) for i, (_, kind) in enumerate(layout)]
+
+
+def fetch_columns(cursor, layout, block_size=FETCH_BLOCK_SIZE):
+    '''
+    Read the rows of an executed DBAPI cursor into a ReportColumns.
+    :param cursor: cursor with a result, its columns in the order of layout; None for an empty result
+    :param layout: list of (name, kind) with kind one of DATE_COLUMN, FLOAT_COLUMN or TEXT_COLUMN
+    :param block_size: rows fetched per fetchmany call
+    '''
+    blocks = []
+    while cursor is not None:
+        rows = cursor.fetchmany(block_size)
+        if not rows:
+            break
+        blocks.append(_convert_block(rows, layout))
+    columns = {}
+    for i, (name, kind) in enumerate(layout):
+        if not blocks:
+            columns[name] = numpy.empty(0, dtype=_DTYPES[kind])
+        elif len(blocks) == 1:
+            columns[name] = blocks[0][i]
+        else:
+            columns[name] = numpy.concatenate([block[i] for block in blocks])
+    return ReportColumns(columns)
@@ -8,6 +8,10 @@ LOAD_DATABASE = custom_type()
 LOAD_DATA_SOURCE = custom_type()
 SELECT_DATABASE = custom_type()
 SELECT_SOURCE_FILE = custom_type()
+CANCEL_IMPORT = custom_type()
+# posted by the import thread
+IMPORT_PROGRESS = custom_type()
+IMPORT_FINISHED = custom_type()
 
 class DataPanel(UIPanel):
     PROGRESS_LABEL_WIDTH = 175
@@ -117,7 +121,7 @@ class DataPanel(UIPanel):
         )
         y += self._button_height
         x = 0
-        w = self.get_relative_rect().width
+        w = self.get_relative_rect().width - self._button_width
         self._xml_read_progress_text = UILabel(
             pygame.Rect(x, y, w, h),
             '',
@@ -128,6 +132,19 @@ class DataPanel(UIPanel):
             object_id=ObjectID(class_id='@vert-centered',
                                object_id='#data-label')
         )
+        x = -self._button_width
+        w = self._button_width
+        self._cancel_import_button = UIButton(
+            pygame.Rect(x, y, w, h),
+            'Cancel',
+            self.ui_manager,
+            container=self,
+            anchors={
+                'top': 'top', 'left': 'right',
+                'bottom': 'top', 'right': 'right'
+            },
+            visible=0
+        )
 
         y += self._button_height
         x = 0
@@ -186,12 +203,13 @@ class DataPanel(UIPanel):
         self.data_source_path = '/Users/mark/Downloads/export.zip' # /export.zip'
 
     def start_reading_data(self):
+        # the export is parsed as it is read, so the first progress of an import starts both
         self._xml_read_progress_text.show()
-        self.xml_record_load_label.set_text('Loading Data')
+        self.xml_record_load_label.set_text('Parsing Records:')
         self.set_xml_total_records(0)
 
     def finish_reading_data(self):
-        self.xml_record_load_label.set_text('Parsing Records:')
+        self.xml_record_load_label.set_text('Records Parsed:')
 
     def set_xml_total_records(self, t):
         self.xml_record_load_progress.maximum_progress = t
@@ -221,6 +239,33 @@ class DataPanel(UIPanel):
         self.xml_record_save_progress.percent_full = pct
         self.xml_record_save_progress.update(0)
 
+    def set_import_running(self, running):
+        '''
+        Lock the database and source controls while an import runs and offer to cancel it.
+        '''
+        for button in (self._open_db_button, self._select_db_button,
+                       self._load_data_button, self._select_data_button):
+            if running:
+                button.disable()
+            else:
+                button.enable()
+        if running:
+            self._cancel_import_button.enable()
+            self._cancel_import_button.show()
+        else:
+            self._cancel_import_button.hide()
+
+    def set_import_progress(self, bytes_read, bytes_total, records_read, records_saved):
+        if self.xml_record_load_progress.maximum_progress != bytes_total:
+            self.set_xml_total_records(bytes_total)
+        self.set_xml_load_progress(bytes_read)
+        self.set_database_total_records(records_read)
+        self.set_database_save_progress(records_saved)
+
+    def set_import_status_text(self, text):
+        self._xml_read_progress_text.show()
+        self._xml_read_progress_text.set_text(text)
+
     @property
     def database_path(self):
         return self._db_path_item.get_text()
@@ -273,4 +318,8 @@ class DataPanel(UIPanel):
                 event_data = { 'file_path': self.data_source_path }
                 pygame.event.post(pygame.event.Event(LOAD_DATA_SOURCE, event_data))
                 return True
+            elif event.ui_element == self._cancel_import_button:
+                self._cancel_import_button.disable() # until the import thread notices
+                pygame.event.post(pygame.event.Event(CANCEL_IMPORT, {}))
+                return True
         return False
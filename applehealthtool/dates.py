@@ -0,0 +1,133 @@
+'''
+Date parsing for Apple Health exports.
+
+Every Record carries three dates like '2022-08-09 10:39:37 -0700' and they are parsed millions of
+times per import, so rather than datetime.strptime this slices the fixed format by hand, caches the
+handful of timezone suffixes an export uses and memoises whole strings (startDate == endDate, and
+often == creationDate, so most strings repeat immediately).
+'''
+import datetime
+
+APPLE_DATE_FORMAT = '%Y-%m-%d %H:%M:%S %z'
+APPLE_DATE_LENGTH = len('2022-08-09 10:39:37 -0700')
+LOCAL_DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f')
+
+EPOCH_CACHE_SIZE = 4096 # strings memoised before the cache is emptied
+
+_offset_seconds = {} # '-0700' -> -25200
+_timezones = {} # '-0700' -> datetime.timezone
+_epochs = {} # full date string -> epoch seconds
+
+
+def _days_from_civil(y, m, d):
+    # days since 1970-01-01 of a proleptic Gregorian date (H. Hinnant's algorithm)
+    if m <= 2:
+        y -= 1
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (m + 9 if m <= 2 else m - 3) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def _is_apple_date(s):
+    return len(s) == APPLE_DATE_LENGTH and s[4] == '-' and s[7] == '-' and s[10] == ' ' \
+        and s[13] == ':' and s[16] == ':' and s[19] == ' ' and s[20] in '+-'
+
+
+def parse_offset(suffix):
+    '''
+    :param suffix: timezone suffix of an Apple date, e.g. '-0700'
+    :return: offset from UTC in seconds
+    '''
+    seconds = _offset_seconds.get(suffix)
+    if seconds is None:
+        seconds = int(suffix[1:3]) * 3600 + int(suffix[3:5]) * 60
+        if suffix[0] == '-':
+            seconds = -seconds
+        _offset_seconds[suffix] = seconds
+    return seconds
+
+
+def parse_epoch(date_string):
+    '''
+    Convert an Apple Health date string straight to integer seconds since the epoch.
+    :param date_string: e.g. '2022-08-09 10:39:37 -0700'
+    '''
+    epoch = _epochs.get(date_string)
+    if epoch is not None:
+        return epoch
+    s = date_string
+    if not _is_apple_date(s):
+        # not the usual layout, let strptime parse it or raise ValueError
+        return int(datetime.datetime.strptime(s, APPLE_DATE_FORMAT).timestamp())
+    days = _days_from_civil(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+    epoch = days * 86400 + int(s[11:13]) * 3600 + int(s[14:16]) * 60 + int(s[17:19]) - parse_offset(s[20:])
+    if len(_epochs) >= EPOCH_CACHE_SIZE:
+        _epochs.clear()
+    _epochs[date_string] = epoch
+    return epoch
+
+
+def parse_utc_epoch(date_string):
+    '''
+    Convert an ISO 8601 UTC time as written in GPX route files to epoch seconds.
+    :param date_string: e.g. '2022-08-09T17:39:37Z', fractional seconds are dropped
+    '''
+    s = date_string
+    if len(s) < 20 or s[-1] != 'Z' or s[10] != 'T':
+        return int(datetime.datetime.fromisoformat(s.replace('Z', '+00:00')).timestamp())
+    days = _days_from_civil(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+    return days * 86400 + int(s[11:13]) * 3600 + int(s[14:16]) * 60 + int(s[17:19])
+
+
+def parse_datetime(date_string):
+    '''
+    Convert an Apple Health date string to an aware datetime in its own timezone.
+    :param date_string: e.g. '2022-08-09 10:39:37 -0700'
+    '''
+    s = date_string
+    if not _is_apple_date(s):
+        return datetime.datetime.strptime(s, APPLE_DATE_FORMAT)
+    suffix = s[20:]
+    tz = _timezones.get(suffix)
+    if tz is None:
+        tz = datetime.timezone(datetime.timedelta(seconds=parse_offset(suffix)))
+        _timezones[suffix] = tz
+    return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                             int(s[11:13]), int(s[14:16]), int(s[17:19]), tzinfo=tz)
+
+
+def parse_local_date(date_string):
+    '''
+    Parse a user supplied 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS[.ffffff]' string as naive local time.
+    '''
+    for format in LOCAL_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(date_string, format)
+        except ValueError:
+            pass
+    raise ValueError(f'Unrecognized date: {date_string}')
+
+
+def to_epoch(value):
+    '''
+    Convert a date to integer seconds since the epoch. Naive datetimes and strings are local time.
+    :param value: datetime, Apple Health date string, string accepted by parse_local_date, or a number
+    '''
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        if _is_apple_date(value):
+            return parse_epoch(value)
+        value = parse_local_date(value)
+    return int(value.timestamp())
+
+
+def from_epoch(seconds):
+    '''
+    Naive local datetime for epoch seconds, the form returned by the report methods.
+    '''
+    return datetime.datetime.fromtimestamp(seconds)
@@ -0,0 +1,139 @@
+'''
+Fonts and rendered text shared by every graph.
+
+pygame.font.SysFont scans the system fonts each time it is called, so fonts are resolved once per
+(name, size) by a FontRegistry, the bundled FiraMono files in data/fonts before any system font.
+Rendered strings are kept in a TextCache, so a label drawn again with the same font and colour, like
+an axis tick label on every pan, is a dictionary lookup instead of a render.
+'''
+import collections
+
+import pygame
+
+from applehealthtool import get_fonts_file_path
+
+# normalized name -> file in data/fonts
+BUNDLED_FONTS = {
+    'firamono': 'FiraMono-Regular.ttf',
+    'firamonoregular': 'FiraMono-Regular.ttf',
+    'firamonomedium': 'FiraMono-Medium.ttf',
+    'firamonobold': 'FiraMono-Bold.ttf',
+}
+DEFAULT_FONT = 'firamono' # used for an empty font name
+DEFAULT_TEXT_CACHE_ENTRIES = 1024
+
+
+def normalize_font_name(name):
+    # 'FiraMono-Bold', 'fira mono bold' and 'firamonobold' are the same font
+    name = (name or DEFAULT_FONT).lower()
+    return name.replace(' ', '').replace('-', '').replace('_', '')
+
+
+class FontRegistry:
+    '''
+    pygame.font.Font objects by (name, size), each loaded the first time it is asked for.
+    '''
+    def __init__(self):
+        self._fonts = {}
+        self.loaded = 0
+
+    def get(self, name, size):
+        '''
+        :param name: a bundled font, e.g. 'FiraMono' or 'FiraMono-Bold', or a system font name for SysFont;
+                     empty for DEFAULT_FONT
+        :param size: point size
+        :return: pygame.font.Font
+        '''
+        key = (normalize_font_name(name), size)
+        font = self._fonts.get(key)
+        if font is None:
+            font = self._load(*key)
+            self._fonts[key] = font
+        return font
+
+    def _load(self, name, size):
+        if not pygame.font.get_init():
+            pygame.font.init()
+        self.loaded += 1
+        path = get_fonts_file_path(BUNDLED_FONTS[name]) if name in BUNDLED_FONTS else None
+        if path:
+            return pygame.font.Font(path, size)
+        # SysFont falls back to the pygame default font if there is no such system font
+        return pygame.font.SysFont(name, size)
+
+
+def premultiply(surface):
+    '''
+    Multiply the colours of a surface with per pixel alpha by its alpha, in place.
+    Surface.premul_alpha is not used, it garbles font surfaces with some pygame builds.
+    '''
+    # the alpha of every pixel as its colour, then multiplied into the original colours
+    alpha = surface.copy()
+    alpha.fill(pygame.Color(255, 255, 255, 0), special_flags=pygame.BLEND_RGB_MAX)
+    weights = pygame.Surface(surface.get_size(), flags=pygame.SRCALPHA, depth=32)
+    weights.fill(pygame.Color(0, 0, 0, 1))
+    weights.blit(alpha, (0, 0))
+    surface.blit(weights, (0, 0), special_flags=pygame.BLEND_RGB_MULT)
+    return surface
+
+
+class TextCache:
+    '''
+    LRU of rendered text surfaces keyed on (text, font, size, colour). The surfaces are shared:
+    blit them, do not draw on them.
+    '''
+    def __init__(self, registry, max_entries=DEFAULT_TEXT_CACHE_ENTRIES):
+        self.registry = registry
+        self.max_entries = max_entries
+        self._surfaces = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self._surfaces.clear()
+
+    def __len__(self):
+        return len(self._surfaces)
+
+    def render(self, text, font_name, size, color, antialias=True, premultiplied=False, background=None):
+        '''
+        :param premultiplied: multiply the colours by the alpha, for blits with BLEND_PREMULTIPLIED
+        :param background: opaque colour to render the text onto, e.g. to blit onto a surface without alpha
+        :return: pygame.Surface with per pixel alpha, or without alpha if there is a background
+        '''
+        color = pygame.Color(color)
+        background = tuple(pygame.Color(background)) if background is not None else None
+        key = (text, normalize_font_name(font_name), size, tuple(color), antialias, premultiplied, background)
+        surface = self._surfaces.get(key)
+        if surface is not None:
+            self._surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+        self.misses += 1
+        surface = self.registry.get(font_name, size).render(text, antialias, color, background)
+        if background is None and surface.get_flags() & pygame.SRCALPHA == 0:
+            # text without antialiasing renders to a colour keyed 8 bit surface
+            with_alpha = pygame.Surface(surface.get_size(), flags=pygame.SRCALPHA)
+            with_alpha.blit(surface, (0, 0))
+            surface = with_alpha
+        if premultiplied and background is None:
+            surface = premultiply(surface)
+        self._surfaces[key] = surface
+        while len(self._surfaces) > self.max_entries:
+            self._surfaces.popitem(last=False)
+        return surface
+
+
+font_registry = FontRegistry()
+text_cache = TextCache(font_registry)
+
+
+def get_font(name, size):
+    return font_registry.get(name, size)
+
+
+def render_text(text, font_name, size, color, antialias=True, premultiplied=False, background=None):
+    '''
+    Render text through the shared TextCache, see TextCache.render.
+    '''
+    return text_cache.render(text, font_name, size, color, antialias, premultiplied, background)
@@ -1,4 +1,9 @@
+import collections
+import contextlib
+import hashlib
+import itertools
 import os
+import threading
 from datetime import datetime
 from datetime import timezone
 import sqlalchemy
@@ -6,8 +11,14 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Query
 from sqlalchemy.orm import aliased
 from sqlalchemy.sql import text
-from sqlalchemy import func, select
+from sqlalchemy import event, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import sqlalchemy.types as types
+import numpy
+
+from applehealthtool.activity import unpack_array, COORDINATE_SCALE, COORDINATE_TYPECODE, FLOAT_TYPECODE, OFFSET_TYPECODE
+from applehealthtool.columns import ReportColumns, fetch_columns, DATE_COLUMN, FLOAT_COLUMN, TEXT_COLUMN
+from applehealthtool.dates import to_epoch, from_epoch, parse_local_date
 
 
 class TZDateTime(types.TypeDecorator):
@@ -30,10 +41,15 @@ class TZDateTime(types.TypeDecorator):
         return value
 
 Base = declarative_base()
+LegacyBase = declarative_base() # v1 schema, only kept around for migrate_legacy_data
 
-TABLE_NAME = 'health_data'
-class HealthData(Base):
-    __tablename__ = TABLE_NAME
+SCHEMA_VERSION = 2 # stored in PRAGMA user_version
+
+LEGACY_TABLE_NAME = 'health_data'
+MIGRATED_LEGACY_TABLE_NAME = 'health_data_v1'
+class HealthData(LegacyBase):
+    ### v1 schema: one row per record with every string repeated and dates stored as text
+    __tablename__ = LEGACY_TABLE_NAME
     id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
     type = sqlalchemy.Column('type', sqlalchemy.String)
     sourceName = sqlalchemy.Column('sourceName', sqlalchemy.String)
@@ -45,24 +61,752 @@ class HealthData(Base):
     endDate = sqlalchemy.Column('endDate', TZDateTime)
     value = sqlalchemy.Column('value', sqlalchemy.String)
 
+class LookupMixin:
+    # dictionary encoding of a repeated string
+    id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
+    name = sqlalchemy.Column('name', sqlalchemy.String, nullable=False, unique=True)
+
+class RecordType(LookupMixin, Base):
+    __tablename__ = 'record_type'
+
+class Source(LookupMixin, Base):
+    __tablename__ = 'source'
+
+class SourceVersion(LookupMixin, Base):
+    __tablename__ = 'source_version'
+
+class Device(LookupMixin, Base):
+    __tablename__ = 'device'
+
+class Unit(LookupMixin, Base):
+    __tablename__ = 'unit'
+
+class Category(LookupMixin, Base):
+    # non-numeric record values, e.g. HKCategoryValueSleepAnalysisAsleep
+    __tablename__ = 'category'
+
+TABLE_NAME = 'health_record'
+class HealthRecord(Base):
+    ### v2 schema:
+    # strings are ids into the lookup tables above
+    # dates are integer seconds since the epoch (UTC)
+    # value is REAL, or NULL with category_id set for non-numeric values
+    __tablename__ = TABLE_NAME
+    # reports filter on type (+ source) and a start/end date range, so these cover them without
+    # touching the table. They are dropped and rebuilt around large imports, see rebuild_indexes.
+    __table_args__ = (
+        sqlalchemy.Index('ix_health_record_type_start', 'type_id', 'start_date', 'end_date', 'value'),
+        sqlalchemy.Index('ix_health_record_type_source_start', 'type_id', 'source_id', 'start_date', 'end_date', 'value'),
+        sqlalchemy.Index('ix_health_record_creation', 'creation_date'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
+    type_id = sqlalchemy.Column('type_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('record_type.id'), nullable=False)
+    source_id = sqlalchemy.Column('source_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('source.id'), nullable=False)
+    source_version_id = sqlalchemy.Column('source_version_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('source_version.id'))
+    device_id = sqlalchemy.Column('device_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('device.id'))
+    unit_id = sqlalchemy.Column('unit_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('unit.id'))
+    creation_date = sqlalchemy.Column('creation_date', sqlalchemy.INTEGER)
+    start_date = sqlalchemy.Column('start_date', sqlalchemy.INTEGER)
+    end_date = sqlalchemy.Column('end_date', sqlalchemy.INTEGER)
+    value = sqlalchemy.Column('value', sqlalchemy.REAL)
+    category_id = sqlalchemy.Column('category_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('category.id'))
+
+# natural key of a record, re-imported records are skipped by INSERT OR IGNORE. value and category_id
+# are each NULL for half of the records and NULLs never collide in a unique index, hence the ifnull.
+sqlalchemy.Index('uq_health_record_natural_key',
+                 HealthRecord.type_id, HealthRecord.source_id, HealthRecord.start_date, HealthRecord.end_date,
+                 func.ifnull(HealthRecord.value, 0), func.ifnull(HealthRecord.category_id, 0),
+                 unique=True)
+
+class ImportWatermark(Base):
+    # newest creation date imported from each source
+    __tablename__ = 'import_watermark'
+    source_id = sqlalchemy.Column('source_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('source.id'), primary_key=True)
+    creation_date = sqlalchemy.Column('creation_date', sqlalchemy.INTEGER, nullable=False)
+
+class DatabaseSetting(Base):
+    __tablename__ = 'database_setting'
+    name = sqlalchemy.Column('name', sqlalchemy.String, primary_key=True)
+    value = sqlalchemy.Column('value', sqlalchemy.String)
+
+### Rollups: count, min, max and sum of the numeric records of each type and source per minute, hour
+# and day, so graphs of long date ranges need not read every sample. Buckets are aligned to UTC.
+ROLLUP_RAW = 0 # resolution meaning the records themselves, see pick_rollup_resolution
+ROLLUP_MINUTE = 60
+ROLLUP_HOUR = 60 * 60
+ROLLUP_DAY = 24 * 60 * 60
+ROLLUP_RESOLUTIONS = (ROLLUP_MINUTE, ROLLUP_HOUR, ROLLUP_DAY) # finest first, each a multiple of the last
+
+class RecordRollup(Base):
+    __tablename__ = 'record_rollup'
+    # stored in primary key order, so a range of buckets is read without a lookup per row
+    __table_args__ = {'sqlite_with_rowid': False}
+    resolution = sqlalchemy.Column('resolution', sqlalchemy.INTEGER, primary_key=True) # bucket width, seconds
+    type_id = sqlalchemy.Column('type_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('record_type.id'), primary_key=True)
+    bucket = sqlalchemy.Column('bucket', sqlalchemy.INTEGER, primary_key=True) # epoch seconds of the bucket start
+    source_id = sqlalchemy.Column('source_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('source.id'), primary_key=True)
+    count = sqlalchemy.Column('count', sqlalchemy.INTEGER, nullable=False)
+    minimum = sqlalchemy.Column('minimum', sqlalchemy.REAL)
+    maximum = sqlalchemy.Column('maximum', sqlalchemy.REAL)
+    total = sqlalchemy.Column('total', sqlalchemy.REAL)
+
+class RollupPending(Base):
+    # days whose rollups are out of date, marked in the transaction that writes their records
+    __tablename__ = 'rollup_pending'
+    __table_args__ = {'sqlite_with_rowid': False}
+    type_id = sqlalchemy.Column('type_id', sqlalchemy.INTEGER, primary_key=True)
+    source_id = sqlalchemy.Column('source_id', sqlalchemy.INTEGER, primary_key=True)
+    day = sqlalchemy.Column('day', sqlalchemy.INTEGER, primary_key=True) # epoch seconds of the UTC day start
+
+def _day_runs(days):
+    # sorted day starts -> (start, stop) of each run of consecutive days
+    runs = []
+    for day in days:
+        if runs and runs[-1][1] == day:
+            runs[-1][1] = day + ROLLUP_DAY
+        else:
+            runs.append([day, day + ROLLUP_DAY])
+    return [tuple(run) for run in runs]
+
+### Everything in an export besides Records, see applehealthtool.activity.
+# Children of records and workouts carry the key of the element they belong to, (type_id, source_id,
+# start_date), where the type of a workout is its activity type. The packed columns are blobs written
+# by activity.pack_array.
+
+class MetadataKey(LookupMixin, Base):
+    __tablename__ = 'metadata_key'
+
+class RecordMetadata(Base):
+    # MetadataEntry children of records and workouts
+    __tablename__ = 'record_metadata'
+    __table_args__ = (
+        sqlalchemy.UniqueConstraint('type_id', 'source_id', 'start_date', 'key_id', name='uq_record_metadata_owner_key'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
+    type_id = sqlalchemy.Column('type_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('record_type.id'), nullable=False)
+    source_id = sqlalchemy.Column('source_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('source.id'), nullable=False)
+    start_date = sqlalchemy.Column('start_date', sqlalchemy.INTEGER, nullable=False)
+    key_id = sqlalchemy.Column('key_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('metadata_key.id'), nullable=False)
+    value = sqlalchemy.Column('value', sqlalchemy.String)
+
+class HeartBeatSeries(Base):
+    # HeartRateVariabilityMetadataList of a heart rate variability record
+    __tablename__ = 'heart_beat_series'
+    __table_args__ = (
+        sqlalchemy.UniqueConstraint('type_id', 'source_id', 'start_date', name='uq_heart_beat_series_owner'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
+    type_id = sqlalchemy.Column('type_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('record_type.id'), nullable=False)
+    source_id = sqlalchemy.Column('source_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('source.id'), nullable=False)
+    start_date = sqlalchemy.Column('start_date', sqlalchemy.INTEGER, nullable=False)
+    beat_count = sqlalchemy.Column('beat_count', sqlalchemy.INTEGER)
+    bpm = sqlalchemy.Column('bpm', sqlalchemy.LargeBinary) # uint16
+    offsets = sqlalchemy.Column('offsets', sqlalchemy.LargeBinary) # int32 ms from start_date, -1 if unknown
+
+class Workout(Base):
+    __tablename__ = 'workout'
+    __table_args__ = (
+        sqlalchemy.UniqueConstraint('type_id', 'source_id', 'start_date', name='uq_workout_natural_key'),
+        sqlalchemy.Index('ix_workout_start', 'start_date'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
+    type_id = sqlalchemy.Column('type_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('record_type.id'), nullable=False)
+    source_id = sqlalchemy.Column('source_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('source.id'), nullable=False)
+    source_version_id = sqlalchemy.Column('source_version_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('source_version.id'))
+    device_id = sqlalchemy.Column('device_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('device.id'))
+    creation_date = sqlalchemy.Column('creation_date', sqlalchemy.INTEGER)
+    start_date = sqlalchemy.Column('start_date', sqlalchemy.INTEGER, nullable=False)
+    end_date = sqlalchemy.Column('end_date', sqlalchemy.INTEGER)
+    duration = sqlalchemy.Column('duration', sqlalchemy.REAL)
+    duration_unit_id = sqlalchemy.Column('duration_unit_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('unit.id'))
+    total_distance = sqlalchemy.Column('total_distance', sqlalchemy.REAL)
+    total_distance_unit_id = sqlalchemy.Column('total_distance_unit_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('unit.id'))
+    total_energy_burned = sqlalchemy.Column('total_energy_burned', sqlalchemy.REAL)
+    total_energy_burned_unit_id = sqlalchemy.Column('total_energy_burned_unit_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('unit.id'))
+    route_name = sqlalchemy.Column('route_name', sqlalchemy.String) # workout_route.name
+
+class ActivitySummary(Base):
+    # one row per day; the current day changes between exports, so a re-import replaces it
+    __tablename__ = 'activity_summary'
+    id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
+    date = sqlalchemy.Column('date', sqlalchemy.String, nullable=False, unique=True) # YYYY-MM-DD
+    active_energy_burned = sqlalchemy.Column('active_energy_burned', sqlalchemy.REAL)
+    active_energy_burned_goal = sqlalchemy.Column('active_energy_burned_goal', sqlalchemy.REAL)
+    active_energy_burned_unit_id = sqlalchemy.Column('active_energy_burned_unit_id', sqlalchemy.INTEGER, sqlalchemy.ForeignKey('unit.id'))
+    apple_move_time = sqlalchemy.Column('apple_move_time', sqlalchemy.REAL)
+    apple_move_time_goal = sqlalchemy.Column('apple_move_time_goal', sqlalchemy.REAL)
+    apple_exercise_time = sqlalchemy.Column('apple_exercise_time', sqlalchemy.REAL)
+    apple_exercise_time_goal = sqlalchemy.Column('apple_exercise_time_goal', sqlalchemy.REAL)
+    apple_stand_hours = sqlalchemy.Column('apple_stand_hours', sqlalchemy.REAL)
+    apple_stand_hours_goal = sqlalchemy.Column('apple_stand_hours_goal', sqlalchemy.REAL)
+
+class WorkoutRoute(Base):
+    # one GPX file from workout-routes/, one packed column per point attribute
+    __tablename__ = 'workout_route'
+    id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
+    name = sqlalchemy.Column('name', sqlalchemy.String, nullable=False, unique=True)
+    start_date = sqlalchemy.Column('start_date', sqlalchemy.INTEGER)
+    end_date = sqlalchemy.Column('end_date', sqlalchemy.INTEGER)
+    point_count = sqlalchemy.Column('point_count', sqlalchemy.INTEGER)
+    times = sqlalchemy.Column('times', sqlalchemy.LargeBinary) # int32 seconds from start_date
+    latitudes = sqlalchemy.Column('latitudes', sqlalchemy.LargeBinary) # int32 degrees * 1e7
+    longitudes = sqlalchemy.Column('longitudes', sqlalchemy.LargeBinary) # int32 degrees * 1e7
+    elevations = sqlalchemy.Column('elevations', sqlalchemy.LargeBinary) # float32 metres
+    speeds = sqlalchemy.Column('speeds', sqlalchemy.LargeBinary) # float32 m/s
+
+### Partitioned layout: the high volume types get their own tables, everything else stays in health_record.
+# Only created in databases that use LAYOUT_PARTITIONED.
+PartitionBase = declarative_base()
+
+LAYOUT_SINGLE = 'single'
+LAYOUT_PARTITIONED = 'partitioned'
+LAYOUTS = (LAYOUT_SINGLE, LAYOUT_PARTITIONED)
+
+class QuantitySampleMixin:
+    # health_record without the type and category columns
+    id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
+    source_id = sqlalchemy.Column('source_id', sqlalchemy.INTEGER, nullable=False)
+    source_version_id = sqlalchemy.Column('source_version_id', sqlalchemy.INTEGER)
+    device_id = sqlalchemy.Column('device_id', sqlalchemy.INTEGER)
+    unit_id = sqlalchemy.Column('unit_id', sqlalchemy.INTEGER)
+    creation_date = sqlalchemy.Column('creation_date', sqlalchemy.INTEGER)
+    start_date = sqlalchemy.Column('start_date', sqlalchemy.INTEGER)
+    end_date = sqlalchemy.Column('end_date', sqlalchemy.INTEGER)
+    value = sqlalchemy.Column('value', sqlalchemy.REAL)
+
+def _sample_indexes(table_name):
+    return (
+        sqlalchemy.Index(f'uq_{table_name}_natural_key', 'source_id', 'start_date', 'end_date', 'value', unique=True),
+        sqlalchemy.Index(f'ix_{table_name}_start', 'start_date', 'end_date', 'value'),
+        sqlalchemy.Index(f'ix_{table_name}_source_start', 'source_id', 'start_date', 'end_date', 'value'),
+        sqlalchemy.Index(f'ix_{table_name}_creation', 'creation_date'),
+    )
+
+class HeartRateSample(QuantitySampleMixin, PartitionBase):
+    __tablename__ = 'heart_rate_sample'
+    __table_args__ = _sample_indexes(__tablename__)
+
+class StepCountSample(QuantitySampleMixin, PartitionBase):
+    __tablename__ = 'step_count_sample'
+    __table_args__ = _sample_indexes(__tablename__)
+
+class ActiveEnergySample(QuantitySampleMixin, PartitionBase):
+    __tablename__ = 'active_energy_sample'
+    __table_args__ = _sample_indexes(__tablename__)
+
+class BloodPressure(PartitionBase):
+    # one row per reading: the systolic and diastolic records are merged on (source, start date)
+    __tablename__ = 'blood_pressure'
+    __table_args__ = (
+        sqlalchemy.UniqueConstraint('source_id', 'start_date', name='uq_blood_pressure_source_start'),
+        sqlalchemy.Index('ix_blood_pressure_start', 'start_date', 'systolic', 'diastolic'),
+        sqlalchemy.Index('ix_blood_pressure_creation', 'creation_date'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
+    source_id = sqlalchemy.Column('source_id', sqlalchemy.INTEGER, nullable=False)
+    device_id = sqlalchemy.Column('device_id', sqlalchemy.INTEGER)
+    unit_id = sqlalchemy.Column('unit_id', sqlalchemy.INTEGER)
+    creation_date = sqlalchemy.Column('creation_date', sqlalchemy.INTEGER)
+    start_date = sqlalchemy.Column('start_date', sqlalchemy.INTEGER)
+    end_date = sqlalchemy.Column('end_date', sqlalchemy.INTEGER)
+    systolic = sqlalchemy.Column('systolic', sqlalchemy.REAL)
+    diastolic = sqlalchemy.Column('diastolic', sqlalchemy.REAL)
+
+HEART_RATE_TYPE = 'HKQuantityTypeIdentifierHeartRate'
+SYSTOLIC_TYPE = 'HKQuantityTypeIdentifierBloodPressureSystolic'
+DIASTOLIC_TYPE = 'HKQuantityTypeIdentifierBloodPressureDiastolic'
+SLEEP_TYPE = 'HKCategoryTypeIdentifierSleepAnalysis'
+
+# column order of the plain tuples accepted by AppleHealthDatabase.insert_rows
+HEALTH_DATA_COLUMNS = ('type', 'sourceName', 'sourceVersion', 'device', 'unit',
+                       'creationDate', 'startDate', 'endDate', 'value')
+
+class LookupCache:
+    '''
+    In-memory name -> id map of one lookup table. Missing names are inserted on demand.
+    Shared by the import thread and the readers of other threads (e.g. a TileLoader), so the map is
+    only touched with the lock held.
+    '''
+    def __init__(self, table):
+        self.table = table
+        self.ids = None
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.ids = None
+
+    def _load(self, connection):
+        return {row[1]: row[0] for row in connection.execute(select(self.table.c.id, self.table.c.name))}
+
+    def get_id(self, connection, name):
+        if name is None or name == '':
+            return None
+        with self._lock:
+            if self.ids is None:
+                self.ids = self._load(connection)
+            id = self.ids.get(name)
+            if id is None:
+                result = connection.execute(self.table.insert().values(name=name))
+                id = result.inserted_primary_key[0]
+                self.ids[name] = id
+            return id
+
+    def find_id(self, connection, name):
+        '''
+        Like get_id but never inserts: None if name is not in the table. Reloads once on a miss in case
+        another connection (e.g. an import writer process) added it.
+        '''
+        with self._lock:
+            if self.ids is not None and name in self.ids:
+                return self.ids[name]
+            # merged rather than replaced: ids the import has inserted but not committed yet are not
+            # visible on this connection and must not be forgotten
+            ids = self._load(connection)
+            if self.ids is not None:
+                ids.update(self.ids)
+            self.ids = ids
+            return self.ids.get(name)
+
+class RecordPartition:
+    '''
+    Where records of one type are written: a table, the insert statement used for a batch and the
+    conversion from an encoded health_record row to a row of that table.
+    '''
+    def __init__(self, table):
+        self.table = table
+        self.statement = table.insert().prefix_with('OR IGNORE')
+        self.value_column = 'value' # column holding the numeric value of a record
+
+    def convert(self, encoded):
+        return encoded
+
+    def type_condition(self, alias='', param='type_id'):
+        '''
+        SQL condition selecting one type within this table, the type id bound to :param.
+        :param alias: table alias prefix, e.g. 'r.'
+        '''
+        return f'{alias}type_id = :{param}'
+
+class SamplePartition(RecordPartition):
+    # a table holding a single type, so no type or category columns
+    def convert(self, encoded):
+        row = dict(encoded)
+        del row['type_id']
+        del row['category_id']
+        return row
+
+    def type_condition(self, alias='', param='type_id'):
+        return '1 = 1'
+
+class BloodPressurePartition(RecordPartition):
+    '''
+    Writes one half of a blood pressure reading, merging with the other half if it is already stored.
+    '''
+    def __init__(self, table, column):
+        super(BloodPressurePartition, self).__init__(table)
+        self.column = column
+        self.value_column = column
+        statement = sqlite_insert(table)
+        self.statement = statement.on_conflict_do_update(
+            index_elements=['source_id', 'start_date'],
+            set_={column: statement.excluded[column]},
+            where=table.c[column].is_(None) # re-imported halves are left alone
+        )
+
+    def convert(self, encoded):
+        return {
+            'source_id': encoded['source_id'],
+            'device_id': encoded['device_id'],
+            'unit_id': encoded['unit_id'],
+            'creation_date': encoded['creation_date'],
+            'start_date': encoded['start_date'],
+            'end_date': encoded['end_date'],
+            'systolic': encoded['value'] if self.column == 'systolic' else None,
+            'diastolic': encoded['value'] if self.column == 'diastolic' else None,
+        }
+
+    def type_condition(self, alias='', param='type_id'):
+        return f'{alias}{self.column} IS NOT NULL'
+
+class PartitionRouter:
+    '''
+    Maps record types to the RecordPartition they are stored in for a storage layout.
+    '''
+    def __init__(self, layout=LAYOUT_SINGLE):
+        if layout is not None and layout not in LAYOUTS:
+            raise ValueError(f'Unknown storage layout: {layout}')
+        self.layout = layout
+        self.default = RecordPartition(HealthRecord.__table__)
+        self.partitions = {}
+        if layout == LAYOUT_PARTITIONED:
+            self.partitions = {
+                HEART_RATE_TYPE: SamplePartition(HeartRateSample.__table__),
+                'HKQuantityTypeIdentifierStepCount': SamplePartition(StepCountSample.__table__),
+                'HKQuantityTypeIdentifierActiveEnergyBurned': SamplePartition(ActiveEnergySample.__table__),
+                SYSTOLIC_TYPE: BloodPressurePartition(BloodPressure.__table__, 'systolic'),
+                DIASTOLIC_TYPE: BloodPressurePartition(BloodPressure.__table__, 'diastolic'),
+            }
+
+    def partition_for(self, type_name):
+        return self.partitions.get(type_name, self.default)
+
+    def table_name(self, type_name):
+        return self.partition_for(type_name).table.name
+
+    def type_condition(self, type_name, alias='', param='type_id'):
+        return self.partition_for(type_name).type_condition(alias, param)
+
+    @property
+    def tables(self):
+        '''
+        Every table records may be stored in, health_record first.
+        '''
+        tables = [self.default.table]
+        for partition in self.partitions.values():
+            if partition.table not in tables:
+                tables.append(partition.table)
+        return tables
+
+REPORT_SLEEP = 'sleep'
+REPORT_HEART_RATE = 'heart_rate'
+REPORT_BLOOD_PRESSURE = 'blood_pressure'
+REPORTS = (REPORT_SLEEP, REPORT_HEART_RATE, REPORT_BLOOD_PRESSURE)
+# names and kinds of the result columns of each report, for columnar results
+REPORT_COLUMNS = {
+    REPORT_SLEEP: [('source', TEXT_COLUMN), ('creationDate', DATE_COLUMN), ('startDate', DATE_COLUMN),
+                   ('endDate', DATE_COLUMN), ('value', TEXT_COLUMN)],
+    REPORT_HEART_RATE: [('startDate', DATE_COLUMN), ('heartrate', FLOAT_COLUMN)],
+    REPORT_BLOOD_PRESSURE: [('startDate', DATE_COLUMN), ('systolic', FLOAT_COLUMN), ('diastolic', FLOAT_COLUMN)],
+}
+# result columns of get_rollup_report, startDate is the start of the bucket
+ROLLUP_COLUMNS = [('startDate', DATE_COLUMN), ('count', FLOAT_COLUMN), ('min', FLOAT_COLUMN),
+                  ('max', FLOAT_COLUMN), ('mean', FLOAT_COLUMN)]
+
+class ReportQuery:
+    '''
+    A report statement built once per storage layout. Dates, source and type ids are bound parameters
+    so the SQL text never changes between calls: SQLAlchemy reuses its compiled form and sqlite its
+    prepared statement, and the range conditions stay on the indexed integer date columns.
+    '''
+    def __init__(self, sql, type_params=None):
+        '''
+        :param sql: statement with :start, :end, optional :source_id and the type parameters
+        :param type_params: {parameter name: record type name} bound to the type id at run time
+        '''
+        self.sql = sql
+        self.statement = text(sql)
+        self.type_params = type_params or {}
+
+INTERACTIVE_PROFILE = 'interactive'
+BULK_IMPORT_PROFILE = 'bulk_import'
+
+# PRAGMAs applied to every new sqlite connection, by profile name
+CONNECTION_PROFILES = {
+    # sqlite defaults with full durability, for reporting and small writes
+    INTERACTIVE_PROFILE: {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'cache_size': -2000, # KiB
+        'temp_store': 'DEFAULT',
+        'mmap_size': 0,
+    },
+    # used for the duration of an import: no fsync per commit, big cache, temp data in memory
+    BULK_IMPORT_PROFILE: {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -262144, # KiB
+        'temp_store': 'MEMORY',
+        'mmap_size': 268435456,
+    },
+}
+
+GENERATION_SETTING = 'generation' # database_setting bumped by every write that can change a report
+DEFAULT_REPORT_CACHE_ENTRIES = 32
+REPORT_CACHE_SUFFIX = '.reports' # directory next to the database holding persisted report results
+
+class ReportCache:
+    '''
+    LRU of report results keyed on (report, parameters). Each result is stored with the database generation
+    it was read at and only returned for that generation, so any import invalidates everything before it.
+
+    Columnar results can also be kept on disk, one .npz file per key, so they survive a restart. Row dict
+    results are only held in memory. Shared by the GUI and the TileLoader thread of a LazyDataSeries.
+    '''
+    def __init__(self, max_entries=DEFAULT_REPORT_CACHE_ENTRIES, directory=None):
+        '''
+        :param max_entries: results held in memory, and four times as many files on disk
+        :param directory: where columnar results are persisted, None to keep them in memory only
+        '''
+        self.max_entries = max_entries
+        self.directory = directory
+        self._entries = collections.OrderedDict() # key -> (generation, result)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+
+    def get(self, key, generation):
+        '''
+        :return: the result stored for key at generation, or None
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            result = self._load(key, generation) if self.directory else None
+            if result is None:
+                self.misses += 1
+                return None
+            self._remember(key, generation, result)
+            self.hits += 1
+            return result
+
+    def put(self, key, generation, result):
+        if isinstance(result, ReportColumns):
+            # shared by every caller from now on
+            for column in result.columns.values():
+                column.flags.writeable = False
+        with self._lock:
+            if self.directory and isinstance(result, ReportColumns):
+                self._save(key, generation, result)
+            self._remember(key, generation, result)
+
+    def _remember(self, key, generation, result):
+        self._entries[key] = (generation, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _save(self, key, generation, result):
+        arrays = {'generation': numpy.array(generation), 'names': numpy.array(result.names),
+                  'text': numpy.array([column.dtype == object for column in result.columns.values()])}
+        for n, column in enumerate(result.columns.values()):
+            # strings as a unicode array so loading needs no pickle
+            arrays[f'column{n}'] = column.astype(str) if column.dtype == object else column
+        path = self._path(key)
+        with open(path + '.tmp', 'wb') as f:
+            numpy.savez(f, **arrays)
+        os.replace(path + '.tmp', path)
+        self._prune()
+
+    def _load(self, key, generation):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with numpy.load(path, allow_pickle=False) as stored:
+                if int(stored['generation']) != generation:
+                    stale = True
+                else:
+                    stale = False
+                    columns = {}
+                    for n, (name, is_text) in enumerate(zip(stored['names'], stored['text'])):
+                        column = stored[f'column{n}']
+                        columns[str(name)] = column.astype(object) if is_text else column
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Ignoring cached report {path}: {e}')
+            stale = True
+        if stale:
+            os.remove(path)
+            return None
+        result = ReportColumns(columns)
+        for column in result.columns.values():
+            column.flags.writeable = False
+        return result
+
+    def _prune(self):
+        # oldest files first, beyond four times the entries held in memory
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.npz')]
+        if len(paths) <= self.max_entries * 4:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_entries * 4]:
+            os.remove(path)
+
 class AppleHealthDatabase():
-    MAX_COMMIT = 10000 # maximum number of records in single commit
-    def __init__(self):
+    DEFAULT_BATCH_SIZE = 10000 # default number of records in a single commit
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, report_cache_entries=DEFAULT_REPORT_CACHE_ENTRIES,
+                 persist_reports=False):
+        '''
+        :param report_cache_entries: report results kept in memory, 0 to read every report from the database
+        :param persist_reports: also keep columnar report results on disk, next to the database
+        '''
         self.db_path = None
         self.db_engine = None
+        self.batch_size = batch_size
+        self.report_cache_entries = report_cache_entries
+        self.persist_reports = persist_reports
+        self.report_cache = None
+        self.profile = INTERACTIVE_PROFILE
+        self._lookups = {
+            'type': LookupCache(RecordType.__table__),
+            'source': LookupCache(Source.__table__),
+            'source_version': LookupCache(SourceVersion.__table__),
+            'device': LookupCache(Device.__table__),
+            'unit': LookupCache(Unit.__table__),
+            'category': LookupCache(Category.__table__),
+            'metadata_key': LookupCache(MetadataKey.__table__),
+        }
+        self.router = PartitionRouter(LAYOUT_SINGLE)
+        self._report_queries = {} # (report name, by source) -> ReportQuery
 
-    def open_database(self, path, echo=False):
+    def open_database(self, path, echo=False, profile=INTERACTIVE_PROFILE, layout=None):
+        '''
+        :param path: path of the sqlite database file, created if it does not exist
+        :param echo: echo SQL statements
+        :param profile: name of the CONNECTION_PROFILES entry applied to each connection
+        :param layout: storage layout (LAYOUT_SINGLE or LAYOUT_PARTITIONED) of a new database, None for
+                       LAYOUT_SINGLE; an existing database keeps the layout it was created with
+        '''
+        if profile not in CONNECTION_PROFILES:
+            raise ValueError(f'Unknown connection profile: {profile}')
+        if layout is not None and layout not in LAYOUTS:
+            raise ValueError(f'Unknown storage layout: {layout}')
         self.db_path = path
+        self.profile = profile
         print(f'Opening DB: {self.db_path}')
         uri = f'sqlite:///{self.db_path}'
         print(uri)
         self.db_engine = sqlalchemy.create_engine(uri, echo = echo)
+        event.listen(self.db_engine, 'connect', self._apply_profile)
         self.metadata = Base.metadata # sqlalchemy.MetaData(self.db_engine)
+        # databases from before watermarks get them computed from their records below
+        had_watermarks = sqlalchemy.inspect(self.db_engine).has_table(ImportWatermark.__tablename__)
+        had_rollups = sqlalchemy.inspect(self.db_engine).has_table(RecordRollup.__tablename__)
         Base.metadata.create_all(self.db_engine)
+        with self.db_engine.begin() as connection:
+            connection.execute(text(f'PRAGMA user_version = {SCHEMA_VERSION}'))
+        stored_layout = self.get_setting('layout')
+        if stored_layout is None:
+            stored_layout = layout or LAYOUT_SINGLE
+            self.set_setting('layout', stored_layout)
+        elif layout is not None and stored_layout != layout:
+            print(f'Database uses the {stored_layout} layout, ignoring {layout}')
+        self.router = PartitionRouter(stored_layout)
+        self._report_queries = {}
+        self.report_cache = None
+        if self.report_cache_entries:
+            directory = self.db_path + REPORT_CACHE_SUFFIX if self.persist_reports else None
+            self.report_cache = ReportCache(self.report_cache_entries, directory)
+        if self.router.layout == LAYOUT_PARTITIONED:
+            PartitionBase.metadata.create_all(self.db_engine)
+        self.create_indexes() # in case an interrupted import left them dropped
+        if not had_watermarks and self.latest_record() is not None:
+            self.rebuild_watermarks()
+        for lookup in self._lookups.values():
+            lookup.reset()
+        if not had_rollups and self.latest_record() is not None:
+            self.rebuild_rollups()
+        else:
+            self.update_rollups() # days left pending by an import that did not finish
         self.db_engine.connect()
         print('database open')
         return self.db_engine
 
+    def _apply_profile(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in CONNECTION_PROFILES[self.profile].items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.close()
+
+    def set_profile(self, profile):
+        '''
+        Switch to another connection profile. Pooled connections are discarded so the
+        next connection is opened with the new PRAGMAs.
+        '''
+        if profile not in CONNECTION_PROFILES:
+            raise ValueError(f'Unknown connection profile: {profile}')
+        self.profile = profile
+        if self.db_engine:
+            self.db_engine.dispose()
+
+    @contextlib.contextmanager
+    def connection_profile(self, profile):
+        '''
+        Use profile for the duration of a with block, then restore the previous one.
+        '''
+        previous = self.profile
+        self.set_profile(profile)
+        try:
+            yield self
+        finally:
+            self.set_profile(previous)
+
+    def get_setting(self, name, default=None):
+        with self.db_engine.connect() as connection:
+            value = connection.execute(
+                select(DatabaseSetting.value).where(DatabaseSetting.name == name)).scalar()
+        return default if value is None else value
+
+    def set_setting(self, name, value):
+        with self.db_engine.begin() as connection:
+            statement = sqlite_insert(DatabaseSetting.__table__).values(name=name, value=str(value))
+            connection.execute(statement.on_conflict_do_update(index_elements=['name'], set_={'value': str(value)}))
+
+    @property
+    def generation(self):
+        '''
+        Counter bumped in the same transaction as every write that can change a report, by this or any
+        other process, so cached report results can tell they are out of date.
+        '''
+        return int(self.get_setting(GENERATION_SETTING, 0))
+
+    def _bump_generation(self, connection):
+        statement = sqlite_insert(DatabaseSetting.__table__).values(name=GENERATION_SETTING, value='1')
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=['name'], set_={'value': sqlalchemy.cast(DatabaseSetting.__table__.c.value, sqlalchemy.INTEGER) + 1}))
+
+    def _existing_indexes(self, table):
+        # sqlalchemy cannot reflect the expression index on health_record, so ask sqlite directly
+        query = text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table")
+        with self.db_engine.connect() as connection:
+            return {row[0] for row in connection.execute(query, {'table': table.name})}
+
+    def drop_indexes(self):
+        '''
+        Drop the secondary indexes of the record tables so a large import does not maintain them row by row.
+        Unique indexes and constraints stay, they are what skips duplicates and merges blood pressure readings.
+        '''
+        for table in self.router.tables:
+            existing = self._existing_indexes(table)
+            for index in table.indexes:
+                if not index.unique and index.name in existing:
+                    index.drop(self.db_engine)
+
+    def create_indexes(self):
+        '''
+        Create any missing secondary indexes of the record tables. Duplicate records stored before a
+        unique index existed are removed first so it can be built.
+        '''
+        for table in self.router.tables:
+            existing = self._existing_indexes(table)
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                if index.unique:
+                    self._remove_duplicates(table, index)
+                index.create(self.db_engine)
+
+    def _remove_duplicates(self, table, index):
+        key = ', '.join(str(e.compile(self.db_engine, compile_kwargs={'literal_binds': True}))
+                        for e in index.expressions)
+        with self.db_engine.begin() as connection:
+            result = connection.execute(text(
+                f'DELETE FROM {table.name} WHERE id NOT IN (SELECT MIN(id) FROM {table.name} GROUP BY {key})'))
+            if result.rowcount:
+                print(f'Removed {result.rowcount} duplicate rows from {table.name}')
+
     def _open_session(self):
         if not self.db_engine:
             return None
@@ -70,137 +814,704 @@ class AppleHealthDatabase():
         return Session()
 
     def latest_record(self):
+        '''
+        :return: creation date of the newest record as an aware local datetime, or None
+        '''
         Session = sessionmaker(bind = self.db_engine)
         with Session() as session:
-            result = session.query(func.max(HealthData.creationDate)).all()
-            return result[0][0]
+            latest = None
+            for table in self.router.tables:
+                result = session.execute(select(func.max(table.c.creation_date))).scalar()
+                if result is not None and (latest is None or result > latest):
+                    latest = result
+            if latest is None:
+                return None
+            return datetime.fromtimestamp(latest, timezone.utc).astimezone()
 
     def count_rows(self):
         print('count_rows')
         Session = sessionmaker(bind = self.db_engine)
-        q = f'SELECT COUNT(*) FROM {TABLE_NAME};'
         with Session() as session:
-            n = session.execute(q)
-            row = n.fetchone()[0]
+            row = 0
+            for table in self.router.tables:
+                n = session.execute(text(f'SELECT COUNT(*) FROM {table.name};'))
+                row += n.fetchone()[0]
             print(f'n: {row}')
 
             return row
 
-    def get_sleep_report(self, startdate=None, enddate=None, sourcename=''):
-        if not startdate:
-            startdate = datetime.strptime('1970-01-01', "%Y-%m-%d")
-        if not enddate:
-            enddate = datetime.now()
-        if sourcename != '':
-            print(f' HR Source: {sourcename}')
-            sourcename = f' AND sourceName = "{sourcename}" '
-        query = f'''
-SELECT sourceName, creationDate, startDate, endDate, value 
-FROM health_data 
-WHERE type = "HKCategoryTypeIdentifierSleepAnalysis"
-    AND startDate >= "{startdate}" AND endDate <= "{enddate}" AND sourceName = "FitCloudPro"
-    ORDER BY startDate
-'''
-        queryxx = f'''
-SELECT sourceName, creationDate, startDate, endDate, value
-CASE
-    WHEN value = "HKCategoryValueSleepAnalysisInBed" THEN 0
-    WHEN value = "HKCategoryValueSleepAnalysisAsleep" THEN 1
-    WHEN value = "HKCategoryValueSleepAnalysisAwake" THEN 2
-END AS ord
-FROM health_data 
-WHERE type = "HKCategoryTypeIdentifierSleepAnalysis"
-    AND startDate >= "{startdate}" AND endDate <= "{enddate}"
-    ORDER BY startDate, ord
-'''
-        statement = text(query)
-        with self._open_session() as session:
-            n = session.execute(statement)
-            rows = []
-            for r in n:
-                cdate = datetime.strptime(r[1], '%Y-%m-%d %H:%M:%S.000000')
-                sdate = datetime.strptime(r[2], '%Y-%m-%d %H:%M:%S.000000')
-                edate = datetime.strptime(r[3], '%Y-%m-%d %H:%M:%S.000000')
-                d = {'source': r[0],
-                     'creationDate': cdate, 'startDate': sdate, 'endDate': edate,
-                     'value': r[4]}
-                rows.append(d)
-            return rows
-
-    def get_heart_rate_report(self, startdate=None, enddate=None, sourcename=''):
-        if not startdate:
-            startdate = datetime.strptime('1970-01-01', "%Y-%m-%d")
-        if not enddate:
-            enddate = datetime.now()
-        if sourcename != '':
-            print(f' HR Source: {sourcename}')
-            sourcename = f' AND sourceName = "{sourcename}" '
-        query = f'''
-SELECT DISTINCT startDate, value FROM health_data 
-    WHERE type = "HKQuantityTypeIdentifierHeartRate" AND startDate >= "{startdate}" AND endDate <= "{enddate}" {sourcename}
-'''
-        statement = text(query)
-        with self._open_session() as session:
-            n = session.execute(statement)
-            rows = []
-            for r in n:
-                cdate = datetime.strptime(r[0], '%Y-%m-%d %H:%M:%S.000000')
-                d = {'startDate': cdate, 'heartrate': r[1]}
-                rows.append(d)
-            return rows
-
-    def get_blood_pressure_report(self, startdate=None, enddate=None, sourcename=''):
-        if not startdate:
-            startdate = datetime.strptime('1970-01-01', "%Y-%m-%d")
-        if not enddate:
-            enddate = datetime.now()
-        if sourcename != '':
-            print(f' BP Source: {sourcename}')
-            sourcename = f' AND sourceName = "{sourcename}" '
-        query = f'''
-SELECT DISTINCT
-  s.startDate, s.value 'systolic', d.value 'diastolic'
-    FROM
-    (
-      SELECT startDate, type, value
-      FROM health_data
-      WHERE
-        type = 'HKQuantityTypeIdentifierBloodPressureSystolic' {sourcename}
-    ) s
-    JOIN
-    (
-        SELECT startDate, type, value
-        FROM health_data
-        WHERE
-            type = 'HKQuantityTypeIdentifierBloodPressureDiastolic' {sourcename}
-    ) d
-    ON
-        s.startDate = d.startDate AND s.startDate >= '{startdate}' AND s.startDate <= '{enddate}'
-    ORDER BY s.startDate
-'''
-        statement = text(query)
-        with self._open_session() as session:
-            n = session.execute(statement)
-            rows = []
-            for r in n:
-                cdate = datetime.strptime(r[0], '%Y-%m-%d %H:%M:%S.000000')
-                d = {'startDate': cdate, 'systolic': r[1], 'diastolic': r[2]}
-                rows.append(d)
-            return rows
-
-    def insert_records(self, records, callback=None):
+    def _build_report_query(self, name, by_source):
+        router = self.router
+        # start_date <= :end follows from end_date <= :end but bounds the index range scan on start_date
+        if name == REPORT_SLEEP:
+            source = ' AND r.source_id = :source_id' if by_source else ''
+            return ReportQuery(f'''
+SELECT s.name, r.creation_date, r.start_date, r.end_date, c.name
+FROM {router.table_name(SLEEP_TYPE)} r
+    JOIN source s ON s.id = r.source_id
+    LEFT JOIN category c ON c.id = r.category_id
+WHERE {router.type_condition(SLEEP_TYPE, alias='r.')}
+    AND r.start_date >= :start AND r.start_date <= :end AND r.end_date <= :end{source}
+ORDER BY r.start_date
+''', {'type_id': SLEEP_TYPE})
+        if name == REPORT_HEART_RATE:
+            source = ' AND source_id = :source_id' if by_source else ''
+            return ReportQuery(f'''
+SELECT DISTINCT start_date, value FROM {router.table_name(HEART_RATE_TYPE)}
+WHERE {router.type_condition(HEART_RATE_TYPE)}
+    AND start_date >= :start AND start_date <= :end AND end_date <= :end{source}
+ORDER BY start_date
+''', {'type_id': HEART_RATE_TYPE})
+        if name == REPORT_BLOOD_PRESSURE:
+            if router.partition_for(SYSTOLIC_TYPE).table is BloodPressure.__table__:
+                source = ' AND source_id = :source_id' if by_source else ''
+                return ReportQuery(f'''
+SELECT DISTINCT start_date, systolic, diastolic FROM blood_pressure
+WHERE systolic IS NOT NULL AND diastolic IS NOT NULL
+    AND start_date >= :start AND start_date <= :end{source}
+ORDER BY start_date
+''')
+            # the two halves of a reading are separate records with the same source and start date.
+            # +s.start_date stops sqlite copying the date range onto d, it would then scan that range
+            # for every reading instead of looking the other half up by equality
+            source = ' AND s.source_id = :source_id' if by_source else ''
+            return ReportQuery(f'''
+SELECT DISTINCT s.start_date, s.value, d.value
+FROM {TABLE_NAME} s
+    JOIN {TABLE_NAME} d
+        ON {router.type_condition(DIASTOLIC_TYPE, alias='d.', param='diastolic_type_id')}
+        AND d.source_id = s.source_id AND d.start_date = +s.start_date
+WHERE {router.type_condition(SYSTOLIC_TYPE, alias='s.', param='systolic_type_id')}
+    AND s.start_date >= :start AND s.start_date <= :end{source}
+ORDER BY s.start_date
+''', {'systolic_type_id': SYSTOLIC_TYPE, 'diastolic_type_id': DIASTOLIC_TYPE})
+        raise ValueError(f'Unknown report: {name}')
+
+    def report_query(self, name, by_source=False):
+        '''
+        The ReportQuery of a report for the storage layout of this database, built on first use.
+        :param name: one of REPORTS
+        :param by_source: the variant filtering on :source_id
+        '''
+        key = (name, by_source)
+        query = self._report_queries.get(key)
+        if query is None:
+            query = self._build_report_query(name, by_source)
+            self._report_queries[key] = query
+        return query
+
+    def _report_params(self, connection, name, startdate, enddate, sourcename):
+        # :return: (ReportQuery, parameters), or (None, None) if the source is not in the database
+        params = {
+            'start': to_epoch(startdate) if startdate else 0,
+            'end': to_epoch(enddate) if enddate else to_epoch(datetime.now()),
+        }
+        if sourcename:
+            params['source_id'] = self._lookups['source'].find_id(connection, sourcename)
+            if params['source_id'] is None:
+                return None, None
+        query = self.report_query(name, bool(sourcename))
+        for param, type_name in query.type_params.items():
+            params[param] = self._lookups['type'].find_id(connection, type_name)
+        return query, params
+
+    def run_report(self, name, startdate=None, enddate=None, sourcename='', columnar=False):
+        '''
+        Run a report with bound parameters.
+        :param name: one of REPORTS
+        :param startdate: datetime, date string or epoch seconds, defaults to the beginning of time
+        :param enddate: same, defaults to now
+        :param sourcename: only rows from this source if set
+        :param columnar: return a ReportColumns with the columns of REPORT_COLUMNS instead of rows
+        :return: list of result rows, or ReportColumns if columnar
+        '''
+        with self.db_engine.connect() as connection:
+            query, params = self._report_params(connection, name, startdate, enddate, sourcename)
+            if query is None:
+                return fetch_columns(None, REPORT_COLUMNS[name]) if columnar else []
+            result = connection.execute(query.statement, params)
+            if columnar:
+                # straight from the DBAPI cursor, the rows are never made into Row objects
+                return fetch_columns(result.cursor, REPORT_COLUMNS[name])
+            return result.fetchall()
+
+    def explain_report(self, name, startdate=None, enddate=None, sourcename=''):
+        '''
+        :return: the EXPLAIN QUERY PLAN details of a report as run by run_report
+        '''
+        with self.db_engine.connect() as connection:
+            query, params = self._report_params(connection, name, startdate, enddate, sourcename)
+            if query is None:
+                return []
+            plan = connection.execute(text(f'EXPLAIN QUERY PLAN {query.sql}'), params)
+            return [row[-1] for row in plan]
+
+    def _cached(self, key, compute):
+        # the result of compute() for key, from the report cache while the database generation is unchanged
+        if self.report_cache is None:
+            return compute()
+        generation = self.generation
+        result = self.report_cache.get(key, generation)
+        if result is None:
+            result = compute()
+            self.report_cache.put(key, generation, result)
+        return result
+
+    def get_report(self, name, startdate=None, enddate=None, sourcename='', columnar=False):
+        '''
+        run_report with the rows as dicts keyed on the column names of REPORT_COLUMNS, dates as datetimes.
+        Results are kept in the report cache until the next import.
+        :param columnar: return a ReportColumns of epoch seconds, floats and strings instead of dicts
+        '''
+        key = (name, to_epoch(startdate) if startdate else None, to_epoch(enddate) if enddate else None,
+               sourcename, columnar)
+        def compute():
+            if columnar:
+                return self.run_report(name, startdate, enddate, sourcename, columnar=True)
+            layout = REPORT_COLUMNS[name]
+            return [{column: from_epoch(value) if kind == DATE_COLUMN else value
+                     for (column, kind), value in zip(layout, r)}
+                    for r in self.run_report(name, startdate, enddate, sourcename)]
+        result = self._cached(key, compute)
+        if columnar:
+            return result
+        # callers convert the dicts in place, e.g. DataDateRange
+        return [dict(row) for row in result]
+
+    def get_sleep_report(self, startdate=None, enddate=None, sourcename='', columnar=False):
+        '''
+        :param columnar: return a ReportColumns of epoch seconds and category names instead of dicts
+        '''
+        return self.get_report(REPORT_SLEEP, startdate, enddate, sourcename, columnar)
+
+    def get_heart_rate_report(self, startdate=None, enddate=None, sourcename='', columnar=False):
+        '''
+        :param columnar: return a ReportColumns of epoch seconds and float values instead of dicts
+        '''
+        return self.get_report(REPORT_HEART_RATE, startdate, enddate, sourcename, columnar)
+
+    def get_blood_pressure_report(self, startdate=None, enddate=None, sourcename='', columnar=False):
+        '''
+        :param columnar: return a ReportColumns of epoch seconds and float values instead of dicts
+        '''
+        return self.get_report(REPORT_BLOOD_PRESSURE, startdate, enddate, sourcename, columnar)
+
+    def pick_rollup_resolution(self, startdate, enddate, pixels):
+        '''
+        The coarsest of ROLLUP_RESOLUTIONS that still gives at least one bucket per pixel over a date range.
+        :param startdate: datetime, date string or epoch seconds
+        :param enddate: same
+        :param pixels: width the range is drawn across
+        :return: bucket width in seconds, or ROLLUP_RAW if even minutes are too coarse
+        '''
+        span = to_epoch(enddate) - to_epoch(startdate)
+        for resolution in reversed(ROLLUP_RESOLUTIONS):
+            if span / resolution >= pixels:
+                return resolution
+        return ROLLUP_RAW
+
+    def _rollup_query(self, type_name, resolution, by_source):
+        # ReportQuery of get_rollup_report, cached with the reports
+        raw = resolution == ROLLUP_RAW
+        key = ('rollup', type_name if raw else None, raw, by_source)
+        query = self._report_queries.get(key)
+        if query is not None:
+            return query
+        if raw:
+            partition = self.router.partition_for(type_name)
+            value = partition.value_column
+            source = ' AND source_id = :source_id' if by_source else ''
+            query = ReportQuery(f'''
+SELECT start_date, 1, {value}, {value}, {value} FROM {partition.table.name}
+WHERE {partition.type_condition()} AND {value} IS NOT NULL
+    AND start_date >= :start AND start_date <= :end{source}
+ORDER BY start_date
+''', {'type_id': type_name})
+        elif by_source:
+            query = ReportQuery('''
+SELECT bucket, count, minimum, maximum, total / count FROM record_rollup
+WHERE resolution = :resolution AND type_id = :type_id AND bucket >= :first_bucket AND bucket <= :end
+    AND source_id = :source_id
+ORDER BY bucket
+''', {'type_id': type_name})
+        else:
+            query = ReportQuery('''
+SELECT bucket, SUM(count), MIN(minimum), MAX(maximum), SUM(total) / SUM(count) FROM record_rollup
+WHERE resolution = :resolution AND type_id = :type_id AND bucket >= :first_bucket AND bucket <= :end
+GROUP BY bucket
+ORDER BY bucket
+''', {'type_id': type_name})
+        self._report_queries[key] = query
+        return query
+
+    def get_rollup_report(self, type_name, startdate=None, enddate=None, pixels=1000, sourcename='', resolution=None):
+        '''
+        Count, min, max and mean of the values of a record type per bucket, from the rollup tables.
+        :param type_name: record type, e.g. HEART_RATE_TYPE
+        :param startdate: datetime, date string or epoch seconds, defaults to the beginning of time
+        :param enddate: same, defaults to now
+        :param pixels: width the range is drawn across, picks the resolution if none is given
+        :param sourcename: only values from this source if set, otherwise the sources are combined
+        :param resolution: one of ROLLUP_RESOLUTIONS or ROLLUP_RAW, see pick_rollup_resolution
+        :return: ReportColumns with the columns of ROLLUP_COLUMNS; with ROLLUP_RAW a bucket per record
+        '''
+        start = to_epoch(startdate) if startdate else 0
+        end = to_epoch(enddate) if enddate else to_epoch(datetime.now())
+        if resolution is None:
+            resolution = self.pick_rollup_resolution(start, end, pixels)
+        if resolution != ROLLUP_RAW and resolution not in ROLLUP_RESOLUTIONS:
+            raise ValueError(f'Unknown rollup resolution: {resolution}')
+        key = ('rollup', type_name, start, end if enddate else None, resolution, sourcename)
+        return self._cached(key, lambda: self._read_rollups(type_name, start, end, resolution, sourcename))
+
+    def _read_rollups(self, type_name, start, end, resolution, sourcename):
+        with self.db_engine.connect() as connection:
+            params = {
+                'start': start,
+                'end': end,
+                'resolution': resolution,
+                # the bucket holding start begins before it
+                'first_bucket': start // resolution * resolution if resolution else start,
+                'type_id': self._lookups['type'].find_id(connection, type_name),
+            }
+            if params['type_id'] is None:
+                return fetch_columns(None, ROLLUP_COLUMNS)
+            if sourcename:
+                params['source_id'] = self._lookups['source'].find_id(connection, sourcename)
+                if params['source_id'] is None:
+                    return fetch_columns(None, ROLLUP_COLUMNS)
+            query = self._rollup_query(type_name, resolution, bool(sourcename))
+            result = connection.execute(query.statement, params)
+            return fetch_columns(result.cursor, ROLLUP_COLUMNS)
+
+    def _reset_lookups(self):
+        # ids inserted by a rolled back transaction are gone, reload from the database
+        for lookup in self._lookups.values():
+            lookup.reset()
+
+    def encode_row(self, connection, row):
+        '''
+        Convert a row of HEALTH_DATA_COLUMNS (strings and dates) to HealthRecord column values,
+        dictionary encoding the strings through the lookup tables.
+        :param connection: connection used to insert lookup entries not seen before
+        :param row: dict keyed by column name or tuple in HEALTH_DATA_COLUMNS order
+        '''
+        if not isinstance(row, dict):
+            row = dict(zip(HEALTH_DATA_COLUMNS, row))
+        lookups = self._lookups
+        value = row['value']
+        category_id = None
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            category_id = lookups['category'].get_id(connection, value)
+            value = None
+        return {
+            'type_id': lookups['type'].get_id(connection, row['type']),
+            'source_id': lookups['source'].get_id(connection, row['sourceName']),
+            'source_version_id': lookups['source_version'].get_id(connection, row['sourceVersion']),
+            'device_id': lookups['device'].get_id(connection, row['device']),
+            'unit_id': lookups['unit'].get_id(connection, row['unit']),
+            'creation_date': to_epoch(row['creationDate']),
+            'start_date': to_epoch(row['startDate']),
+            'end_date': to_epoch(row['endDate']),
+            'value': value,
+            'category_id': category_id,
+        }
+
+    def insert_records(self, records, callback=None, batch_size=None):
+        '''
+        Insert rows through an ORM session, committing every batch_size records. Like insert_rows, records
+        matching the natural key of a stored record are skipped and the import watermarks are moved on.
+        :param records: iterable of dicts keyed by column name or tuples in HEALTH_DATA_COLUMNS order
+        :return: number of new rows
+        '''
+        if self.router.layout != LAYOUT_SINGLE:
+            raise ValueError(f'The ORM writer only supports the {LAYOUT_SINGLE} layout')
+        batch_size = batch_size or self.batch_size
         with self._open_session() as session:
             count = 0
-            for record in records:
-                session.add(record)
-                count += 1
-                if count % AppleHealthDatabase.MAX_COMMIT == 0:
-                    print(f' - Committing {count} records...')
-                    session.commit()
+            inserted = 0
+            encoded_rows = []
+            try:
+                for record in records:
+                    encoded_rows.append(self.encode_row(session.connection(), record))
+                    count += 1
+                    if count % batch_size == 0:
+                        inserted += self._commit_records(session, encoded_rows, count)
+                        encoded_rows = []
+                        if callback:
+                            callback(count)
+                if count % batch_size != 0:
+                    inserted += self._commit_records(session, encoded_rows, count)
                     if callback:
                         callback(count)
-            if count > 0:
-                print(f' - Committing {count} records...')
-                session.commit()
+            except Exception:
+                self._reset_lookups()
+                raise
+            return inserted
+
+    def _commit_records(self, session, encoded_rows, count):
+        # the unit of work has no INSERT OR IGNORE, so the rows go in on the session's connection
+        # through the same statement the bulk writer uses and let the natural key index drop duplicates
+        print(f' - Committing {count} records...')
+        connection = session.connection()
+        inserted = connection.execute(HealthRecord.__table__.insert().prefix_with('OR IGNORE'), encoded_rows).rowcount
+        self._update_watermarks(connection, encoded_rows)
+        self._mark_rollups_pending(connection, encoded_rows)
+        if inserted:
+            self._bump_generation(connection)
+        session.commit()
+        return inserted
+
+    def _update_watermarks(self, connection, encoded_rows):
+        newest = {}
+        for row in encoded_rows:
+            source_id = row['source_id']
+            if source_id not in newest or row['creation_date'] > newest[source_id]:
+                newest[source_id] = row['creation_date']
+        if not newest:
+            return
+        statement = sqlite_insert(ImportWatermark.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements=['source_id'],
+            set_={'creation_date': func.max(ImportWatermark.__table__.c.creation_date, statement.excluded.creation_date)}
+        )
+        connection.execute(statement, [{'source_id': k, 'creation_date': v} for k, v in newest.items()])
+
+    def _mark_rollups_pending(self, connection, encoded_rows):
+        days = {(row['type_id'], row['source_id'], row['start_date'] // ROLLUP_DAY * ROLLUP_DAY)
+                for row in encoded_rows if row['value'] is not None and row['start_date'] is not None}
+        if days:
+            connection.execute(RollupPending.__table__.insert().prefix_with('OR IGNORE'),
+                               [{'type_id': t, 'source_id': s, 'day': d} for t, s, d in days])
+
+    def _rollup_statements(self, partition):
+        # DELETE and INSERTs that recompute the rollups of one type and source over [:start, :stop)
+        key = ('rollup_update', partition.table.name, partition.value_column)
+        statements = self._report_queries.get(key)
+        if statements is not None:
+            return statements
+        resolutions = ', '.join(str(r) for r in ROLLUP_RESOLUTIONS)
+        value = partition.value_column
+        statements = [text(f'''
+DELETE FROM record_rollup WHERE resolution IN ({resolutions}) AND type_id = :type_id
+    AND bucket >= :start AND bucket < :stop AND source_id = :source_id
+'''), text(f'''
+INSERT INTO record_rollup (resolution, type_id, bucket, source_id, count, minimum, maximum, total)
+SELECT {ROLLUP_MINUTE}, :type_id, start_date / {ROLLUP_MINUTE} * {ROLLUP_MINUTE}, :source_id,
+    COUNT(*), MIN({value}), MAX({value}), SUM({value})
+FROM {partition.table.name}
+WHERE {partition.type_condition()} AND source_id = :source_id
+    AND start_date >= :start AND start_date < :stop AND {value} IS NOT NULL
+GROUP BY 3
+''')]
+        # each resolution from the one below it rather than from the records again
+        for finer, coarser in zip(ROLLUP_RESOLUTIONS, ROLLUP_RESOLUTIONS[1:]):
+            statements.append(text(f'''
+INSERT INTO record_rollup (resolution, type_id, bucket, source_id, count, minimum, maximum, total)
+SELECT {coarser}, :type_id, bucket / {coarser} * {coarser}, :source_id,
+    SUM(count), MIN(minimum), MAX(maximum), SUM(total)
+FROM record_rollup
+WHERE resolution = {finer} AND type_id = :type_id AND bucket >= :start AND bucket < :stop AND source_id = :source_id
+GROUP BY 3
+'''))
+        self._report_queries[key] = statements
+        return statements
+
+    def update_rollups(self):
+        '''
+        Recompute the rollups of the days whose records changed since the last update, as marked in
+        rollup_pending by insert_rows and insert_records. Importers call this when they finish.
+        :return: number of days updated
+        '''
+        with self.db_engine.begin() as connection:
+            pending = connection.execute(text(
+                'SELECT type_id, source_id, day FROM rollup_pending ORDER BY type_id, source_id, day')).fetchall()
+            if not pending:
+                return 0
+            type_names = {row[0]: row[1] for row in connection.execute(select(RecordType.id, RecordType.name))}
+            for (type_id, source_id), days in itertools.groupby(pending, key=lambda row: (row[0], row[1])):
+                statements = self._rollup_statements(self.router.partition_for(type_names[type_id]))
+                for start, stop in _day_runs([row[2] for row in days]):
+                    params = {'type_id': type_id, 'source_id': source_id, 'start': start, 'stop': stop}
+                    for statement in statements:
+                        connection.execute(statement, params)
+            # only what was read above, a writer may have marked more since
+            connection.execute(RollupPending.__table__.delete().where(sqlalchemy.and_(
+                RollupPending.type_id == sqlalchemy.bindparam('t'),
+                RollupPending.source_id == sqlalchemy.bindparam('s'),
+                RollupPending.day == sqlalchemy.bindparam('d'))),
+                [{'t': row[0], 's': row[1], 'd': row[2]} for row in pending])
+            self._bump_generation(connection)
+        print(f'Updated the rollups of {len(pending)} days')
+        return len(pending)
+
+    def rebuild_rollups(self):
+        '''
+        Recompute every rollup from the stored records, e.g. for databases from before rollups existed.
+        '''
+        day = f'start_date / {ROLLUP_DAY} * {ROLLUP_DAY}'
+        with self.db_engine.begin() as connection:
+            connection.execute(text('DELETE FROM record_rollup'))
+            self._bump_generation(connection)
+            connection.execute(text(f'''
+INSERT OR IGNORE INTO rollup_pending (type_id, source_id, day)
+    SELECT type_id, source_id, {day} FROM {TABLE_NAME}
+    WHERE value IS NOT NULL AND start_date IS NOT NULL GROUP BY 1, 2, 3
+'''))
+            for type_name, partition in self.router.partitions.items():
+                type_id = self._lookups['type'].find_id(connection, type_name)
+                if type_id is None:
+                    continue
+                value = partition.value_column
+                connection.execute(text(f'''
+INSERT OR IGNORE INTO rollup_pending (type_id, source_id, day)
+    SELECT :type_id, source_id, {day} FROM {partition.table.name}
+    WHERE {partition.type_condition()} AND {value} IS NOT NULL AND start_date IS NOT NULL GROUP BY 2, 3
+'''), {'type_id': type_id})
+        return self.update_rollups()
+
+    def _execute_batch(self, batch):
+        '''
+        Write one batch in a single transaction.
+        :return: number of rows inserted; rows already in the database are skipped
+        '''
+        try:
+            with self.db_engine.begin() as connection:
+                encoded_rows = []
+                groups = {}
+                for row in batch:
+                    if not isinstance(row, dict):
+                        row = dict(zip(HEALTH_DATA_COLUMNS, row))
+                    encoded = self.encode_row(connection, row)
+                    encoded_rows.append(encoded)
+                    partition = self.router.partition_for(row['type'])
+                    groups.setdefault(partition, []).append(partition.convert(encoded))
+                # one executemany per partition
+                inserted = 0
+                for partition, rows in groups.items():
+                    inserted += connection.execute(partition.statement, rows).rowcount
+                self._update_watermarks(connection, encoded_rows)
+                self._mark_rollups_pending(connection, encoded_rows)
+                if inserted:
+                    self._bump_generation(connection)
+                return inserted
+        except Exception:
+            self._reset_lookups()
+            raise
+
+    def insert_rows(self, rows, callback=None, batch_size=None):
+        '''
+        Bulk insert plain rows without going through the ORM unit of work. Each batch is written
+        with a single executemany inside its own transaction.
+        :param rows: iterable of dicts keyed by column name or tuples in HEALTH_DATA_COLUMNS order
+        :param callback: called with the running count of rows written after each batch is committed
+        :param batch_size: rows per transaction, defaults to self.batch_size
+        :return: number of new rows, rows matching the natural key of a stored record are skipped
+        '''
+        batch_size = batch_size or self.batch_size
+        count = 0
+        inserted = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                inserted += self._execute_batch(batch)
+                count += len(batch)
+                batch = []
                 if callback:
                     callback(count)
+        if batch:
+            inserted += self._execute_batch(batch)
+            count += len(batch)
+            if callback:
+                callback(count)
+        return inserted
+
+    def insert_extras(self, extras):
+        '''
+        Write the workouts, activity summaries, record metadata, heart beat series and routes collected
+        in an activity.ExtraRows, in one transaction. Rows already stored are skipped, except activity
+        summaries which are replaced.
+        :return: number of rows written
+        '''
+        lookups = self._lookups
+        try:
+            with self.db_engine.begin() as connection:
+                def get_id(lookup, name):
+                    return lookups[lookup].get_id(connection, name)
+                written = 0
+                if extras.workouts:
+                    rows = [{
+                        'type_id': get_id('type', w['activityType']),
+                        'source_id': get_id('source', w['sourceName']),
+                        'source_version_id': get_id('source_version', w['sourceVersion']),
+                        'device_id': get_id('device', w['device']),
+                        'creation_date': w['creationDate'],
+                        'start_date': w['startDate'],
+                        'end_date': w['endDate'],
+                        'duration': w['duration'],
+                        'duration_unit_id': get_id('unit', w['durationUnit']),
+                        'total_distance': w['totalDistance'],
+                        'total_distance_unit_id': get_id('unit', w['totalDistanceUnit']),
+                        'total_energy_burned': w['totalEnergyBurned'],
+                        'total_energy_burned_unit_id': get_id('unit', w['totalEnergyBurnedUnit']),
+                        'route_name': w['routeName'],
+                    } for w in extras.workouts]
+                    written += connection.execute(Workout.__table__.insert().prefix_with('OR IGNORE'), rows).rowcount
+                if extras.activity_summaries:
+                    rows = []
+                    for summary in extras.activity_summaries:
+                        row = dict(summary)
+                        row['active_energy_burned_unit_id'] = get_id('unit', row.pop('active_energy_burned_unit'))
+                        rows.append(row)
+                    statement = sqlite_insert(ActivitySummary.__table__)
+                    statement = statement.on_conflict_do_update(
+                        index_elements=['date'],
+                        set_={name: statement.excluded[name] for name in rows[0] if name != 'date'})
+                    written += connection.execute(statement, rows).rowcount
+                if extras.metadata:
+                    rows = [{
+                        'type_id': get_id('type', record_type),
+                        'source_id': get_id('source', source_name),
+                        'start_date': start_date,
+                        'key_id': get_id('metadata_key', key),
+                        'value': value,
+                    } for record_type, source_name, start_date, key, value in extras.metadata]
+                    written += connection.execute(RecordMetadata.__table__.insert().prefix_with('OR IGNORE'), rows).rowcount
+                if extras.heart_beats:
+                    rows = [{
+                        'type_id': get_id('type', record_type),
+                        'source_id': get_id('source', source_name),
+                        'start_date': start_date,
+                        'beat_count': count,
+                        'bpm': bpm,
+                        'offsets': offsets,
+                    } for record_type, source_name, start_date, count, bpm, offsets in extras.heart_beats]
+                    written += connection.execute(HeartBeatSeries.__table__.insert().prefix_with('OR IGNORE'), rows).rowcount
+                if extras.routes:
+                    written += connection.execute(WorkoutRoute.__table__.insert().prefix_with('OR IGNORE'),
+                                                  extras.routes).rowcount
+                return written
+        except Exception:
+            self._reset_lookups()
+            raise
+
+    def get_route_names(self):
+        '''
+        :return: set of the names of the workout routes already stored
+        '''
+        with self.db_engine.connect() as connection:
+            return {row[0] for row in connection.execute(select(WorkoutRoute.name))}
+
+    def get_route(self, name):
+        '''
+        :param name: workout_route.name, as referenced by workout.route_name
+        :return: dict of start_date, end_date and per point lists of times (epoch seconds), latitudes,
+                 longitudes (degrees), elevations and speeds, or None if there is no such route
+        '''
+        with self.db_engine.connect() as connection:
+            route = connection.execute(select(WorkoutRoute.__table__).where(WorkoutRoute.name == name)).mappings().first()
+        if route is None:
+            return None
+        start_date = route['start_date']
+        return {
+            'name': name,
+            'start_date': start_date,
+            'end_date': route['end_date'],
+            'times': [None if t < 0 else start_date + t for t in unpack_array(OFFSET_TYPECODE, route['times'])],
+            'latitudes': [c / COORDINATE_SCALE for c in unpack_array(COORDINATE_TYPECODE, route['latitudes'])],
+            'longitudes': [c / COORDINATE_SCALE for c in unpack_array(COORDINATE_TYPECODE, route['longitudes'])],
+            'elevations': list(unpack_array(FLOAT_TYPECODE, route['elevations'])),
+            'speeds': list(unpack_array(FLOAT_TYPECODE, route['speeds'])),
+        }
+
+    def get_watermarks(self):
+        '''
+        :return: {source name: epoch seconds of the newest record imported from that source}
+        '''
+        query = text('''
+SELECT s.name, w.creation_date FROM import_watermark w JOIN source s ON s.id = w.source_id
+''')
+        with self.db_engine.connect() as connection:
+            return {row[0]: row[1] for row in connection.execute(query)}
+
+    def restore_watermarks(self, watermarks):
+        '''
+        Put the import watermarks back to an earlier get_watermarks() result. Used when an import stops
+        part way: exports are grouped by type rather than sorted by date, so the watermarks it left behind
+        could be newer than records it never reached.
+        '''
+        with self.db_engine.begin() as connection:
+            connection.execute(text('DELETE FROM import_watermark'))
+            if watermarks:
+                connection.execute(text('''
+INSERT INTO import_watermark (source_id, creation_date) SELECT id, :creation_date FROM source WHERE name = :name
+'''), [{'name': name, 'creation_date': creation_date} for name, creation_date in watermarks.items()])
+
+    def rebuild_watermarks(self):
+        '''
+        Recompute the import watermarks from the stored records, e.g. for databases from before they existed.
+        '''
+        union = ' UNION ALL '.join(f'SELECT source_id, creation_date FROM {table.name}' for table in self.router.tables)
+        with self.db_engine.begin() as connection:
+            connection.execute(text('DELETE FROM import_watermark'))
+            connection.execute(text(f'''
+INSERT INTO import_watermark (source_id, creation_date)
+    SELECT source_id, MAX(creation_date) FROM ({union}) WHERE creation_date IS NOT NULL GROUP BY source_id
+'''))
+
+    def needs_migration(self):
+        '''
+        :return: True if the database still has a v1 health_data table to migrate
+        '''
+        return sqlalchemy.inspect(self.db_engine).has_table(LEGACY_TABLE_NAME)
+
+    def _read_legacy_rows(self, batch_size):
+        # page through health_data by id so no read cursor is held open while writing
+        columns = ', '.join(HEALTH_DATA_COLUMNS)
+        query = text(f'SELECT id, {columns} FROM {LEGACY_TABLE_NAME} WHERE id > :last ORDER BY id LIMIT :limit')
+        last = 0
+        while True:
+            with self.db_engine.connect() as connection:
+                page = connection.execute(query, {'last': last, 'limit': batch_size}).fetchall()
+            if not page:
+                return
+            last = page[-1][0]
+            for r in page:
+                row = dict(zip(HEALTH_DATA_COLUMNS, r[1:]))
+                # v1 stored the wall clock time without its offset; treat it as local time
+                for col in ('creationDate', 'startDate', 'endDate'):
+                    row[col] = to_epoch(parse_local_date(row[col]))
+                yield row
+
+    def migrate_legacy_data(self, drop_legacy=False, callback=None):
+        '''
+        Copy every row of the v1 health_data table into the v2 schema. Afterwards the v1 table is
+        renamed to health_data_v1, or dropped if drop_legacy is set.
+        :return: number of rows migrated
+        '''
+        if not self.needs_migration():
+            return 0
+        print(f'Migrating {LEGACY_TABLE_NAME} to schema version {SCHEMA_VERSION}...')
+        with self.connection_profile(BULK_IMPORT_PROFILE):
+            self.drop_indexes()
+            try:
+                count = self.insert_rows(self._read_legacy_rows(self.batch_size), callback=callback)
+            finally:
+                self.create_indexes()
+            with self.db_engine.begin() as connection:
+                if drop_legacy:
+                    connection.execute(text(f'DROP TABLE {LEGACY_TABLE_NAME}'))
+                else:
+                    connection.execute(text(f'ALTER TABLE {LEGACY_TABLE_NAME} RENAME TO {MIGRATED_LEGACY_TABLE_NAME}'))
+        print(f'Migrated {count} records')
+        return count
+
+    def vacuum(self):
+        '''
+        Rebuild the database file, e.g. to reclaim the space of a dropped v1 table.
+        '''
+        with self.db_engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text('VACUUM'))
@@ -0,0 +1,92 @@
+'''
+Runs an import on a worker thread so the GUI keeps drawing and handling events while it runs.
+The thread never touches the UI; it reports through posted pygame events which the main loop
+hands to AppleHealthTool.handle_event like any other event.
+'''
+import threading
+import time
+import zipfile
+
+import pygame
+
+from applehealthtool.data_panel import IMPORT_PROGRESS, IMPORT_FINISHED
+from applehealthtool.importer import HealthDataImporter, ImportCancelledException
+from applehealthtool.sources import ExportSource, UnknownSourceException
+
+PROGRESS_EVENT_INTERVAL = 0.1 # seconds between IMPORT_PROGRESS events
+
+IMPORT_SUCCEEDED = 'succeeded'
+IMPORT_CANCELLED = 'cancelled'
+IMPORT_FAILED = 'failed'
+
+
+class ImportThread(threading.Thread):
+    '''
+    Imports one export into an AppleHealthDatabase.
+
+    Posts IMPORT_PROGRESS events with bytes_read, bytes_total, records_read and records_saved, at most
+    every PROGRESS_EVENT_INTERVAL seconds, and one IMPORT_FINISHED event with status (IMPORT_SUCCEEDED,
+    IMPORT_CANCELLED or IMPORT_FAILED), records_new and message.
+
+    The GUI thread should leave the database alone until IMPORT_FINISHED arrives.
+    '''
+    def __init__(self, database, file_path, rebuild_indexes=False):
+        super(ImportThread, self).__init__(name='import', daemon=True)
+        self.database = database
+        self.file_path = file_path
+        self.rebuild_indexes = rebuild_indexes
+        self._importer = None
+        self._cancel = threading.Event()
+        self._last_progress = 0
+
+    def cancel(self):
+        self._cancel.set()
+        importer = self._importer
+        if importer:
+            importer.cancel()
+
+    def _post_progress(self, source, records_read, records_saved, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_progress < PROGRESS_EVENT_INTERVAL:
+            return
+        self._last_progress = now
+        pygame.event.post(pygame.event.Event(IMPORT_PROGRESS, {
+            'bytes_read': source.position,
+            'bytes_total': source.size,
+            'records_read': records_read,
+            'records_saved': records_saved
+        }))
+
+    def _post_finished(self, status, records_new=0, message=''):
+        pygame.event.post(pygame.event.Event(IMPORT_FINISHED, {
+            'status': status,
+            'records_new': records_new,
+            'message': message
+        }))
+
+    def run(self):
+        importer = None
+        try:
+            with ExportSource(self.file_path) as source:
+                print(f'Reading {source.kind} source {source.member_name or ""}')
+
+                def progress(records_read, records_saved):
+                    self._post_progress(source, records_read, records_saved)
+
+                importer = HealthDataImporter(self.database, progress_callback=progress,
+                                              rebuild_indexes=self.rebuild_indexes)
+                self._importer = importer
+                if self._cancel.is_set():
+                    importer.cancel()
+                records_new = importer.import_source(source)
+                self._post_progress(source, importer.records_read, importer.records_saved, force=True)
+            skipped = f'{importer.routes_failed} workout routes skipped' if importer.routes_failed else ''
+            self._post_finished(IMPORT_SUCCEEDED, records_new, skipped)
+        except ImportCancelledException as e:
+            self._post_finished(IMPORT_CANCELLED, importer.records_new, f'{e}')
+        except (OSError, zipfile.BadZipFile, UnknownSourceException) as e:
+            print(f'Uh-oh: {e}')
+            self._post_finished(IMPORT_FAILED, importer.records_new if importer else 0, f'{e}')
+        except Exception as e:
+            print(f'Import failed: {e}')
+            self._post_finished(IMPORT_FAILED, importer.records_new if importer else 0, f'{type(e).__name__}: {e}')
@@ -0,0 +1,395 @@
+import datetime
+import xml.etree.ElementTree as ET
+
+from applehealthtool.activity import ExtraRows, ELEMENT_TAGS, WORKOUT_TAG, ACTIVITY_SUMMARY_TAG, RouteLoader, \
+    default_route_workers
+from applehealthtool.dates import parse_epoch, to_epoch
+from applehealthtool.healthdatabase import BULK_IMPORT_PROFILE, HEALTH_DATA_COLUMNS
+from applehealthtool.healthdatabase import HEART_RATE_TYPE, SYSTOLIC_TYPE, DIASTOLIC_TYPE, SLEEP_TYPE
+
+RECORD_TAG = 'Record'
+PROGRESS_INTERVAL = 1000 # records read between progress callbacks
+MAX_UTC_OFFSET = 14 * 60 * 60 # largest timezone offset in seconds, for the watermark pre-filter
+
+RECORD_TYPE_TAGS = {
+    'HKQuantityTypeIdentifierBloodPressureDiastolic': 'diastolic',
+    'HKQuantityTypeIdentifierBloodPressureSystolic': 'systolic',
+    'HKQuantityTypeIdentifierHeartRate': 'heart-rate',
+    'HKQuantityTypeIdentifierBodyMass': 'weight',
+    'HKQuantityTypeIdentifierHeight': 'height',
+    'HKQuantityTypeIdentifierActiveEnergyBurned': 'calories',
+    'HKQuantityTypeIdentifierFlightsClimbed': 'stairs',
+    'HKQuantityTypeIdentifierStepCount': 'steps',
+    'HKQuantityTypeIdentifierDistanceWalkingRunning': 'distance',
+    'HKCategoryTypeIdentifierSleepAnalysis': 'sleep'
+}
+RECORD_TYPES_BY_TAG = {tag: record_type for record_type, tag in RECORD_TYPE_TAGS.items()}
+
+# named sets of types for the type filter
+RECORD_TYPE_PRESETS = {
+    'tagged': tuple(RECORD_TYPE_TAGS), # every type with a short tag
+    'charts': (HEART_RATE_TYPE, SYSTOLIC_TYPE, DIASTOLIC_TYPE, SLEEP_TYPE) # what the report panel draws
+}
+
+
+def resolve_record_types(names):
+    '''
+    Expand a list of type names as a user would write them into the HK type identifiers.
+    :param names: iterable of identifiers (HKQuantityTypeIdentifierHeartRate), short tags (heart-rate),
+                  preset names from RECORD_TYPE_PRESETS or element tags (Workout, ActivitySummary)
+    :return: set of identifiers and element tags
+    '''
+    record_types = set()
+    for name in names:
+        name = name.strip()
+        if not name:
+            continue
+        if name in RECORD_TYPE_PRESETS:
+            record_types.update(RECORD_TYPE_PRESETS[name])
+        elif name in RECORD_TYPES_BY_TAG:
+            record_types.add(RECORD_TYPES_BY_TAG[name])
+        elif name.startswith('HK') or name in ELEMENT_TAGS:
+            record_types.add(name)
+        else:
+            raise ValueError(f'Unknown record type: {name}')
+    return record_types
+
+
+class ImportCancelledException(Exception):
+    def __init__(self, message='Import cancelled'):
+        super().__init__(message)
+
+
+def make_row_tuple(attrib):
+    '''
+    Convert the attributes of a Record element to a tuple in HEALTH_DATA_COLUMNS order, with the
+    dates as epoch seconds and numeric values as floats.
+    '''
+    value = attrib['value']
+    try:
+        value = float(value)
+    except ValueError:
+        pass # category value, e.g. HKCategoryValueSleepAnalysisAsleep
+    return (
+        attrib['type'],
+        attrib['sourceName'],
+        attrib['sourceVersion'] if 'sourceVersion' in attrib else '',
+        str(attrib['device']) if 'device' in attrib else '',
+        attrib['unit'] if 'unit' in attrib else '',
+        parse_epoch(attrib['creationDate']),
+        parse_epoch(attrib['startDate']),
+        parse_epoch(attrib['endDate']),
+        value
+    )
+
+
+def make_row(attrib):
+    '''
+    Same as make_row_tuple, as a dict keyed by HEALTH_DATA_COLUMNS name.
+    '''
+    return dict(zip(HEALTH_DATA_COLUMNS, make_row_tuple(attrib)))
+
+
+def watermark_prefix(watermark):
+    '''
+    Cheap pre-filter for incremental imports. Any record whose raw creationDate string sorts before the
+    returned prefix was created before watermark whatever its timezone offset, so it can be skipped
+    without parsing the date.
+    :param watermark: epoch seconds
+    '''
+    earliest = datetime.datetime.fromtimestamp(watermark - MAX_UTC_OFFSET, datetime.timezone.utc)
+    return earliest.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class RecordFilter:
+    '''
+    Decides from the raw attributes of a Record, before any conversion, whether it is imported.
+    The type is checked first, on the raw string, so unwanted types cost no date parsing at all.
+    Plain data so it can be pickled for the worker processes of the parallel pipeline.
+    '''
+    def __init__(self, watermarks=None, since=None, types=None, exclude_types=None, type_since=None):
+        '''
+        :param watermarks: {source name: epoch seconds}, records created earlier are skipped
+        :param since: epoch seconds, records created earlier are skipped
+        :param types: if set, only records of these types are imported, and only the elements of
+                      ELEMENT_TAGS (workouts with their routes, activity summaries) listed here
+        :param exclude_types: records of these types and elements with these tags are skipped
+        :param type_since: {type: epoch seconds}, per-type cutoff used instead of since for that type
+        '''
+        self.watermarks = watermarks or {}
+        self.prefixes = {name: watermark_prefix(watermark) for name, watermark in self.watermarks.items()}
+        self.since = since
+        self.types = frozenset(types) if types is not None else None
+        self.exclude_types = frozenset(exclude_types or ())
+        self.type_since = type_since or {}
+
+    def accept(self, attrib):
+        record_type = attrib['type']
+        if self.types is not None and record_type not in self.types:
+            return False
+        if record_type in self.exclude_types:
+            return False
+        source_name = attrib['sourceName']
+        if source_name in self.watermarks:
+            creation_date = attrib['creationDate']
+            if creation_date[:19] < self.prefixes[source_name] or \
+                    parse_epoch(creation_date) < self.watermarks[source_name]:
+                return False
+        since = self.type_since.get(record_type, self.since)
+        if since is not None and parse_epoch(attrib['creationDate']) < since:
+            return False
+        return True
+
+    def accept_element(self, tag):
+        '''
+        Whether top level elements other than Record, e.g. Workout, are imported.
+        '''
+        if self.types is not None and tag not in self.types:
+            return False
+        return tag not in self.exclude_types
+
+
+class ElementConverter:
+    '''
+    Filters and converts top level export elements into record rows and ExtraRows until take() hands
+    them over for writing.
+    '''
+    def __init__(self, record_filter):
+        self.record_filter = record_filter
+        self.rows = []
+        self.extras = ExtraRows()
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.rows) + len(self.extras)
+
+    def convert(self, elem):
+        tag = elem.tag
+        if tag == RECORD_TAG:
+            attrib = elem.attrib
+            if not self.record_filter.accept(attrib):
+                self.skipped += 1
+                return
+            row = make_row_tuple(attrib)
+            self.rows.append(row)
+            if len(elem):
+                self.extras.add_record_children(elem, row)
+        elif not self.record_filter.accept_element(tag):
+            self.skipped += 1
+        elif tag == WORKOUT_TAG:
+            self.extras.add_workout(elem)
+        elif tag == ACTIVITY_SUMMARY_TAG:
+            self.extras.add_activity_summary(elem)
+
+    def take(self):
+        '''
+        :return: (rows, extras, skipped) converted since the last call
+        '''
+        taken = self.rows, self.extras, self.skipped
+        self.rows = []
+        self.extras = ExtraRows()
+        self.skipped = 0
+        return taken
+
+
+def iter_elements(source, tags=(RECORD_TAG,) + ELEMENT_TAGS):
+    '''
+    Incrementally parse an Apple Health export and yield its top level elements with one of tags one
+    at a time, children included. Each element is released as soon as the caller is done with it, so
+    memory use does not grow with the size of the export. Records nested inside other elements
+    (e.g. Correlation) are duplicates of top level records and are skipped.
+    :param source: path or binary file object of an export.xml
+    '''
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            if elem.tag in tags:
+                yield elem
+            root.clear()
+
+
+def iter_records(source):
+    '''
+    Same as iter_elements, yielding only the Record elements.
+    '''
+    return iter_elements(source, (RECORD_TAG,))
+
+
+class HealthDataImporter:
+    '''
+    Streams Record elements out of an export and writes them to an AppleHealthDatabase in
+    batches of at most batch_size records. By default rows go through the bulk writer
+    (AppleHealthDatabase.insert_rows); pass bulk=False to write through an ORM session instead.
+    Workouts, activity summaries and the metadata of records are written alongside them
+    (AppleHealthDatabase.insert_extras), and the GPX routes of an ExportSource are parsed by a
+    RouteLoader in other processes while the export is streamed.
+
+    Imports are incremental: records created before the import watermark of their source are skipped
+    and records already in the database are ignored by the writer, so re-importing a newer export of
+    the same data only costs time in proportion to what is new.
+
+    cancel() may be called from another thread; the import stops at the next progress interval and
+    raises ImportCancelledException. Batches already written stay in the database and the watermarks
+    are put back, so importing the same export again only has to skip the duplicates. Imports limited
+    by type or date put the watermarks back too, since they are kept per source and not per type.
+    '''
+    def __init__(self, database, batch_size=None, since=None, progress_callback=None, bulk=True,
+                 profile=BULK_IMPORT_PROFILE, rebuild_indexes=False, incremental=True,
+                 types=None, exclude_types=None, type_since=None, routes=True, route_workers=None):
+        '''
+        :param database: AppleHealthDatabase to write to
+        :param batch_size: records per call to the database writer (one transaction each),
+                           defaults to database.batch_size
+        :param since: if set, records created before this datetime are skipped (naive means local time)
+        :param progress_callback: called as progress_callback(records_read, records_saved)
+        :param bulk: use the executemany writer rather than the ORM session
+        :param profile: connection profile used while importing, None to keep the current one
+        :param rebuild_indexes: drop the table indexes before loading and build them once afterwards,
+                                much faster when the import is large compared to the existing data
+        :param incremental: skip records older than the per-source watermarks stored in the database
+        :param types: if set, only import records of these types (see resolve_record_types)
+        :param exclude_types: never import records of these types
+        :param type_since: {type: datetime}, per-type replacement for since
+        :param routes: import the workout routes of the export
+        :param route_workers: processes parsing routes, defaults to default_route_workers()
+        '''
+        self.database = database
+        self.bulk = bulk
+        self.batch_size = batch_size or database.batch_size
+        self.since = since
+        self.progress_callback = progress_callback
+        self.profile = profile
+        self.rebuild_indexes = rebuild_indexes
+        self.incremental = incremental
+        self.types = types
+        self.exclude_types = exclude_types
+        self.type_since = type_since or {}
+        self.routes = routes
+        self.route_workers = route_workers or default_route_workers()
+        self.records_read = 0
+        self.records_saved = 0 # written to the database, including duplicates it ignored
+        self.records_new = 0
+        self.records_skipped = 0 # dropped by the record filter
+        self.extras_new = 0 # rows written by insert_extras
+        self.routes_failed = 0 # route files that could not be read or parsed
+        self.cancelled = False
+        self._watermarks = None # as they were before the import
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _progress(self):
+        if self.progress_callback:
+            self.progress_callback(self.records_read, self.records_saved)
+
+    def _flush(self, converter, routes=()):
+        batch, extras, skipped = converter.take()
+        self.records_skipped += skipped
+        extras.routes.extend(routes)
+        if batch:
+            if self.bulk:
+                self.records_new += self.database.insert_rows(batch, batch_size=self.batch_size)
+            else:
+                self.records_new += self.database.insert_records(batch, batch_size=self.batch_size)
+            self.records_saved += len(batch)
+        if extras:
+            self.extras_new += self.database.insert_extras(extras)
+        self._progress()
+
+    def import_source(self, source):
+        '''
+        Import every Record in source.
+        :param source: path or binary file object of an export.xml
+        :return: number of new records saved
+        '''
+        try:
+            if self.profile is None:
+                records_new = self._import_source(source)
+            else:
+                with self.database.connection_profile(self.profile):
+                    records_new = self._import_source(source)
+        except ImportCancelledException:
+            self.restore_watermarks()
+            # what was written before the cancel stays, so its rollups are brought up to date as well
+            self.update_rollups()
+            raise
+        if self.is_partial:
+            self.restore_watermarks()
+        self.update_rollups()
+        return records_new
+
+    def update_rollups(self):
+        if self.profile is None:
+            self.database.update_rollups()
+        else:
+            with self.database.connection_profile(self.profile):
+                self.database.update_rollups()
+
+    @property
+    def is_partial(self):
+        '''True if the filter leaves out records by type or date.'''
+        return self.types is not None or bool(self.exclude_types) or self.since is not None or bool(self.type_since)
+
+    def restore_watermarks(self):
+        if self._watermarks is not None:
+            self.database.restore_watermarks(self._watermarks)
+
+    def _import_source(self, source):
+        if not self.rebuild_indexes:
+            return self._load(source)
+        self.database.drop_indexes()
+        try:
+            return self._load(source)
+        finally:
+            print('Rebuilding indexes...')
+            self.database.create_indexes()
+
+    def make_filter(self):
+        self._watermarks = self.database.get_watermarks()
+        watermarks = self._watermarks if self.incremental else {}
+        type_since = {record_type: to_epoch(date) for record_type, date in self.type_since.items()}
+        return RecordFilter(watermarks, to_epoch(self.since), types=self.types,
+                            exclude_types=self.exclude_types, type_since=type_since)
+
+    def make_route_loader(self, source, record_filter):
+        '''
+        :return: a started RouteLoader for the routes of source not imported yet, or None
+        '''
+        if not self.routes or not hasattr(source, 'route_files') or not record_filter.accept_element(WORKOUT_TAG):
+            return None
+        return RouteLoader(source, self.database.get_route_names(), self.route_workers).start()
+
+    def _report(self):
+        print(f'Read {self.records_read} records: {self.records_new} new, '
+              f'{self.records_skipped} skipped by filter, {self.records_saved - self.records_new} duplicates; '
+              f'{self.extras_new} new workout, summary, metadata and route rows')
+        if self.routes_failed:
+            print(f'{self.routes_failed} workout routes could not be read and were skipped')
+
+    def _load(self, source):
+        record_filter = self.make_filter()
+        converter = ElementConverter(record_filter)
+        routes = self.make_route_loader(source, record_filter)
+        try:
+            for elem in iter_elements(source):
+                self.records_read += 1
+                if self.records_read % PROGRESS_INTERVAL == 0:
+                    if self.cancelled:
+                        raise ImportCancelledException()
+                    self._progress()
+                converter.convert(elem)
+                if len(converter) >= self.batch_size:
+                    self._flush(converter, routes.finished() if routes else ())
+            self._flush(converter, routes.wait() if routes else ())
+        finally:
+            if routes:
+                routes.close()
+                self.routes_failed = routes.routes_failed
+        self._report()
+        return self.records_new
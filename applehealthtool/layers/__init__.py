@@ -1,9 +1,38 @@
 from typing import Union
 
+import numpy
 import pygame
-from pygame_gui.core.utility import premul_alpha_surface
 
 from applehealthtool.GraphData import DataViewScaler, DataSet, DataSeries, DataDateRange
+from applehealthtool.fonts import get_font, render_text
+from applehealthtool.lod import category_columns, column_runs
+from applehealthtool.ticks import AxisTicks, TIME_AXIS, VALUE_AXIS
+
+# inputs a layer is drawn from besides its own settings, see GraphLayer.depends_on
+DEPENDS_X = 'x' # the x DataViewScaler
+DEPENDS_Y = 'y' # the y DataViewScaler
+
+# kinds of layer surface, see make_surface
+SURFACE_OPAQUE = 'opaque' # covers everything below it
+SURFACE_COLORKEY = 'colorkey' # opaque drawing, COLORKEY where there is none
+SURFACE_ALPHA = 'alpha' # per pixel alpha, only for drawing that is partly translucent
+COLORKEY = pygame.Color(255, 0, 128) # far from the layer colors, also in 16 bit display formats
+
+
+def make_surface(size, mode):
+    '''
+    A layer surface, in the format of the display once one is set so blits onto it need no conversion.
+    :param mode: SURFACE_OPAQUE, SURFACE_COLORKEY or SURFACE_ALPHA
+    '''
+    if mode == SURFACE_ALPHA:
+        surface = pygame.Surface(size, flags=pygame.SRCALPHA)
+    else:
+        surface = pygame.Surface(size)
+    if pygame.display.get_surface() is not None:
+        surface = surface.convert_alpha() if mode == SURFACE_ALPHA else surface.convert()
+    if mode == SURFACE_COLORKEY:
+        surface.set_colorkey(COLORKEY)
+    return surface
 
 
 class BadArgException(Exception):
@@ -16,6 +45,10 @@ class BadOffsetException(BadArgException):
 
 
 class GraphLayer:
+    # scalers the surface is drawn through; the compositor of UIGraph renders the layer again when one
+    # of them changes, otherwise only when dirty is set
+    depends_on = ()
+
     def __init__(self, visible=True, offset=(0,0)):
         self._surface = None
         self.visible = visible
@@ -41,6 +74,15 @@ class GraphLayer:
     def update(self):
         pass # overload this function
 
+    @property
+    def rect(self):
+        '''
+        Area of the target surface the layer covers, None before it has a surface.
+        '''
+        if self.surface is None:
+            return None
+        return pygame.Rect(self._offset, self.surface.get_size())
+
     @property
     def ready_to_draw(self):
         return self.surface and self.visible and self.dirty
@@ -78,7 +120,8 @@ class TextLayer(GraphLayer):
         self.text = text
         self.color = color if color is not None else pygame.Color(0, 0, 0, 255)
         self._font:pygame.font = None
-        self._image:pygame.surface = None
+        self._font_name = font_name
+        self._font_size = font_size
         self.set_font(font_name, font_size)
 
     @property
@@ -91,14 +134,22 @@ class TextLayer(GraphLayer):
         self.dirty = True
 
     def set_font(self, name:str, size:int):
-        pygame.font.init()
-        self._font = pygame.font.SysFont(name, size)
+        '''
+        :param name: a font of applehealthtool.fonts, empty for the bundled FiraMono
+        '''
+        self._font = get_font(name, size) # loaded once for every layer using it
+        self._font_name = name
+        self._font_size = size
         self.dirty = True
 
+    @property
+    def font(self):
+        return self._font
+
     def update(self):
         if self.visible and self.dirty:
-            image = self._font.render(self.text, True, self.color)
-            self._surface = premul_alpha_surface(image)
+            # shared with every other layer showing the same text, it is only blitted
+            self._surface = render_text(self.text, self._font_name, self._font_size, self.color, premultiplied=True)
             self.dirty = False
 
 
@@ -110,27 +161,50 @@ class BackgroundLayer(GraphLayer):
         self._yscaler = yscaler
         self._size = size
 
+    @property
+    def surface_mode(self):
+        # per pixel alpha only for a translucent background
+        if self.bg_color.a == 255:
+            return SURFACE_OPAQUE
+        if self.bg_color.a == 0:
+            return SURFACE_COLORKEY
+        return SURFACE_ALPHA
+
     def update_surface(self):
         if not self.surface:
-            self.surface = pygame.Surface(self._size, flags=pygame.SRCALPHA)
+            self.surface = make_surface(self._size, self.surface_mode)
+
+    def clear(self):
+        self.surface.fill(COLORKEY if self.surface_mode == SURFACE_COLORKEY else self.bg_color)
+
+    def local_scalers(self):
+        # the scalers work in the coordinates of the graph, the surface starts at offset
+        return self._xscaler.shifted(-self._offset[0]), self._yscaler.shifted(-self._offset[1])
 
     def update(self):
         self.update_surface()
         if self.surface:
-            self.surface.fill(self.bg_color)
+            self.clear()
 
 class BPRangeLayer(BackgroundLayer):
-    def __init__(self,size, color:pygame.Color, xscaler:DataViewScaler, yscaler:DataViewScaler):
-        super(BPRangeLayer, self).__init__(size, color, xscaler, yscaler)
+    depends_on = (DEPENDS_X, DEPENDS_Y)
+    surface_mode = SURFACE_ALPHA # translucent band, opaque lines
+
+    def __init__(self,size, color:pygame.Color, xscaler:DataViewScaler, yscaler:DataViewScaler, offset=(0,0)):
+        super(BPRangeLayer, self).__init__(size, color, xscaler, yscaler, offset=offset)
+
+    def clear(self):
+        self.surface.fill(pygame.Color(0, 0, 0, 0))
 
     def update(self):
-        self.update_surface()
+        super(BPRangeLayer, self).update()
         if not self.dirty or not self.visible:
             return
-        y0 = self._yscaler.scale(120) # 120 / 80 : "normal" range for BP
-        y1 = self._yscaler.scale(80)
-        x0 = self._xscaler.view_min
-        x1 = self._xscaler.view_max
+        xscaler, yscaler = self.local_scalers()
+        y0 = yscaler.scale(120) # 120 / 80 : "normal" range for BP
+        y1 = yscaler.scale(80)
+        x0 = xscaler.view_min
+        x1 = xscaler.view_max
         # on the screen zero is top so we put the max world y (200) first to flip the graph
         r = pygame.Rect(x0, y0, x1 - x0, y1 - y0)
         pygame.draw.rect(self.surface, pygame.Color(200, 255, 200, 128), r)
@@ -138,12 +212,43 @@ class BPRangeLayer(BackgroundLayer):
         pygame.draw.line(self.surface, pygame.Color(0, 255, 0, 255), (x0, y1), (x1, y1))
 
 class AxisLayer(BackgroundLayer):
-    def __init__(self, size, color:pygame.Color, width:int, xscaler:DataViewScaler, yscaler:DataViewScaler, graph_rect):
-        super(AxisLayer, self).__init__(size, pygame.Color(0,0,0,0), xscaler=xscaler, yscaler=yscaler)
-        self.axis_size = 150# where this should come from ???
+    depends_on = (DEPENDS_X, DEPENDS_Y) # the ticks
+
+    TICK_LENGTH = 6
+    LABEL_PADDING = 4 # between a tick and its label, and around the axis
+    X_LABEL_SAMPLE = 'Sep 30 ' # about the widest time tick label
+    Y_LABEL_SAMPLE = '0000.0' # about the widest value tick label
+
+    def __init__(self, size, color:pygame.Color, width:int, xscaler:DataViewScaler, yscaler:DataViewScaler, graph_rect,
+                 font_name:str='', font_size:int=12, label_background:pygame.Color=None):
+        '''
+        :param size: size of graph_rect, which it is placed on
+        :param font_name: font of the tick labels, see applehealthtool.fonts
+        :param label_background: the opaque colour under the axes, if there is one the labels are rendered
+                                 onto it and the layer needs no per pixel alpha
+        '''
+        super(AxisLayer, self).__init__(size, pygame.Color(0,0,0,0), xscaler=xscaler, yscaler=yscaler,
+                                        offset=graph_rect.topleft)
         self.axis_color = color
         self.axis_width = width
         self.graph_rect = graph_rect
+        self.font_name = font_name
+        self.font_size = font_size
+        self.label_background = label_background
+        font = get_font(font_name, font_size)
+        # room for two lines of time labels under the x axis and a value label left of the y axis
+        x_axis_height = self.TICK_LENGTH + self.LABEL_PADDING * 2 + font.get_linesize() * 2
+        y_axis_width = self.TICK_LENGTH + self.LABEL_PADDING * 2 + font.size(self.Y_LABEL_SAMPLE)[0]
+        self.axis_size = max(x_axis_height, y_axis_width)
+        self.x_ticks = AxisTicks(xscaler, TIME_AXIS, font.size(self.X_LABEL_SAMPLE)[0] + self.LABEL_PADDING)
+        self.y_ticks = AxisTicks(yscaler, VALUE_AXIS, font.get_linesize() * 2)
+
+    @property
+    def surface_mode(self):
+        return SURFACE_COLORKEY if self.label_background is not None else SURFACE_ALPHA
+
+    def _label(self, text):
+        return render_text(text, self.font_name, self.font_size, self.axis_color, background=self.label_background)
 
     def recalculate_layout(self):
         # y axis box
@@ -163,16 +268,49 @@ class AxisLayer(BackgroundLayer):
         super(AxisLayer, self).update()
         if self.visible and self.dirty:
             self.recalculate_layout()
-            start = self.y_axis_rect.topright
-            end = self.y_axis_rect.bottomright
-            pygame.draw.line(self.surface, self.axis_color, start, end, self.axis_width)
-            start = self.x_axis_rect.topleft
-            end = self.x_axis_rect.topright
-            pygame.draw.line(self.surface, self.axis_color, start, end, self.axis_width)
+            x, y = self._offset
+            y_axis = self.y_axis_rect.move(-x, -y)
+            x_axis = self.x_axis_rect.move(-x, -y)
+            pygame.draw.line(self.surface, self.axis_color, y_axis.topright, y_axis.bottomright, self.axis_width)
+            pygame.draw.line(self.surface, self.axis_color, x_axis.topleft, x_axis.topright, self.axis_width)
+            self._draw_x_ticks(x_axis)
+            self._draw_y_ticks(y_axis)
+
+    def _draw_x_ticks(self, x_axis):
+        ticks = self.x_ticks.update()
+        top = x_axis.top
+        for vx, label, context in zip(ticks.view_positions - self._offset[0], ticks.labels, ticks.context):
+            if vx < x_axis.left or vx > x_axis.right:
+                continue
+            pygame.draw.line(self.surface, self.axis_color, (vx, top), (vx, top + self.TICK_LENGTH))
+            y = top + self.TICK_LENGTH + self.LABEL_PADDING
+            for line in (label, context):
+                if line:
+                    text = self._label(line)
+                    self.surface.blit(text, (vx - text.get_width() // 2, y))
+                    y += text.get_height()
+
+    def _draw_y_ticks(self, y_axis):
+        ticks = self.y_ticks.update()
+        right = y_axis.right
+        for vy, label in zip(ticks.view_positions - self._offset[1], ticks.labels):
+            if vy < y_axis.top or vy > y_axis.bottom:
+                continue
+            pygame.draw.line(self.surface, self.axis_color, (right - self.TICK_LENGTH, vy), (right, vy))
+            text = self._label(label)
+            # centred on the tick, but kept inside the axis at either end
+            y = min(max(vy - text.get_height() // 2, y_axis.top), y_axis.bottom - text.get_height())
+            self.surface.blit(text, (right - self.TICK_LENGTH - self.LABEL_PADDING - text.get_width(), y))
 
 class DataSetLayer(BackgroundLayer):
-    def __init__(self, data_set:DataSet, size, xscaler:DataViewScaler, yscaler:DataViewScaler):
-        super(DataSetLayer, self).__init__(size, pygame.Color(0,0,0,0), xscaler, yscaler)
+    depends_on = (DEPENDS_X, DEPENDS_Y)
+
+    def __init__(self, data_set:DataSet, size, xscaler:DataViewScaler, yscaler:DataViewScaler, offset=(0,0)):
+        '''
+        :param size: size of the area the data is drawn in, usually UIGraph.graph_data_rect
+        :param offset: top left of that area
+        '''
+        super(DataSetLayer, self).__init__(size, pygame.Color(0,0,0,0), xscaler, yscaler, offset=offset)
         self.data_set = data_set
 
     @property
@@ -182,58 +320,82 @@ class DataSetLayer(BackgroundLayer):
         return None
 
 class DataSeriesLayer(DataSetLayer):
-    def __init__(self, data_set, size, xscaler:DataViewScaler, yscaler:DataViewScaler):
+    def __init__(self, data_set, size, xscaler:DataViewScaler, yscaler:DataViewScaler, offset=(0,0)):
         if not isinstance(data_set, DataSeries):
             raise Exception('DataSeriesLayer data_set must be DataSeries instance')
-        super(DataSeriesLayer, self).__init__(data_set, size, xscaler, yscaler)
+        super(DataSeriesLayer, self).__init__(data_set, size, xscaler, yscaler, offset=offset)
+
+    @property
+    def surface_mode(self):
+        return SURFACE_COLORKEY if self.data_set.color.a == 255 else SURFACE_ALPHA
 
     def update(self):
         super().update()
-        lines = []
-        ycount = self.data_set.y_per_column
-        for y in range(ycount):
-            print(f'Start Empty Line: {y}')
-            lines.append([])
-
         if self.data_set.data_count > 0:
-            print(f'First Row: {self.data_set._data[0]["startDate"]}')
-            print(f' Last Row: {self.data_set._data[-1]["startDate"]}')
+            print(f'First Row: {self.data_set.x_min}')
+            print(f' Last Row: {self.data_set.x_max}')
         else:
             print(f'NO DATA')
-        for row in self.data_set:
-            x = self._xscaler.scale(float(row[0]))
-            for i in range(ycount):
-                y = self._yscaler.scale(float(row[i + 1]))
-                lines[i].append([x, y])
+        lines = self.data_set.scaled_lines(*self.local_scalers())
 
         for line in lines:
             if len(line) > 1:
                 pygame.draw.lines(self.surface, self.data_set.color, False, line, width=self.data_set.line_width)
 
 class DateRangeDataLayer(DataSetLayer):
-    def __init__(self, data_set, size, xscaler:DataViewScaler, yscaler:DataViewScaler, type_color_map:dict, type_row:int ):
+    def __init__(self, data_set, size, xscaler:DataViewScaler, yscaler:DataViewScaler, type_color_map:dict, type_row:int,
+                 offset=(0,0)):
         if not isinstance(data_set, DataDateRange):
             raise Exception('DateRangeDataLayer data_set must be DataDateRange instance')
         self.type_row = type_row
         self.type_color_map = type_color_map
-        super(DateRangeDataLayer, self).__init__(data_set, size, xscaler, yscaler)
+        super(DateRangeDataLayer, self).__init__(data_set, size, xscaler, yscaler, offset=offset)
+
+    @property
+    def layer_alpha(self):
+        # the alpha all the type colors share, None if they differ
+        alphas = {color.a for color in self.type_color_map.values()}
+        return alphas.pop() if len(alphas) == 1 else None
+
+    @property
+    def surface_mode(self):
+        # colors of one alpha are drawn opaque on a color keyed surface blitted with that alpha;
+        # types missing from type_color_map then take it too
+        return SURFACE_COLORKEY if self.layer_alpha is not None else SURFACE_ALPHA
+
+    def update_surface(self):
+        super().update_surface()
+        if self.surface_mode == SURFACE_COLORKEY and self.layer_alpha < 255:
+            self.surface.set_alpha(self.layer_alpha)
 
     def update(self):
         super().update()
         if not self.visible or not self.dirty:
             return
 
-        top = self._yscaler.view_max
-        bottom = self._yscaler.view_min
+        if self.data_set.data_count < 1:
+            return
+        xscaler, yscaler = self.local_scalers()
+        top = yscaler.view_max
+        bottom = yscaler.view_min
         H = bottom - top
         yoff = 0
-        for row in self.data_set:
-            color = pygame.Color(255, 0, 255, 255)
-            if row[self.type_row] in self.type_color_map:
-                color = self.type_color_map[row[self.type_row]]
-
-            left = self._xscaler.scale(row[1])
-            right = self._xscaler.scale(row[2])
-            w = right - left
-            r = pygame.Rect(left, bottom - yoff - H, w, H)
-            pygame.draw.rect(self.surface, color, r)
+        # every range is the full height, so a pixel column shows one type: work out which and fill
+        # each run of columns once, however many ranges there are
+        left = xscaler.scale_array(self.data_set.x_start_values)
+        right = xscaler.scale_array(self.data_set.x_end_values)
+        codes = self.type_codes(self.data_set.type_values)
+        columns = category_columns(left, right, codes, self.surface.get_width())
+        colors = [pygame.Color(255, 0, 255, 255)] + list(self.type_color_map.values())
+        for start, stop, code in zip(*column_runs(columns)):
+            r = pygame.Rect(int(start), bottom - yoff - H, int(stop - start), H)
+            self.surface.fill(colors[code], r)
+
+    def type_codes(self, types):
+        '''
+        :return: int array, 0 for types missing from type_color_map, otherwise 1 + the position in it;
+                 types later in type_color_map cover earlier ones where ranges overlap
+        '''
+        positions = {name: n + 1 for n, name in enumerate(self.type_color_map)}
+        names, inverse = numpy.unique(types.astype(str), return_inverse=True)
+        return numpy.array([positions.get(name, 0) for name in names], dtype=numpy.int64)[inverse]
@@ -0,0 +1,94 @@
+'''
+Level of detail for drawing dense series.
+
+A year of heart rate is a hundred thousand points or more, drawn into a graph about a thousand
+pixels wide. Everything that lands in one pixel column draws as a vertical stroke from the lowest to
+the highest point, so the line is reduced to the first, lowest, highest and last point of each column
+before it goes to pygame.draw.lines. Peaks survive and the work per redraw follows the width of
+the graph rather than the number of samples.
+
+Ranges drawn the full height of the graph, like sleep, are reduced the same way: category_columns
+works out which category covers each pixel column and column_runs turns that into one span per run
+of columns to fill.
+'''
+import numpy
+
+POINTS_PER_COLUMN = 4 # most points minmax_columns keeps for one pixel column
+
+
+def visible_range(vx, view_min, view_max):
+    '''
+    The points of a line that fall in the view, plus one on either side so the line runs to the edge.
+    :param vx: ascending x view coordinates
+    :return: (start, stop) slice bounds into vx
+    '''
+    start = max(int(numpy.searchsorted(vx, view_min, side='left')) - 1, 0)
+    stop = min(int(numpy.searchsorted(vx, view_max, side='right')) + 1, len(vx))
+    return start, stop
+
+
+def minmax_columns(vx, vy):
+    '''
+    Reduce a line to the first, lowest, highest and last point of each pixel column it crosses.
+    :param vx: ascending x view coordinates
+    :param vy: y view coordinates, without NaN
+    :return: (x, y) arrays of at most POINTS_PER_COLUMN points per column
+    '''
+    if len(vx) == 0:
+        return vx, vy
+    column = numpy.floor(vx).astype(numpy.int64)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(column[1:] != column[:-1]) + 1))
+    ends = numpy.concatenate((starts[1:], [len(vx)])) - 1
+    low = numpy.minimum.reduceat(vy, starts)
+    high = numpy.maximum.reduceat(vy, starts)
+    x = numpy.column_stack((vx[starts], vx[starts], vx[ends], vx[ends])).ravel()
+    y = numpy.column_stack((vy[starts], low, high, vy[ends])).ravel()
+    return x, y
+
+
+def needs_reduction(count, view_width):
+    '''
+    :return: True if a line of count points has more than POINTS_PER_COLUMN per column of the view
+    '''
+    return count > POINTS_PER_COLUMN * max(view_width, 1)
+
+
+def category_columns(left, right, codes, width):
+    '''
+    Which category covers each pixel column of a view. Spans are snapped to the nearest column edges but
+    cover at least one column, so one shorter than a pixel still shows; overlapping and adjacent spans
+    of a category merge, spans outside the view are dropped.
+    :param left: view x of the start of each span
+    :param right: view x of the end of each span
+    :param codes: category of each span, non negative ints; higher codes cover lower ones
+    :param width: number of columns in the view, starting at view x 0
+    :return: int array of width, the code covering each column or -1
+    '''
+    columns = numpy.full(width, -1, dtype=numpy.int64)
+    start = numpy.rint(left)
+    stop = numpy.maximum(numpy.rint(right), start + 1)
+    start = numpy.clip(start, 0, width).astype(numpy.int64)
+    stop = numpy.clip(stop, 0, width).astype(numpy.int64)
+    keep = stop > start
+    start, stop, codes = start[keep], stop[keep], numpy.asarray(codes)[keep]
+    for code in numpy.unique(codes):
+        mine = codes == code
+        # +1 where a span starts and -1 where it ends, covered wherever the running sum is positive
+        depth = numpy.cumsum(numpy.bincount(start[mine], minlength=width + 1) -
+                             numpy.bincount(stop[mine], minlength=width + 1))
+        columns[depth[:width] > 0] = code
+    return columns
+
+
+def column_runs(columns):
+    '''
+    :param columns: result of category_columns
+    :return: (start, stop, code) arrays, one entry per run of columns of the same code, without the -1 runs
+    '''
+    if len(columns) == 0:
+        return columns, columns, columns
+    start = numpy.concatenate(([0], numpy.flatnonzero(columns[1:] != columns[:-1]) + 1))
+    stop = numpy.concatenate((start[1:], [len(columns)]))
+    code = columns[start]
+    covered = code >= 0
+    return start[covered], stop[covered], code[covered]
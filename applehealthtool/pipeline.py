@@ -0,0 +1,263 @@
+'''
+Multiprocess import pipeline.
+
+    reader (this process) --chunks--> converter workers --row tuples--> writer process --> sqlite
+
+The reader splits the raw export into chunks of complete top level elements (Record, Workout,
+ActivitySummary) without parsing them. A pool of worker processes parses the chunks, filters and
+converts the elements to row tuples and ExtraRows (date parsing, value coercion) and a single writer
+process owns the database connection and does the batched inserts. GPX routes are parsed by a
+RouteLoader pool started by the reader and handed to the writer the same way. The queues between
+the stages are bounded, so a slow writer holds back the workers and the workers hold back the reader
+instead of the backlog piling up in memory.
+
+The splitter relies on the layout Apple's exporter writes, one element per line with child elements
+on lines of their own. HealthDataImporter parses any well formed export.
+'''
+import multiprocessing
+import os
+import queue
+import xml.etree.ElementTree as ET
+
+from applehealthtool.activity import ExtraRows, ELEMENT_TAGS
+from applehealthtool.healthdatabase import AppleHealthDatabase, BULK_IMPORT_PROFILE
+from applehealthtool.importer import HealthDataImporter, ImportCancelledException, ElementConverter, RECORD_TAG
+
+DEFAULT_CHUNK_SIZE = 2000 # records per chunk handed to a worker
+QUEUE_CHUNKS_PER_WORKER = 4 # bound of the queues, in chunks per worker
+QUEUE_POLL_SECONDS = 0.5
+
+# start of the opening tag line -> closing tag line, of the top level elements that are imported
+_ELEMENT_ENDS = {b'<' + tag.encode() + b' ': b'</' + tag.encode() + b'>' for tag in (RECORD_TAG,) + ELEMENT_TAGS}
+# elements whose children may include Records that duplicate top level ones
+_CONTAINER_START = b'<Correlation'
+_CONTAINER_END = b'</Correlation>'
+
+
+class PipelineException(Exception):
+    def __init__(self, message='Import pipeline failed'):
+        super().__init__(message)
+
+
+def iter_record_chunks(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Split an export into chunks of raw top level elements without parsing them.
+    :param source: binary file object of an export.xml, iterated by line
+    :return: generator of (element count, bytes) tuples
+    '''
+    chunk = []
+    element = None # lines of a multi-line element
+    element_end = None
+    in_container = False
+    for line in source:
+        stripped = line.strip()
+        if element is not None:
+            element.append(line)
+            if stripped == element_end:
+                chunk.append(b''.join(element))
+                element = None
+        elif in_container:
+            if stripped == _CONTAINER_END:
+                in_container = False
+            continue
+        else:
+            end = _ELEMENT_ENDS.get(stripped[:stripped.find(b' ') + 1])
+            if end is not None:
+                if stripped.endswith(b'/>'):
+                    chunk.append(line)
+                else:
+                    element = [line]
+                    element_end = end
+            elif stripped.startswith(_CONTAINER_START) and not stripped.endswith(b'/>'):
+                in_container = True
+        if len(chunk) >= chunk_size and element is None:
+            yield len(chunk), b''.join(chunk)
+            chunk = []
+    if chunk:
+        yield len(chunk), b''.join(chunk)
+
+
+def _convert_worker(chunk_queue, row_queue, record_filter):
+    # worker process: raw chunk -> (row tuples, ExtraRows, skipped count)
+    converter = ElementConverter(record_filter)
+    while True:
+        chunk = chunk_queue.get()
+        if chunk is None:
+            row_queue.put(None)
+            return
+        root = ET.fromstring(b'<HealthData>' + chunk + b'</HealthData>')
+        for elem in root:
+            converter.convert(elem)
+        row_queue.put(converter.take())
+
+
+def _writer(db_path, batch_size, rebuild_indexes, row_queue, status_queue, worker_count):
+    # writer process: the only connection to the database while the pipeline runs
+    try:
+        database = AppleHealthDatabase(batch_size=batch_size)
+        database.open_database(db_path, profile=BULK_IMPORT_PROFILE)
+        if rebuild_indexes:
+            database.drop_indexes()
+        saved = new = skipped = extras_new = 0
+        batch = []
+        extras = ExtraRows()
+        finished = 0
+        while finished < worker_count:
+            item = row_queue.get()
+            if item is None:
+                finished += 1
+                continue
+            rows, chunk_extras, chunk_skipped = item
+            skipped += chunk_skipped
+            batch.extend(rows)
+            extras.extend(chunk_extras)
+            if len(batch) + len(extras) >= batch_size:
+                if batch:
+                    new += database.insert_rows(batch)
+                    saved += len(batch)
+                    batch = []
+                if extras:
+                    extras_new += database.insert_extras(extras)
+                    extras = ExtraRows()
+                status_queue.put(('progress', saved, new, skipped, extras_new))
+        if batch:
+            new += database.insert_rows(batch)
+            saved += len(batch)
+        if extras:
+            extras_new += database.insert_extras(extras)
+        if rebuild_indexes:
+            print('Rebuilding indexes...')
+            database.create_indexes()
+        database.update_rollups()
+        database.db_engine.dispose()
+        status_queue.put(('done', saved, new, skipped, extras_new))
+    except Exception as e:
+        status_queue.put(('error', f'{type(e).__name__}: {e}'))
+
+
+class ParallelImporter(HealthDataImporter):
+    '''
+    Drop-in replacement for HealthDataImporter that spreads record conversion over worker processes.
+    The database must be file backed, the writer process opens it again by path.
+    '''
+    def __init__(self, database, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        '''
+        :param workers: number of converter processes, defaults to the CPU count less two (reader, writer)
+                        and less the route workers if routes are imported
+        :param chunk_size: records per chunk sent to a worker
+        Other arguments are those of HealthDataImporter; the writer always uses the bulk path and
+        the bulk import connection profile.
+        '''
+        super(ParallelImporter, self).__init__(database, **kwargs)
+        route_workers = self.route_workers if self.routes else 0
+        self.workers = workers or max(1, (os.cpu_count() or 1) - 2 - route_workers)
+        self.chunk_size = chunk_size
+        self._status = None
+
+    def _handle_status(self, status):
+        kind = status[0]
+        if kind == 'error':
+            raise PipelineException(f'Import pipeline failed: {status[1]}')
+        _, self.records_saved, self.records_new, self.records_skipped, self.extras_new = status
+        if kind == 'progress':
+            self._progress()
+        return kind == 'done'
+
+    def _poll_status(self):
+        while True:
+            try:
+                status = self._status.get_nowait()
+            except queue.Empty:
+                return False
+            if self._handle_status(status):
+                return True
+
+    def _put(self, q, item, processes):
+        # put with back-pressure, but notice if a stage died instead of blocking forever
+        while True:
+            try:
+                q.put(item, timeout=QUEUE_POLL_SECONDS)
+                return
+            except queue.Full:
+                self._poll_status()
+                for p in processes:
+                    if not p.is_alive():
+                        raise PipelineException(f'{p.name} exited with code {p.exitcode}')
+
+    def _put_routes(self, row_queue, routes, processes):
+        if routes:
+            extras = ExtraRows()
+            extras.routes.extend(routes)
+            self._put(row_queue, ([], extras, 0), processes)
+
+    def import_source(self, source):
+        '''
+        Import every Record in source.
+        :param source: binary file object of an export.xml, e.g. an ExportSource
+        :return: number of new records saved
+        '''
+        record_filter = self.make_filter()
+        routes = self.make_route_loader(source, record_filter)
+        # the writer process must be the only one holding the database
+        self.database.db_engine.dispose()
+        context = multiprocessing.get_context('spawn')
+        bound = self.workers * QUEUE_CHUNKS_PER_WORKER
+        chunk_queue = context.Queue(bound)
+        row_queue = context.Queue(bound)
+        self._status = context.Queue()
+        writer = context.Process(
+            target=_writer, name='import-writer',
+            args=(self.database.db_path, self.batch_size, self.rebuild_indexes,
+                  row_queue, self._status, self.workers))
+        workers = [
+            context.Process(target=_convert_worker, name=f'import-worker-{n}',
+                            args=(chunk_queue, row_queue, record_filter))
+            for n in range(self.workers)
+        ]
+        processes = workers + [writer]
+        for p in processes:
+            p.start()
+        try:
+            for count, chunk in iter_record_chunks(source, self.chunk_size):
+                if self.cancelled:
+                    # stop reading but let the stages drain, so the writer commits and rebuilds indexes
+                    break
+                self.records_read += count
+                self._put(chunk_queue, chunk, processes)
+                if routes:
+                    self._put_routes(row_queue, routes.finished(), processes)
+            if routes:
+                # before the worker sentinels, the writer stops once it has seen all of those
+                self._put_routes(row_queue, [] if self.cancelled else routes.wait(), processes)
+            for _ in workers:
+                self._put(chunk_queue, None, processes)
+            done = False
+            while not done:
+                try:
+                    status = self._status.get(timeout=QUEUE_POLL_SECONDS)
+                except queue.Empty:
+                    if not writer.is_alive():
+                        raise PipelineException(f'{writer.name} exited with code {writer.exitcode}')
+                    continue
+                done = self._handle_status(status)
+        finally:
+            if routes:
+                routes.close()
+                self.routes_failed = routes.routes_failed
+            # normally every stage has finished by now; after an error stop whatever is left
+            for p in processes:
+                p.join(QUEUE_POLL_SECONDS)
+                if p.is_alive():
+                    p.terminate()
+                    p.join()
+            # anything still buffered has no reader left, don't let it hold up interpreter exit
+            for q in (chunk_queue, row_queue):
+                q.cancel_join_thread()
+                q.close()
+        self._progress()
+        self._report()
+        if self.cancelled or self.is_partial:
+            self.restore_watermarks()
+        if self.cancelled:
+            raise ImportCancelledException()
+        return self.records_new
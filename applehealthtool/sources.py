@@ -0,0 +1,196 @@
+import gzip
+import io
+import os
+import posixpath
+import zipfile
+
+EXPORT_XML_NAME = 'export.xml'
+ROUTES_DIR_NAME = 'workout-routes'
+ROUTE_SUFFIX = '.gpx'
+READ_BUFFER_SIZE = 1024 * 1024 # bytes buffered between the decompressor and the parser
+
+ZIP_MAGIC = b'PK\x03\x04'
+GZIP_MAGIC = b'\x1f\x8b'
+
+SOURCE_ZIP = 'zip'
+SOURCE_GZIP = 'gzip'
+SOURCE_XML = 'xml'
+
+
+class UnknownSourceException(Exception):
+    def __init__(self, message='Not an Apple Health export'):
+        super().__init__(message)
+
+
+def detect_source_kind(path):
+    '''
+    Work out how an export is packaged from its first bytes, falling back to the file suffix.
+    :return: one of SOURCE_ZIP, SOURCE_GZIP or SOURCE_XML
+    '''
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(ZIP_MAGIC):
+        return SOURCE_ZIP
+    if magic.startswith(GZIP_MAGIC):
+        return SOURCE_GZIP
+    if magic.lstrip().startswith(b'<') or path.lower().endswith('.xml'):
+        return SOURCE_XML
+    raise UnknownSourceException(f'Unrecognized data source: {path}')
+
+
+def find_export_member(zippy:zipfile.ZipFile):
+    '''
+    Find the export.xml member of an export zip. Apple has used several top level folder names
+    (apple_health_export/, localized names) so match on the base name and prefer the shallowest.
+    '''
+    candidates = [name for name in zippy.namelist() if posixpath.basename(name) == EXPORT_XML_NAME]
+    if not candidates:
+        raise UnknownSourceException(f'No {EXPORT_XML_NAME} in {zippy.filename}')
+    return min(candidates, key=lambda name: (name.count('/'), len(name)))
+
+
+class RouteReader:
+    '''
+    Reads the workout routes listed by ExportSource.route_files. An export.zip is opened once, when
+    the reader is made, since opening it parses the whole central directory; a worker process keeps
+    one RouteReader for all the routes it parses.
+    '''
+    def __init__(self, path, kind=None):
+        '''
+        :param path: path of the export
+        :param kind: ExportSource.kind of the export, detected from the file if not given
+        '''
+        self.path = path
+        self.kind = kind or detect_source_kind(path)
+        self._zip = zipfile.ZipFile(path, 'r') if self.kind == SOURCE_ZIP else None
+
+    def read(self, route_file):
+        '''
+        :param route_file: entry of route_files()
+        :return: contents of the route file
+        '''
+        if self._zip is not None:
+            return self._zip.read(route_file)
+        with open(route_file, 'rb') as f:
+            return f.read()
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+
+def read_route_file(path, route_file, kind=None):
+    '''
+    Read a single workout route, see RouteReader for reading many.
+    '''
+    reader = RouteReader(path, kind)
+    try:
+        return reader.read(route_file)
+    finally:
+        reader.close()
+
+
+class _CountingReader(io.RawIOBase):
+    '''Raw stream wrapper that counts the bytes read through it, for progress reporting.'''
+    def __init__(self, f):
+        super().__init__()
+        self._f = f
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._f.readinto(b)
+        if n:
+            self.count += n
+        return n
+
+
+class ExportSource:
+    '''
+    Buffered binary stream over an Apple Health export: an export.zip, a plain export.xml or a
+    gzip compressed export.xml. Data is decompressed as the parser reads it; the full payload is
+    never held in memory. Use as a context manager and pass the object itself to the parser.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.kind = detect_source_kind(path)
+        self.member_name = None
+        self.size = 0 # total bytes that position counts towards
+        self._files = []
+        self._zip = None
+        self._counter = None
+        self._stream = None
+
+    def open(self):
+        if self.kind == SOURCE_ZIP:
+            zippy = zipfile.ZipFile(self.path, 'r')
+            self._files.append(zippy)
+            self._zip = zippy
+            self.member_name = find_export_member(zippy)
+            self.size = zippy.getinfo(self.member_name).file_size
+            member = zippy.open(self.member_name)
+            self._files.append(member)
+            self._counter = _CountingReader(member)
+            self._stream = io.BufferedReader(self._counter, READ_BUFFER_SIZE)
+        elif self.kind == SOURCE_GZIP:
+            # progress is measured on the compressed bytes since the inflated size is unknown
+            raw = open(self.path, 'rb', buffering=0)
+            self._files.append(raw)
+            self.size = os.path.getsize(self.path)
+            self._counter = _CountingReader(raw)
+            compressed = io.BufferedReader(self._counter, READ_BUFFER_SIZE)
+            self._stream = io.BufferedReader(gzip.GzipFile(fileobj=compressed, mode='rb'), READ_BUFFER_SIZE)
+        else:
+            raw = open(self.path, 'rb', buffering=0)
+            self._files.append(raw)
+            self.size = os.path.getsize(self.path)
+            self._counter = _CountingReader(raw)
+            self._stream = io.BufferedReader(self._counter, READ_BUFFER_SIZE)
+        return self
+
+    def close(self):
+        if self._stream:
+            self._stream.close()
+            self._stream = None
+        for f in reversed(self._files):
+            f.close()
+        self._files = []
+        self._zip = None
+
+    def route_files(self):
+        '''
+        The GPX workout routes that come with the export: members of the workout-routes folder of an
+        export.zip, or the workout-routes directory next to an unpacked export.xml.
+        :return: list of zip member names or file paths, for RouteReader.read
+        '''
+        if self._zip is not None:
+            return sorted(name for name in self._zip.namelist()
+                          if posixpath.basename(posixpath.dirname(name)) == ROUTES_DIR_NAME
+                          and name.lower().endswith(ROUTE_SUFFIX))
+        routes_dir = os.path.join(os.path.dirname(os.path.abspath(self.path)), ROUTES_DIR_NAME)
+        if not os.path.isdir(routes_dir):
+            return []
+        return sorted(os.path.join(routes_dir, name) for name in os.listdir(routes_dir)
+                      if name.lower().endswith(ROUTE_SUFFIX))
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def readline(self, size=-1):
+        return self._stream.readline(size)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    @property
+    def position(self):
+        return self._counter.count if self._counter else 0
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
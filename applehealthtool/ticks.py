@@ -0,0 +1,196 @@
+'''
+Tick positions and labels for the axes of a graph.
+
+time_ticks picks a step a clock or calendar would use (minutes, hours, days, months or years) so
+that no more than max_ticks fit in the range, and value_ticks does the same with 1, 2 and 5 times a
+power of ten. AxisTicks keeps the ticks of one DataViewScaler and only works them out again when the
+scaler's limits change, so a redraw with the same range reuses the arrays and labels.
+'''
+import datetime
+import math
+
+import numpy
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+# steps in seconds below a day, aligned to local time
+CLOCK_STEPS = (MINUTE, 2 * MINUTE, 5 * MINUTE, 10 * MINUTE, 15 * MINUTE, 30 * MINUTE,
+               HOUR, 2 * HOUR, 3 * HOUR, 6 * HOUR, 12 * HOUR)
+DAY_STEPS = (1, 2, 7, 14)
+MONTH_STEPS = (1, 2, 3, 6)
+YEAR_STEPS = (1, 2, 5, 10, 20, 50, 100)
+MONTH_SECONDS = 30.44 * DAY # only used to pick a step
+YEAR_SECONDS = 365.25 * DAY
+VALUE_MULTIPLES = (1, 2, 5)
+
+TIME_AXIS = 'time'
+VALUE_AXIS = 'value'
+
+
+class Ticks:
+    '''
+    Ticks of an axis: positions in data units and, for each, a label and a second line of context
+    (e.g. the date under the first hour of a day) that is empty where it would repeat the one before.
+    '''
+    def __init__(self, positions, labels, context=None):
+        self.positions = numpy.asarray(positions, dtype=numpy.float64)
+        self.labels = labels
+        self.context = context if context is not None else [''] * len(labels)
+        self.view_positions = self.positions # set by AxisTicks
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def _local(seconds):
+    return datetime.datetime.fromtimestamp(seconds)
+
+
+def _with_context(dates, label_format, context_format):
+    # context only where it differs from the tick before
+    labels = []
+    context = []
+    previous = None
+    for d in dates:
+        labels.append(d.strftime(label_format))
+        line = d.strftime(context_format) if context_format else ''
+        context.append(line if line != previous else '')
+        previous = line
+    return labels, context
+
+
+def _clock_ticks(start, stop, step):
+    # local clock times, aligned with the UTC offset at start; a DST change shifts the ticks after it by an hour
+    offset = _local(start).astimezone().utcoffset().total_seconds()
+    first = math.ceil((start + offset) / step) * step - offset
+    positions = numpy.arange(first, stop + 1, step, dtype=numpy.float64)
+    labels, context = _with_context([_local(p) for p in positions], '%H:%M', '%b %d %Y')
+    return Ticks(positions, labels, context)
+
+
+def _day_ticks(start, stop, step):
+    # local midnights of every step'th day, counted from day 1 so the ticks stay put while panning
+    day = _local(start).date()
+    end = _local(stop).date()
+    dates = []
+    while day <= end:
+        if day.toordinal() % step == 0:
+            midnight = datetime.datetime.combine(day, datetime.time())
+            if start <= midnight.timestamp() <= stop:
+                dates.append(midnight)
+        day += datetime.timedelta(days=1)
+    labels, context = _with_context(dates, '%d', '%b %Y')
+    return Ticks([d.timestamp() for d in dates], labels, context)
+
+
+def _month_ticks(start, stop, step):
+    first = _local(start)
+    end = _local(stop)
+    year, month = first.year, first.month
+    dates = []
+    while (year, month) <= (end.year, end.month):
+        if (month - 1) % step == 0:
+            d = datetime.datetime(year, month, 1)
+            if start <= d.timestamp() <= stop:
+                dates.append(d)
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+    labels, context = _with_context(dates, '%b', '%Y')
+    return Ticks([d.timestamp() for d in dates], labels, context)
+
+
+def _year_ticks(start, stop, step):
+    first = _local(start).year
+    dates = [datetime.datetime(year, 1, 1) for year in range(first - first % step, _local(stop).year + 1, step)]
+    dates = [d for d in dates if start <= d.timestamp() <= stop]
+    return Ticks([d.timestamp() for d in dates], [d.strftime('%Y') for d in dates])
+
+
+def time_ticks(start, stop, max_ticks):
+    '''
+    :param start: epoch seconds
+    :param stop: epoch seconds
+    :param max_ticks: most ticks wanted in the range
+    :return: Ticks at the finest clock or calendar step giving no more than max_ticks
+    '''
+    span = stop - start
+    if span <= 0 or max_ticks < 1:
+        return Ticks([], [])
+    for step in CLOCK_STEPS:
+        if span / step <= max_ticks:
+            return _clock_ticks(start, stop, step)
+    for step in DAY_STEPS:
+        if span / (step * DAY) <= max_ticks:
+            return _day_ticks(start, stop, step)
+    for step in MONTH_STEPS:
+        if span / (step * MONTH_SECONDS) <= max_ticks:
+            return _month_ticks(start, stop, step)
+    for step in YEAR_STEPS:
+        if span / (step * YEAR_SECONDS) <= max_ticks:
+            return _year_ticks(start, stop, step)
+    return _year_ticks(start, stop, YEAR_STEPS[-1])
+
+
+def nice_step(span, max_ticks):
+    '''
+    :return: the smallest 1, 2 or 5 times a power of ten giving no more than max_ticks steps across span
+    '''
+    rough = span / max(max_ticks, 1)
+    power = 10.0 ** math.floor(math.log10(rough))
+    for multiple in VALUE_MULTIPLES:
+        if multiple * power >= rough:
+            return multiple * power
+    return 10 * power
+
+
+def value_ticks(low, high, max_ticks):
+    '''
+    :return: Ticks at multiples of nice_step between low and high
+    '''
+    span = high - low
+    if span <= 0 or max_ticks < 1:
+        return Ticks([], [])
+    step = nice_step(span, max_ticks)
+    positions = numpy.arange(math.ceil(low / step), math.floor(high / step) + 1) * step
+    decimals = max(0, -math.floor(math.log10(step)))
+    return Ticks(positions, [f'{p:.{decimals}f}' for p in positions])
+
+
+class AxisTicks:
+    '''
+    The ticks of a DataViewScaler, worked out again only when its limits change.
+    '''
+    def __init__(self, scaler, kind=VALUE_AXIS, min_spacing=50):
+        '''
+        :param kind: TIME_AXIS for epoch seconds, VALUE_AXIS for numbers
+        :param min_spacing: pixels between ticks at least, e.g. the width of a label and a gap
+        '''
+        self.scaler = scaler
+        self.kind = kind
+        self.min_spacing = min_spacing
+        self._state = None
+        self.ticks = Ticks([], [])
+        self.computed = 0
+
+    def update(self):
+        '''
+        :return: Ticks with view_positions set for the current scaler
+        '''
+        state = self.scaler.state
+        if state == self._state:
+            return self.ticks
+        self._state = state
+        self.computed += 1
+        if not self.scaler.is_valid:
+            self.ticks = Ticks([], [])
+            return self.ticks
+        low, high = sorted((self.scaler.data_min, self.scaler.data_max))
+        max_ticks = int(abs(self.scaler.view_max - self.scaler.view_min) // self.min_spacing)
+        if self.kind == TIME_AXIS:
+            self.ticks = time_ticks(low, high, max_ticks)
+        else:
+            self.ticks = value_ticks(low, high, max_ticks)
+        self.ticks.view_positions = self.scaler.scale_array(self.ticks.positions)
+        return self.ticks
@@ -0,0 +1,274 @@
+'''
+Lazy loading of graph data for panning and zooming across years of records.
+
+A LazyDataSeries holds only the rollup buckets (or records, when zoomed in far enough) around the
+current x view. The data is fetched in tiles, fixed spans of TILE_BUCKETS buckets at one resolution,
+kept in an LRU TileCache. Tiles in view are fetched when the view changes; the tiles either side of it
+are requested from a TileLoader thread so a pan finds them already loaded.
+'''
+import collections
+import queue
+import threading
+
+import numpy
+import pygame
+from pygame.event import custom_type
+
+from applehealthtool.GraphData import DataSeries
+from applehealthtool.columns import ReportColumns, fetch_columns
+from applehealthtool.healthdatabase import ROLLUP_RAW, ROLLUP_COLUMNS
+
+TILE_BUCKETS = 1024 # buckets per tile at the rollup resolutions
+RAW_TILE_SECONDS = 6 * 60 * 60 # span of a tile of records
+DEFAULT_CACHE_TILES = 64
+PREFETCH_MARGIN = 0.5 # view widths either side of the view that are loaded in the background, as far as the cache has room
+
+TILE_LOADED = custom_type() # posted by post_tile_loaded with resolution and index
+
+
+def post_tile_loaded(resolution, index):
+    # on_tile_loaded for the GUI: the main loop calls refresh() on the series when the event arrives
+    pygame.event.post(pygame.event.Event(TILE_LOADED, {'resolution': resolution, 'index': index}))
+
+
+def tile_span(resolution):
+    '''
+    :return: seconds covered by one tile at resolution
+    '''
+    return resolution * TILE_BUCKETS if resolution != ROLLUP_RAW else RAW_TILE_SECONDS
+
+
+def split_tiles(columns, resolution, first, count):
+    '''
+    Split a result covering consecutive tiles into one ReportColumns per tile.
+    :param first: index of the first tile
+    :return: {tile index: ReportColumns}
+    '''
+    span = tile_span(resolution)
+    bounds = numpy.searchsorted(columns['startDate'], [(first + n) * span for n in range(count + 1)])
+    return {first + n: ReportColumns({name: a[bounds[n]:bounds[n + 1]] for name, a in columns.columns.items()})
+            for n in range(count)}
+
+
+def concat_columns(parts):
+    '''
+    :param parts: non empty list of ReportColumns with the same columns
+    '''
+    if len(parts) == 1:
+        return parts[0]
+    return ReportColumns({name: numpy.concatenate([part[name] for part in parts]) for name in parts[0].names})
+
+
+class RollupTileProvider:
+    '''
+    Fetches the tiles of one record type from AppleHealthDatabase.get_rollup_report.
+    May be called from the TileLoader thread; every call opens its own connection.
+    '''
+    def __init__(self, database, type_name, sourcename=''):
+        self.database = database
+        self.type_name = type_name
+        self.sourcename = sourcename
+
+    def resolution_for(self, start, stop, pixels):
+        return self.database.pick_rollup_resolution(start, stop, pixels)
+
+    def fetch(self, resolution, first, count):
+        '''
+        Read count consecutive tiles in one query.
+        :return: {tile index: ReportColumns}
+        '''
+        span = tile_span(resolution)
+        start = first * span
+        stop = (first + count) * span
+        columns = self.database.get_rollup_report(self.type_name, start, stop - 1, sourcename=self.sourcename,
+                                                  resolution=resolution)
+        return split_tiles(columns, resolution, first, count)
+
+
+class TileCache:
+    '''
+    LRU map of (resolution, tile index) -> ReportColumns, shared by the GUI and loader threads.
+    '''
+    def __init__(self, capacity=DEFAULT_CACHE_TILES):
+        self.capacity = capacity
+        self._tiles = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+            return tile
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._tiles
+
+    def put(self, key, tile):
+        with self._lock:
+            self._tiles[key] = tile
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.capacity:
+                self._tiles.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tiles)
+
+
+class TileLoader(threading.Thread):
+    '''
+    Background thread that fills a TileCache with the tiles asked for by request().
+    '''
+    def __init__(self, provider, cache, on_loaded=None):
+        '''
+        :param on_loaded: called on the loader thread with (resolution, tile index) after a tile is cached,
+                          e.g. to post a pygame event so the GUI redraws
+        '''
+        super(TileLoader, self).__init__(name='tile-loader', daemon=True)
+        self.provider = provider
+        self.cache = cache
+        self.on_loaded = on_loaded
+        self._queue = queue.Queue()
+        self._requested = set()
+        self._lock = threading.Lock()
+
+    def request(self, key):
+        with self._lock:
+            if key in self._requested or key in self.cache:
+                return
+            self._requested.add(key)
+        self._queue.put(key)
+
+    def close(self):
+        self._queue.put(None)
+
+    def run(self):
+        while True:
+            key = self._queue.get()
+            if key is None:
+                return
+            resolution, index = key
+            try:
+                if key not in self.cache:
+                    for tile_key, tile in self.provider.fetch(resolution, index, 1).items():
+                        self.cache.put((resolution, tile_key), tile)
+                    if self.on_loaded:
+                        self.on_loaded(resolution, index)
+            except Exception as e:
+                print(f'Tile {key} failed: {type(e).__name__}: {e}')
+            finally:
+                with self._lock:
+                    self._requested.discard(key)
+
+
+class LazyDataSeries(DataSeries):
+    '''
+    A DataSeries of rollup columns (startDate, count, min, max, mean) that loads only what the view shows.
+    Call set_view, or update_from_scaler, whenever the x range changes; the series then holds the tiles
+    covering the view and whatever neighbouring tiles are already cached.
+    '''
+    def __init__(self, name, provider, y_data_cols=('mean',), label='', color=pygame.Color(0, 0, 0),
+                 line_width=1, cache_tiles=DEFAULT_CACHE_TILES, prefetch=True, on_tile_loaded=None):
+        '''
+        :param provider: RollupTileProvider or anything with the same resolution_for and fetch
+        :param y_data_cols: columns of ROLLUP_COLUMNS to draw, e.g. ['min', 'max']
+        :param prefetch: load the tiles either side of the view in the background
+        :param on_tile_loaded: see TileLoader
+        '''
+        super(LazyDataSeries, self).__init__(name, fetch_columns(None, ROLLUP_COLUMNS), 'startDate', list(y_data_cols),
+                                             label=label, color=color, line_width=line_width)
+        self.provider = provider
+        self.cache = TileCache(cache_tiles)
+        self.resolution = None
+        self._view = None
+        self._loader = None
+        if prefetch:
+            self._loader = TileLoader(provider, self.cache, on_tile_loaded)
+            self._loader.start()
+
+    def close(self):
+        if self._loader:
+            self._loader.close()
+            self._loader = None
+
+    def update_from_scaler(self, xscaler):
+        '''
+        Load the data range of an x DataViewScaler at the width of its view.
+        '''
+        self.set_view(xscaler.data_min, xscaler.data_max, abs(xscaler.view_max - xscaler.view_min))
+
+    def set_view(self, start, stop, pixels):
+        '''
+        :param start: epoch seconds at the left of the view
+        :param stop: epoch seconds at the right of the view
+        :param pixels: width of the view
+        '''
+        self._view = (start, stop, pixels)
+        resolution = self.provider.resolution_for(start, stop, pixels)
+        span = tile_span(resolution)
+        first = int(start // span)
+        last = int(stop // span)
+        view_tiles = last - first + 1
+        if view_tiles > self.cache.capacity:
+            # a view wider than the cache would evict its own tiles while it is assembled
+            print(f'Tile cache grown from {self.cache.capacity} to {view_tiles} tiles')
+            self.cache.capacity = view_tiles
+        # get rather than in, so the cached view tiles are the most recently used and the prefetch evicts others
+        missing = [index for index in range(first, last + 1) if self.cache.get((resolution, index)) is None]
+        # consecutive missing tiles in one query each
+        for run_start, run in self._runs(missing):
+            for index, tile in self.provider.fetch(resolution, run_start, run).items():
+                self.cache.put((resolution, index), tile)
+        # no more prefetch than fits in the cache next to the view, or each loaded tile evicts one in view
+        margin = min(int(view_tiles * PREFETCH_MARGIN) + 1, (self.cache.capacity - view_tiles) // 2)
+        if self._loader:
+            for n in range(1, margin + 1):
+                self._loader.request((resolution, last + n))
+                self._loader.request((resolution, first - n))
+        self.resolution = resolution
+        self._assemble(resolution, first, last, margin)
+
+    def refresh(self):
+        '''
+        Pick up tiles loaded in the background since the last set_view.
+        '''
+        if self._view:
+            self.set_view(*self._view)
+
+    @staticmethod
+    def _runs(indexes):
+        runs = []
+        for index in indexes:
+            if runs and runs[-1][0] + runs[-1][1] == index:
+                runs[-1][1] += 1
+            else:
+                runs.append([index, 1])
+        return runs
+
+    def _assemble(self, resolution, first, last, margin):
+        # the view tiles and the cached tiles next to them, up to the first gap so no line is drawn across one
+        low = first
+        while low > first - margin and (resolution, low - 1) in self.cache:
+            low -= 1
+        high = last
+        while high < last + margin and (resolution, high + 1) in self.cache:
+            high += 1
+        parts = []
+        for index in range(low, high + 1):
+            tile = self.cache.get((resolution, index))
+            if tile is None:
+                # evicted since it was looked at, e.g. by the loader caching tiles requested for an earlier view
+                tile = self.provider.fetch(resolution, index, 1)[index]
+            parts.append(tile)
+        self._data = concat_columns(parts)
+        self._x = self._data[self._x_data_col]
+        self._y = [self._data[col] for col in self._y_data_cols]
+        if self.data_count < 1:
+            self._xmin = self._xmax = self._ymin = self._ymax = None
+            return
+        self._xmin = float(self._x[0])
+        self._xmax = float(self._x[-1])
+        self._ymin = float(min(numpy.nanmin(y) for y in self._y))
+        self._ymax = float(max(numpy.nanmax(y) for y in self._y))
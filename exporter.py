@@ -1,43 +1,17 @@
 import argparse
-import datetime
 import os.path
 
 import sqlalchemy
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import sys
-import xml.etree.ElementTree as ET
 
-print(f'SQLAlchemy Version: {sqlalchemy.__version__}')
-Base = declarative_base()
-
-class HealthData(Base):
-    ### Schema:
-    # type           : HKQuantityTypeIdentifierHeight
-    # sourceName     : Health
-    # sourceVersion  : _string_
-    # device         : _string_
-    # unit           : _string_
-    # creationDate   : 2015-05-03 16:58:00 -0700
-    # startDate      : 2015-05-03 16:58:00 -0700
-    # endDate        : 2015-05-03 16:58:00 -0700
-    # value          : 5.83333
-    __tablename__ = 'health_data'
-    id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True, autoincrement=True)
-    type = sqlalchemy.Column('type', sqlalchemy.String)
-    sourceName = sqlalchemy.Column('sourceName', sqlalchemy.String)
-    sourceVersion = sqlalchemy.Column('sourceVersion', sqlalchemy.String)
-    device = sqlalchemy.Column('device', sqlalchemy.String)
-    unit = sqlalchemy.Column('unit', sqlalchemy.String)
-    creationDate = sqlalchemy.Column('creationDate', sqlalchemy.DateTime)
-    startDate = sqlalchemy.Column('startDate', sqlalchemy.DateTime)
-    endDate = sqlalchemy.Column('endDate', sqlalchemy.DateTime)
-    value = sqlalchemy.Column('value', sqlalchemy.String)
+from applehealthtool.dates import parse_local_date
+from applehealthtool.healthdatabase import AppleHealthDatabase, LAYOUTS, LAYOUT_SINGLE
+from applehealthtool.importer import HealthDataImporter, RECORD_TYPE_PRESETS, resolve_record_types
+from applehealthtool.pipeline import ParallelImporter
+from applehealthtool.sources import ExportSource
 
+print(f'SQLAlchemy Version: {sqlalchemy.__version__}')
 
-def make_datetime(datetime_string):
-    format = '%Y-%m-%d %H:%M:%S %z'
-    return datetime.datetime.strptime(datetime_string, format)
+PROGRESS_REPORT_INTERVAL = 100000
 
 
 def dump_elem_attr(attrib):
@@ -45,90 +19,76 @@ def dump_elem_attr(attrib):
         print(f'{k:15}: {attrib[k]}')
 
 
-def import_data(config, db):
+def import_data(config, database):
     xmlfile = config.input
     print(f'importing {xmlfile}')
 
     startdate = None
-    dateformat = "%Y-%m-%d"
     if config.start:
-        startdate = datetime.datetime.strptime(config.start, dateformat)
-
-    tree = ET.parse(xmlfile)
-    root = tree.getroot()
-
-    records = {}
-
-    tags = {
-        'HKQuantityTypeIdentifierBloodPressureDiastolic': 'diastolic',
-        'HKQuantityTypeIdentifierBloodPressureSystolic': 'systolic',
-        'HKQuantityTypeIdentifierHeartRate': 'heart-rate',
-        'HKQuantityTypeIdentifierBodyMass': 'weight',
-        'HKQuantityTypeIdentifierHeight': 'height',
-        'HKQuantityTypeIdentifierActiveEnergyBurned': 'calories',
-        'HKQuantityTypeIdentifierFlightsClimbed': 'stairs',
-        'HKQuantityTypeIdentifierStepCount': 'steps',
-        'HKQuantityTypeIdentifierDistanceWalkingRunning': 'distance'
-    }
-    Session = sessionmaker(bind = db)
-    session = Session()
-    rcount = 0
-    total_count = 0
-    COMMIT_MAX = 100000
-    for elem in root:
-        if elem.tag == 'Record':
-            record = HealthData(
-                type = elem.attrib['type'],
-                sourceName = elem.attrib['sourceName'],
-                sourceVersion = elem.attrib['sourceVersion'] if 'sourceVersion' in elem.attrib else '',
-                device = str(elem.attrib['device']) if 'device' in elem.attrib else '',
-                unit = elem.attrib['unit'] if 'unit' in elem.attrib else '',
-                creationDate = make_datetime(elem.attrib['creationDate']),
-                startDate = make_datetime(elem.attrib['startDate']),
-                endDate = make_datetime(elem.attrib['endDate']),
-                value = elem.attrib['value']
-            )
-            session.add(record)
-            rcount += 1
-            total_count += 1
-            if rcount >= COMMIT_MAX:
-                print(f'commit {COMMIT_MAX} records...')
-                session.commit()
-                rcount = 0
-
-    if rcount > 0:
-        session.commit()
-    print(f'Total of {total_count} records')
+        startdate = parse_local_date(config.start)
+    types = resolve_record_types(config.types.split(',')) if config.types else None
+    exclude_types = resolve_record_types(config.exclude_types.split(',')) if config.exclude_types else None
+    type_since = {}
+    for type_start in config.type_start:
+        name, _, date = type_start.partition('=')
+        for record_type in resolve_record_types([name]):
+            type_since[record_type] = parse_local_date(date)
+    filters = dict(since=startdate, types=types, exclude_types=exclude_types, type_since=type_since,
+                   routes=not config.no_routes, route_workers=config.route_workers)
+
+    reported = [0]
+    def progress(records_read, records_saved):
+        # the parallel importer reports in whole chunks, so print on crossing each interval
+        if records_read - reported[0] >= PROGRESS_REPORT_INTERVAL:
+            reported[0] = records_read - records_read % PROGRESS_REPORT_INTERVAL
+            print(f'read {records_read} records, saved {records_saved}...')
+
+    # loading into an empty database: build the indexes after loading rather than during it
+    rebuild_indexes = database.latest_record() is None
+    if config.workers:
+        importer = ParallelImporter(database, workers=config.workers, batch_size=config.batch_size,
+                                    progress_callback=progress, rebuild_indexes=rebuild_indexes, **filters)
+    else:
+        importer = HealthDataImporter(database, batch_size=config.batch_size, progress_callback=progress,
+                                      rebuild_indexes=rebuild_indexes, **filters)
+    with ExportSource(xmlfile) as source:
+        total_count = importer.import_source(source)
+    print(f'Total of {total_count} new records')
 
 def parse_command_line():
     parser = argparse.ArgumentParser()
     parser.add_argument('--database', '-d', help='Path to sqlite database', type=str, required=True)
-    parser.add_argument('--input', '-i', help='Path to Apple Health XML file', type=str)
-    parser.add_argument('--start', '-s', help='Date to start report', default=None, type=str)
+    parser.add_argument('--input', '-i', help='Path to Apple Health export (export.zip, export.xml or export.xml.gz)', type=str)
+    parser.add_argument('--start', '-s', help='Skip records created before this date (YYYY-MM-DD [HH:MM:SS])',
+                        default=None, type=str)
+    type_help = f'types, short tags (heart-rate) or presets ({", ".join(RECORD_TYPE_PRESETS)})'
+    parser.add_argument('--types', '-t', help=f'Comma separated {type_help} to import, everything else is skipped',
+                        default=None, type=str)
+    parser.add_argument('--exclude-types', '-x', help=f'Comma separated {type_help} to skip',
+                        default=None, type=str)
+    parser.add_argument('--no-routes', help='Do not import the GPX workout routes', action='store_true')
+    parser.add_argument('--type-start', help='TYPE=DATE, per-type replacement for --start; may be repeated',
+                        action='append', default=[], type=str)
+    parser.add_argument('--batch-size', '-b', help='Number of records written per transaction',
+                        default=AppleHealthDatabase.DEFAULT_BATCH_SIZE, type=int)
+    parser.add_argument('--fresh', '-f', help='Delete the database and import everything again',
+                        action='store_true')
+    parser.add_argument('--layout', '-l', help='Storage layout of a new database: one record table or per-type '
+                        f'partition tables (default {LAYOUT_SINGLE})', choices=LAYOUTS, default=None)
+    parser.add_argument('--workers', '-w', help='Parse the export in this many worker processes, 0 to import '
+                        'in a single process', default=0, type=int)
+    parser.add_argument('--route-workers', help='Parse the GPX workout routes in this many worker processes '
+                        '(default a quarter of the CPUs)', default=None, type=int)
     return parser.parse_args()
 
 def open_database(config):
-    print(f'Opening DB: {config.database}')
-    if os.path.exists(config.database):
+    if config.fresh and os.path.exists(config.database):
         os.remove(config.database)
-    uri = f'sqlite:///{config.database}'
-    print(uri)
-    db = sqlalchemy.create_engine(uri, echo = False)
-    TABLE_NAME = 'health_data'
-    ### Schema:
-    # type           : HKQuantityTypeIdentifierHeight
-    # sourceName     : Health
-    # unit           : ft
-    # creationDate   : 2015-05-03 16:58:00 -0700
-    # startDate      : 2015-05-03 16:58:00 -0700
-    # endDate        : 2015-05-03 16:58:00 -0700
-    # value          : 5.83333
-    metadata = sqlalchemy.MetaData(db)
-    Base.metadata.create_all(db)
-    db.connect()
-    return db
+    database = AppleHealthDatabase()
+    database.open_database(config.database, layout=config.layout)
+    return database
 
 if __name__ == '__main__':
     config = parse_command_line()
-    db = open_database(config)
-    import_data(config, db)
\ No newline at end of file
+    database = open_database(config)
+    import_data(config, database)
@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+import argparse
+import contextlib
+import io
+import os
+import time
+
+import numpy
+import pygame
+import pygame_gui
+
+from applehealthtool.GraphData import DataSeries, DataDateRange, DataViewScaler
+from applehealthtool.TimeDataGraph import UITimeDataGraph, DateRangeDataLayer
+from applehealthtool.columns import ReportColumns
+
+SLEEP_VALUES = ('HKCategoryValueSleepAnalysisInBed', 'HKCategoryValueSleepAnalysisAsleep')
+
+
+def make_series(days, count):
+    # a reading every 5 minutes per series, offset so the lines do not overlap
+    x = numpy.arange(0, days * 86400, 300, dtype=numpy.float64)
+    return [DataSeries(f'series {n}', ReportColumns({'startDate': x, 'value': 60 + n * 10 + 20 * numpy.sin(x / 5000 + n)}),
+                       'startDate', ['value'], color=pygame.Color(n * 30 % 256, 0, 128))
+            for n in range(count)]
+
+
+def make_sleep(days):
+    # in bed from 22:00 and asleep from 23:00, until 7:00
+    start = numpy.repeat(numpy.arange(days, dtype=numpy.float64) * 86400, 2) + numpy.tile([-7200, -3600], days)
+    end = start - start % 86400 + 86400 * (start % 86400 > 0) + 7 * 3600
+    value = numpy.array(SLEEP_VALUES * days, dtype=object)
+    return DataDateRange('sleep', ReportColumns({'startDate': start, 'endDate': end, 'value': value}),
+                         'startDate', 'endDate', 'value', {})
+
+
+def surface_bytes(graph):
+    return sum(layer.surface.get_pitch() * layer.surface.get_height()
+               for layer in graph._layer_list if layer.surface is not None)
+
+
+def timed(repeat, function):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def run(config):
+    size = (config.width, config.height)
+    pygame.init()
+    # a display, so layers can convert their surfaces to its format
+    pygame.display.set_mode(size, pygame.HIDDEN)
+    manager = pygame_gui.UIManager(size)
+    # the layers print as they draw, keep that out of the timing
+    with contextlib.redirect_stdout(io.StringIO()):
+        graph = UITimeDataGraph(pygame.Rect((0, 0), size), manager, title='Benchmark')
+        graph.add_sleep_data(make_sleep(config.days))
+        for series in make_series(config.days, config.series):
+            graph.add_data_series_layer(series)
+        graph.redraw(full=True)
+
+        def pan():
+            # a new x range renders every layer drawn through the scalers
+            graph.set_x_range(graph._xscaler.data_min + 60, graph._xscaler.data_max + 60)
+            graph.redraw()
+        render_ms = timed(config.repeat, pan)
+        # blending the rendered layers onto the image, what every full redraw pays
+        compose_ms = timed(config.repeat, lambda: graph.redraw(full=True))
+    layers = len(graph._layer_list)
+    print(f'{layers} layers on a {size[0]}x{size[1]} graph, {config.series} series of {config.days} days')
+    print(f'    layer surfaces: {surface_bytes(graph) / 1024 / 1024:8.2f} MiB')
+    print(f'    render + compose: {render_ms:8.3f} ms/frame')
+    print(f'    compose only:     {compose_ms:8.3f} ms/frame')
+    benchmark_sleep(config)
+
+
+def benchmark_sleep(config):
+    # years of sleep on a layer the size of the data area of the graph
+    sleep = make_sleep(config.sleep_days)
+    size = (config.width - 170, config.height - 200)
+    xscaler = DataViewScaler([float(sleep.x_start_values[0]), float(sleep.x_end_values[-1])], [0, size[0]])
+    yscaler = DataViewScaler([0, 200], [size[1], 0])
+    type_color_map = {SLEEP_VALUES[0]: pygame.Color(200, 200, 255, 128), SLEEP_VALUES[1]: pygame.Color(200, 255, 200, 128)}
+    layer = DateRangeDataLayer(sleep, size, xscaler, yscaler, type_color_map, 0)
+
+    def render():
+        layer.dirty = True
+        layer.update()
+    ms = timed(config.repeat, render)
+    print(f'sleep layer, {sleep.data_count} ranges across {size[0]} px')
+    print(f'    render:           {ms:8.3f} ms/frame')
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='Measure the layer surface memory and frame time of a UITimeDataGraph')
+    parser.add_argument('--series', '-n', help='Number of data series', default=8, type=int)
+    parser.add_argument('--days', help='Days of synthetic data per series', default=30, type=int)
+    parser.add_argument('--sleep-days', help='Days of sleep for the sleep layer', default=3 * 365, type=int)
+    parser.add_argument('--width', help='Width of the graph', default=1400, type=int)
+    parser.add_argument('--height', help='Height of the graph', default=800, type=int)
+    parser.add_argument('--repeat', '-r', help='Frames per measurement', default=50, type=int)
+    parser.add_argument('--headless', help='Use the dummy SDL video driver', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    config = parse_command_line()
+    if config.headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    run(config)
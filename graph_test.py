@@ -6,8 +6,10 @@ from pygame_gui.elements import UIImage
 from pygame_gui_extras.app import GuiApp
 
 from applehealthtool.GraphData import DataSeries, DataDateRange
+from applehealthtool.dates import to_epoch
 from applehealthtool.TimeDataGraph import UITimeDataGraph, DataSeriesLayer, GraphLayer
-from applehealthtool.healthdatabase import AppleHealthDatabase
+from applehealthtool.healthdatabase import AppleHealthDatabase, HEART_RATE_TYPE
+from applehealthtool.viewport import LazyDataSeries, RollupTileProvider, TILE_LOADED, post_tile_loaded
 
 test_data = [
     {"date": datetime.strptime("2022-06-01 10:36:23.000000", "%Y-%m-%d %H:%M:%S.000000"), "systolic": 146, "diastolic": 81},
@@ -71,13 +73,33 @@ class GraphTestApp(GuiApp):
             self.graph.add_sleep_data(data)
 
     def set_date_range(self, startdate, enddate):
-        d = datetime.strptime(startdate, "%Y-%m-%d")
-        date0 = datetime.timestamp(d)
-        d = datetime.strptime(enddate, "%Y-%m-%d")
-        date1 = datetime.timestamp(d)
+        date0 = to_epoch(startdate)
+        date1 = to_epoch(enddate)
         self.graph._xscaler.update_data_limits(date0, date1)
         print(f'date range: {date0} to {date1}')
 
+    def handle_event(self, event):
+        if event.type == TILE_LOADED:
+            self.graph.refresh_data_sets()
+            self.graph.redraw()
+        elif event.type == pygame.KEYDOWN:
+            # arrows pan, up / down zoom in and out around the middle
+            x_min = self.graph._xscaler.data_min
+            x_max = self.graph._xscaler.data_max
+            width = x_max - x_min
+            if event.key == pygame.K_LEFT:
+                x_min, x_max = x_min - width / 4, x_max - width / 4
+            elif event.key == pygame.K_RIGHT:
+                x_min, x_max = x_min + width / 4, x_max + width / 4
+            elif event.key == pygame.K_UP:
+                x_min, x_max = x_min + width / 4, x_max - width / 4
+            elif event.key == pygame.K_DOWN:
+                x_min, x_max = x_min - width / 2, x_max + width / 2
+            else:
+                return
+            self.graph.set_x_range(x_min, x_max)
+            self.graph.redraw()
+
     def setup(self):
         # self.graph.add_data(data_series)
         self.graph.redraw()
@@ -85,7 +107,7 @@ class GraphTestApp(GuiApp):
 DB_PATH = './health.db'
 
 if __name__ == '__main__':
-    database = AppleHealthDatabase()
+    database = AppleHealthDatabase(persist_reports=True)
     db_engine = database.open_database(DB_PATH, echo=True)
     app = GraphTestApp()
 
@@ -101,11 +123,12 @@ if __name__ == '__main__':
     # sourcename = 'FitCloudPro'
     app.set_date_range(startdate, enddate)
 
-    bp_data = database.get_blood_pressure_report(startdate=startdate, enddate=enddate, sourcename=sourcename)
+    bp_data = database.get_blood_pressure_report(startdate=startdate, enddate=enddate, sourcename=sourcename,
+                                                columnar=True)
     print(f'** BP Count: {len(bp_data)}')
     if len(bp_data) > 0:
-        print(f'** BP Start: {bp_data[0]["startDate"]}')
-        print(f'** BP   End: {bp_data[-1]["startDate"]}')
+        print(f'** BP Start: {bp_data["startDate"][0]}')
+        print(f'** BP   End: {bp_data["startDate"][-1]}')
         data_series = DataSeries('blood pressure', bp_data,
                              x_data_col='startDate',
                              y_data_cols=['systolic', 'diastolic'],
@@ -117,26 +140,22 @@ if __name__ == '__main__':
         print(f'    BP min/max: {data_series.x_minmax}, {data_series.y_minmax}')
         app.add_series_layer(data_series)
 
-    hr_data = database.get_heart_rate_report(startdate=startdate, enddate=enddate, sourcename=sourcename)
-    print(f'** HR Count: {len(hr_data)}')
-    if len(hr_data) > 0:
-        print(f'** HR Start: {hr_data[0]["startDate"]}')
-        print(f'** HR   End: {hr_data[-1]["startDate"]}')
-        hr_series = DataSeries('heart rate', hr_data,
-                           x_data_col='startDate',
-                           y_data_cols=['heartrate'],
-                           label='heart rate',
-                           timeseries=True,
-                           color=pygame.Color(0, 200, 0, 255),
-                           line_width=3)
-
-        app.add_series_layer(hr_series)
-
-    sleep_data = database.get_sleep_report(startdate=startdate, enddate=enddate, sourcename=sourcename)
+    # heart rate is loaded from the rollups for whatever range is shown, pan and zoom with the arrow keys
+    hr_series = LazyDataSeries('heart rate', RollupTileProvider(database, HEART_RATE_TYPE, sourcename),
+                               y_data_cols=['mean'],
+                               label='heart rate',
+                               color=pygame.Color(0, 200, 0, 255),
+                               line_width=3,
+                               on_tile_loaded=post_tile_loaded)
+    app.add_series_layer(hr_series)
+    print(f'** HR Count: {hr_series.data_count} at resolution {hr_series.resolution}')
+
+    sleep_data = database.get_sleep_report(startdate=startdate, enddate=enddate, sourcename=sourcename,
+                                           columnar=True)
     print(f'** SLEEP Count: {len(sleep_data)}')
     if len(sleep_data) > 0:
-        print(f'** SLEEP Start: {sleep_data[0]["startDate"]} to {sleep_data[0]["endDate"]}: {sleep_data[0]["value"]}')
-        print(f'** SLEEP End: {sleep_data[-1]["startDate"]} to {sleep_data[-1]["endDate"]}: {sleep_data[-1]["value"]}')
+        print(f'** SLEEP Start: {sleep_data["startDate"][0]} to {sleep_data["endDate"][0]}: {sleep_data["value"][0]}')
+        print(f'** SLEEP End: {sleep_data["startDate"][-1]} to {sleep_data["endDate"][-1]}: {sleep_data["value"][-1]}')
     sleep_series = DataDateRange('sleep', sleep_data, 'startDate', 'endDate', 'value', {})
     app.add_sleep_data(sleep_series)
 
@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+from applehealthtool.healthdatabase import AppleHealthDatabase, CONNECTION_PROFILES, \
+    INTERACTIVE_PROFILE, BULK_IMPORT_PROFILE
+
+TYPES = (
+    'HKQuantityTypeIdentifierHeartRate',
+    'HKQuantityTypeIdentifierStepCount',
+    'HKQuantityTypeIdentifierActiveEnergyBurned',
+)
+
+
+def make_rows(count):
+    tz = datetime.timezone(datetime.timedelta(hours=-7))
+    start = datetime.datetime(2022, 1, 1, tzinfo=tz)
+    rows = []
+    for n in range(count):
+        d = start + datetime.timedelta(seconds=n * 30)
+        rows.append({
+            'type': TYPES[n % len(TYPES)],
+            'sourceName': 'Apple Watch',
+            'sourceVersion': '8.7',
+            'device': '<<HKDevice: 0x283a6c5f0>, name:Apple Watch, manufacturer:Apple Inc., model:Watch>',
+            'unit': 'count/min',
+            'creationDate': d,
+            'startDate': d,
+            'endDate': d,
+            'value': str(60 + n % 40)
+        })
+    return rows
+
+
+def run(label, rows, write, profile=INTERACTIVE_PROFILE):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database = AppleHealthDatabase()
+        database.open_database(os.path.join(tmpdir, 'bench.db'), profile=profile)
+        start = time.perf_counter()
+        write(database, rows)
+        elapsed = time.perf_counter() - start
+        database.db_engine.dispose()
+    print(f'{label:>18}: {len(rows)} rows in {elapsed:.2f}s = {len(rows) / elapsed:,.0f} rows/s')
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='Compare insert throughput of the write paths and connection profiles')
+    parser.add_argument('--rows', '-n', help='Number of synthetic rows', default=200000, type=int)
+    parser.add_argument('--batch-size', '-b', help='Rows per transaction',
+                        default=AppleHealthDatabase.DEFAULT_BATCH_SIZE, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    config = parse_command_line()
+    rows = make_rows(config.rows)
+    for profile in (INTERACTIVE_PROFILE, BULK_IMPORT_PROFILE):
+        print(f'{profile}: {CONNECTION_PROFILES[profile]}')
+        run(f'orm/{profile}', rows,
+            lambda db, r: db.insert_records(r, batch_size=config.batch_size),
+            profile=profile)
+        run(f'bulk/{profile}', rows,
+            lambda db, r: db.insert_rows(r, batch_size=config.batch_size),
+            profile=profile)
@@ -0,0 +1,28 @@
+#! /usr/bin/env python3
+import argparse
+
+from applehealthtool.healthdatabase import AppleHealthDatabase
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='Migrate a v1 health_data database to the compact v2 schema')
+    parser.add_argument('--database', '-d', help='Path to sqlite database', type=str, required=True)
+    parser.add_argument('--drop-legacy', help='Drop the v1 table instead of renaming it to health_data_v1',
+                        action='store_true')
+    parser.add_argument('--vacuum', help='Compact the database file afterwards', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    config = parse_command_line()
+    database = AppleHealthDatabase()
+    database.open_database(config.database)
+    if not database.needs_migration():
+        print('Nothing to migrate')
+    else:
+        database.migrate_legacy_data(drop_legacy=config.drop_legacy,
+                                     callback=lambda n: print(f' - migrated {n} records'))
+    if config.vacuum:
+        print('Vacuuming...')
+        database.vacuum()
+    print(f'database has {database.count_rows()} rows')
@@ -0,0 +1,176 @@
+#! /usr/bin/env python3
+import argparse
+import contextlib
+import datetime
+import os
+import re
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy.sql import text
+
+from applehealthtool.GraphData import DataSeries, DataDateRange
+from applehealthtool.healthdatabase import AppleHealthDatabase, LAYOUTS, LAYOUT_SINGLE, REPORTS, \
+    HEART_RATE_TYPE, SYSTOLIC_TYPE, DIASTOLIC_TYPE, SLEEP_TYPE, BULK_IMPORT_PROFILE, REPORT_CACHE_SUFFIX
+
+SOURCE_NAME = 'Apple Watch'
+SLEEP_VALUES = ('HKCategoryValueSleepAnalysisInBed', 'HKCategoryValueSleepAnalysisAsleep')
+
+
+def make_rows(days):
+    # a reading every 5 minutes of heart rate, blood pressure twice a day and a night of sleep per day
+    tz = datetime.timezone(datetime.timedelta(hours=-7))
+    start = datetime.datetime(2022, 1, 1, tzinfo=tz)
+    rows = []
+    for day in range(days):
+        midnight = start + datetime.timedelta(days=day)
+        for minute in range(0, 24 * 60, 5):
+            d = midnight + datetime.timedelta(minutes=minute)
+            rows.append((HEART_RATE_TYPE, SOURCE_NAME, '', '', 'count/min', d, d, d, 60 + minute % 40))
+        for hour in (8, 20):
+            d = midnight + datetime.timedelta(hours=hour)
+            rows.append((SYSTOLIC_TYPE, SOURCE_NAME, '', '', 'mmHg', d, d, d, 120 + day % 10))
+            rows.append((DIASTOLIC_TYPE, SOURCE_NAME, '', '', 'mmHg', d, d, d, 80 + day % 10))
+        for n, value in enumerate(SLEEP_VALUES):
+            d = midnight + datetime.timedelta(hours=22 + n)
+            rows.append((SLEEP_TYPE, SOURCE_NAME, '', '', '', d, d, d + datetime.timedelta(hours=7), value))
+    return rows
+
+
+def inline_literals(sql, params):
+    # the same statement with the values written into the SQL, the way the reports used to build it
+    def literal(match):
+        value = params[match.group(1)]
+        return 'NULL' if value is None else str(value)
+    return re.sub(r':(\w+)', literal, sql)
+
+
+def benchmark(database, name, startdate, enddate, sourcename, repeat):
+    with database.db_engine.connect() as connection:
+        query, params = database._report_params(connection, name, startdate, enddate, sourcename)
+        # the end moves a second per call, like a window being scrolled, so no two literal statements match
+        start = time.perf_counter()
+        for n in range(repeat):
+            connection.execute(text(inline_literals(query.sql, dict(params, end=params['end'] + n)))).fetchall()
+        literal_ms = (time.perf_counter() - start) * 1000 / repeat
+        start = time.perf_counter()
+        for n in range(repeat):
+            rows = connection.execute(query.statement, dict(params, end=params['end'] + n)).fetchall()
+        bound_ms = (time.perf_counter() - start) * 1000 / repeat
+        literal_plan = [row[-1] for row in connection.execute(text(f'EXPLAIN QUERY PLAN {inline_literals(query.sql, params)}'))]
+    print(f'{name} ({len(rows)} rows{", source " + sourcename if sourcename else ""})')
+    print(f'    literal SQL: {literal_ms:8.3f} ms/call  plan: {"; ".join(literal_plan)}')
+    print(f'    bound SQL:   {bound_ms:8.3f} ms/call  plan: {"; ".join(database.explain_report(name, startdate, enddate, sourcename))}')
+
+
+def make_data_sets(database, startdate, enddate, sourcename, columnar):
+    # what graph_test.py does with the reports
+    bp = database.get_blood_pressure_report(startdate, enddate, sourcename, columnar=columnar)
+    hr = database.get_heart_rate_report(startdate, enddate, sourcename, columnar=columnar)
+    sleep = database.get_sleep_report(startdate, enddate, sourcename, columnar=columnar)
+    return [
+        DataSeries('blood pressure', bp, 'startDate', ['systolic', 'diastolic'], timeseries=True),
+        DataSeries('heart rate', hr, 'startDate', ['heartrate'], timeseries=True),
+        DataDateRange('sleep', sleep, 'startDate', 'endDate', 'value', {}),
+    ]
+
+
+def benchmark_results(database, startdate, enddate, sourcename, repeat):
+    print(f'reports to graph data sets, {startdate} to {enddate}')
+    for label, columnar in (('row dicts:', False), ('columnar: ', True)):
+        # the data sets print their limits, keep that out of the timing
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                data_sets = make_data_sets(database, startdate, enddate, sourcename, columnar)
+            ms = (time.perf_counter() - start) * 1000 / repeat
+            tracemalloc.start()
+            data_sets = make_data_sets(database, startdate, enddate, sourcename, columnar)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        rows = sum(data_set.data_count for data_set in data_sets)
+        print(f'    {label} {ms:8.3f} ms/call  {rows} rows  peak {peak / 1024:8.1f} KiB')
+
+
+def benchmark_rollups(database, startdate, enddate, sourcename, pixels, repeat):
+    resolution = database.pick_rollup_resolution(startdate, enddate, pixels)
+    print(f'heart rate {startdate} to {enddate} across {pixels} px')
+    start = time.perf_counter()
+    for _ in range(repeat):
+        columns = database.get_heart_rate_report(startdate, enddate, sourcename, columnar=True)
+    ms = (time.perf_counter() - start) * 1000 / repeat
+    print(f'    records:         {ms:8.3f} ms/call  {len(columns)} rows')
+    start = time.perf_counter()
+    for _ in range(repeat):
+        columns = database.get_rollup_report(HEART_RATE_TYPE, startdate, enddate, pixels, sourcename)
+    ms = (time.perf_counter() - start) * 1000 / repeat
+    print(f'    rollup ({resolution:5d} s): {ms:8.3f} ms/call  {len(columns)} buckets')
+
+
+def benchmark_cache(path, startdate, enddate, sourcename, repeat):
+    # cold is a fresh process with an empty cache, warm the same call again, restart a fresh process
+    # finding the columnar results persisted by the first
+    print(f'report cache, {startdate} to {enddate}')
+    timings = {}
+    for label in ('cold', 'warm', 'restart'):
+        if label != 'warm':
+            database = AppleHealthDatabase(persist_reports=True)
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                database.open_database(path)
+        for columnar in (False, True):
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                for _ in range(1 if label != 'warm' else repeat):
+                    make_data_sets(database, startdate, enddate, sourcename, columnar)
+            timings[label, columnar] = (time.perf_counter() - start) * 1000 / (1 if label != 'warm' else repeat)
+    for columnar in (False, True):
+        print(f'    {"columnar: " if columnar else "row dicts:"} ' +
+              '  '.join(f'{label} {timings[label, columnar]:8.3f} ms' for label in ('cold', 'warm', 'restart')))
+    shutil.rmtree(path + REPORT_CACHE_SUFFIX, ignore_errors=True)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='Compare report queries with inlined literals and bound parameters, '
+                                                 'row and columnar report results, rollups '
+                                                 'and the report cache')
+    parser.add_argument('--database', '-d', help='Existing database to query, a synthetic one is built if not given',
+                        default=None, type=str)
+    parser.add_argument('--days', help='Days of synthetic data', default=365, type=int)
+    parser.add_argument('--layout', '-l', help=f'Storage layout of the synthetic database (default {LAYOUT_SINGLE})',
+                        choices=LAYOUTS, default=None)
+    parser.add_argument('--start', '-s', help='Start of the report window', default='2022-03-01', type=str)
+    parser.add_argument('--end', '-e', help='End of the report window', default='2022-03-08', type=str)
+    parser.add_argument('--source', help='Source name filter', default='', type=str)
+    parser.add_argument('--repeat', '-r', help='Calls per measurement', default=200, type=int)
+    parser.add_argument('--results-start', help='Start of the window converted to data sets', default='2022-01-01', type=str)
+    parser.add_argument('--pixels', help='Graph width the rollup resolution is picked for', default=1000, type=int)
+    parser.add_argument('--results-end', help='End of the window converted to data sets', default='2023-01-01', type=str)
+    return parser.parse_args()
+
+
+def run(config, path):
+    # every call below reads the database, benchmark_cache measures the cache
+    database = AppleHealthDatabase(report_cache_entries=0)
+    database.open_database(path, layout=config.layout)
+    if database.count_rows() == 0:
+        with database.connection_profile(BULK_IMPORT_PROFILE):
+            database.insert_rows(make_rows(config.days))
+            database.update_rollups()
+    for name in REPORTS:
+        benchmark(database, name, config.start, config.end, config.source, config.repeat)
+    benchmark_results(database, config.results_start, config.results_end, config.source, max(1, config.repeat // 100))
+    benchmark_rollups(database, config.results_start, config.results_end, config.source, config.pixels,
+                      max(1, config.repeat // 10))
+    database.db_engine.dispose()
+    benchmark_cache(path, config.results_start, config.results_end, config.source, config.repeat)
+
+
+if __name__ == '__main__':
+    config = parse_command_line()
+    if config.database:
+        run(config, config.database)
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            run(config, os.path.join(tmpdir, 'bench.db'))
@@ -0,0 +1,85 @@
+import datetime
+import unittest
+
+from applehealthtool.dates import APPLE_DATE_FORMAT, parse_epoch, parse_datetime, parse_utc_epoch, to_epoch
+
+# the whole range of UTC offsets, including the half and quarter hour ones
+OFFSETS = ('-1200', '-0930', '-0700', '-0000', '+0000', '+0530', '+0545', '+1000', '+1245', '+1400')
+DATES = (
+    '1970-01-01 00:00:00',
+    '1999-12-31 23:59:59',
+    '2000-02-28 12:00:00',
+    '2000-02-29 23:59:59', # leap day of a year divisible by 400
+    '2000-03-01 00:00:00',
+    '2019-02-28 23:59:59',
+    '2019-03-01 00:00:00',
+    '2020-02-29 00:00:00',
+    '2021-03-14 02:30:00', # a local DST gap, the offset in the string is what counts
+    '2022-08-09 10:39:37',
+    '2023-12-31 23:59:59',
+    '2024-02-29 06:07:08',
+    '2100-02-28 23:59:59', # 2100 is not a leap year
+    '2100-03-01 00:00:00',
+)
+
+
+def strptime(date_string):
+    return datetime.datetime.strptime(date_string, APPLE_DATE_FORMAT)
+
+
+class TestParseEpoch(unittest.TestCase):
+    def test_matches_strptime(self):
+        for date in DATES:
+            for offset in OFFSETS:
+                s = f'{date} {offset}'
+                with self.subTest(s=s):
+                    self.assertEqual(parse_epoch(s), int(strptime(s).timestamp()))
+
+    def test_memoised_string_parses_the_same(self):
+        s = '2020-02-29 13:14:15 +0545'
+        self.assertEqual(parse_epoch(s), parse_epoch(s))
+        self.assertEqual(parse_epoch(s), int(strptime(s).timestamp()))
+
+    def test_every_day_of_a_leap_year(self):
+        day = datetime.datetime(2024, 1, 1, 23, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=-7)))
+        while day.year == 2024:
+            s = day.strftime(APPLE_DATE_FORMAT)
+            self.assertEqual(parse_epoch(s), int(day.timestamp()), s)
+            day += datetime.timedelta(days=1)
+
+    def test_other_layouts_fall_back_to_strptime(self):
+        self.assertEqual(parse_epoch('2022-8-9 10:39:37 -0700'), parse_epoch('2022-08-09 10:39:37 -0700'))
+        with self.assertRaises(ValueError):
+            parse_epoch('2022-08-09T10:39:37-07:00')
+
+    def test_to_epoch(self):
+        s = '2020-02-29 00:00:00 -0930'
+        self.assertEqual(to_epoch(s), int(strptime(s).timestamp()))
+
+
+class TestParseDatetime(unittest.TestCase):
+    def test_matches_strptime(self):
+        for date in DATES:
+            for offset in OFFSETS:
+                s = f'{date} {offset}'
+                with self.subTest(s=s):
+                    expected = strptime(s)
+                    parsed = parse_datetime(s)
+                    self.assertEqual(parsed, expected)
+                    self.assertEqual(parsed.utcoffset(), expected.utcoffset())
+
+
+class TestParseUtcEpoch(unittest.TestCase):
+    def test_matches_fromisoformat(self):
+        for date in DATES:
+            s = date.replace(' ', 'T') + 'Z'
+            with self.subTest(s=s):
+                expected = datetime.datetime.fromisoformat(date).replace(tzinfo=datetime.timezone.utc)
+                self.assertEqual(parse_utc_epoch(s), int(expected.timestamp()))
+
+    def test_fractional_seconds_are_dropped(self):
+        self.assertEqual(parse_utc_epoch('2020-02-29T12:00:00.750Z'), parse_utc_epoch('2020-02-29T12:00:00Z'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+import numpy
+
+from applehealthtool.lod import POINTS_PER_COLUMN, minmax_columns, category_columns, column_runs
+
+
+class TestMinmaxColumns(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.default_rng(17)
+        # a thousand points per column on average, a few columns with a single point
+        self.vx = numpy.sort(numpy.concatenate((rng.uniform(0, 50, 50000), [60.5, 70.25, 70.75])))
+        self.vy = rng.normal(100, 30, len(self.vx))
+
+    def test_keeps_the_extremes_of_each_column(self):
+        x, y = minmax_columns(self.vx, self.vy)
+        columns = numpy.floor(self.vx).astype(numpy.int64)
+        reduced = numpy.floor(x).astype(numpy.int64)
+        for column in numpy.unique(columns):
+            mine = self.vy[columns == column]
+            kept = y[reduced == column]
+            with self.subTest(column=column):
+                self.assertEqual(kept.min(), mine.min())
+                self.assertEqual(kept.max(), mine.max())
+                self.assertEqual(kept[0], mine[0])
+                self.assertEqual(kept[-1], mine[-1])
+                self.assertLessEqual(len(kept), POINTS_PER_COLUMN)
+
+    def test_x_stays_ascending(self):
+        x, _ = minmax_columns(self.vx, self.vy)
+        self.assertTrue(numpy.all(numpy.diff(x) >= 0))
+        self.assertEqual(x[0], self.vx[0])
+        self.assertEqual(x[-1], self.vx[-1])
+
+    def test_empty(self):
+        x, y = minmax_columns(numpy.array([]), numpy.array([]))
+        self.assertEqual(len(x), 0)
+        self.assertEqual(len(y), 0)
+
+
+class TestColumnRuns(unittest.TestCase):
+    def test_merges_adjacent_columns(self):
+        start, stop, code = column_runs(numpy.array([-1, 0, 0, 1, 1, 1, -1, -1, 0, 2]))
+        self.assertEqual(start.tolist(), [1, 3, 8, 9])
+        self.assertEqual(stop.tolist(), [3, 6, 9, 10])
+        self.assertEqual(code.tolist(), [0, 1, 0, 2])
+
+    def test_uncovered_and_empty(self):
+        for columns in (numpy.full(5, -1), numpy.array([], dtype=numpy.int64)):
+            start, stop, code = column_runs(columns)
+            self.assertEqual((len(start), len(stop), len(code)), (0, 0, 0))
+
+    def test_adjacent_and_overlapping_spans_make_one_run(self):
+        # two adjacent spans and an overlapping one of code 0, a short span of code 1 on top of them
+        left = numpy.array([2.0, 5.0, 4.0, 6.2])
+        right = numpy.array([5.0, 8.0, 9.0, 6.4])
+        columns = category_columns(left, right, [0, 0, 0, 1], 12)
+        start, stop, code = column_runs(columns)
+        self.assertEqual(start.tolist(), [2, 6, 7])
+        self.assertEqual(stop.tolist(), [6, 7, 9])
+        self.assertEqual(code.tolist(), [0, 1, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()